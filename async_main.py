@@ -0,0 +1,457 @@
+import os
+import signal
+import asyncio
+import time
+from dotenv import load_dotenv
+from slack_bolt.async_app import AsyncApp
+from slack_bolt.adapter.socket_mode.async_handler import AsyncSocketModeHandler
+from slack_sdk.web.async_client import AsyncWebClient
+from services.async_dify_service import AsyncDifyService
+from services.async_conversation_service import AsyncConversationService
+from services.event_dedup import EventDeduplicator, AsyncPostgresDedupBackend, event_keys
+from services.mention_queue import AsyncMentionQueue
+from services.partitioning import AsyncPartitionManager
+from services.slack_sender import AsyncSlackSender, AsyncThreadReply
+from utils.logger import setup_logger, shutdown_logger, LazyJson
+from utils.config import load_slack_credentials, load_message_max_chars
+from utils.formatters import format_stats_message
+from utils.tracing import Trace
+from utils.metrics import MENTIONS, ERRORS, REPLY_LATENCY, DB_POOL_IN_USE
+from utils.health_server import start_health_server, set_ready
+from utils.lifecycle import StartupTimer, InFlightTracker
+from services.errors import DifyAPIError, DifyTimeoutError, DifyConnectionError, DifyResponseError, DifyConversationNotFoundError
+
+# Load environment variables from .env file
+load_dotenv()
+
+# Setup logging
+logger = setup_logger()
+
+# Initialize required environment variables
+SLACK_BOT_TOKEN, SLACK_APP_TOKEN, DIFY_API_KEY = load_slack_credentials()
+
+# Response mode settings
+DIFY_RESPONSE_MODE = os.environ.get("DIFY_RESPONSE_MODE", "blocking")
+SLACK_UPDATE_INTERVAL = float(os.environ.get("SLACK_UPDATE_INTERVAL", "1.0"))
+STREAMING_PLACEHOLDER = "考え中です..."
+
+# Slack Web APIの接続先（プロキシやベンチマーク用のスタブを使う場合に変更）
+SLACK_API_URL = os.environ.get("SLACK_API_URL")
+
+# initialize_slackで解決したBot User ID（ジョブキューのワーカーが使用）
+BOT_USER_ID = None
+
+# 起動時にDify APIへ事前に確立しておく接続数と、終了時に処理中のメンションの完了を待つ最大秒数
+DIFY_WARM_CONNECTIONS = int(os.environ.get("DIFY_WARM_CONNECTIONS", "2"))
+SHUTDOWN_DRAIN_TIMEOUT = float(os.environ.get("SHUTDOWN_DRAIN_TIMEOUT", "25"))
+
+# スレッド内の質問でDifyの会話を継続するか
+THREAD_CONVERSATION_ENABLED = os.environ.get("THREAD_CONVERSATION_ENABLED", "true").lower() == "true"
+
+# メンションのジョブキューと会話ログのパーティション管理（asyncpgの接続プール作成後にstartupで作成）
+mention_queue = None
+partition_manager = None
+
+def create_event_deduplicator():
+    """EVENT_DEDUP_ENABLED=true（デフォルト）の場合にSlackの再送イベントを破棄する仕組みを作成する"""
+    if os.environ.get("EVENT_DEDUP_ENABLED", "true").lower() != "true":
+        return None
+    return EventDeduplicator(
+        ttl=float(os.environ.get("EVENT_DEDUP_TTL", "600")),
+        max_entries=int(os.environ.get("EVENT_DEDUP_MAX_ENTRIES", "10000"))
+    )
+
+async def create_partition_manager(pool):
+    """CONVERSATION_PARTITIONING=true の場合に会話ログの月次パーティションを管理する仕組みを作成する"""
+    if os.environ.get("CONVERSATION_PARTITIONING", "false").lower() != "true":
+        return None
+    manager = AsyncPartitionManager(
+        pool,
+        retention_months=int(os.environ.get("CONVERSATION_RETENTION_MONTHS", "0")),
+        premake_months=int(os.environ.get("CONVERSATION_PARTITION_PREMAKE", "2")),
+        archive_dir=os.environ.get("CONVERSATION_ARCHIVE_DIR", "conversation_archive"),
+        interval=float(os.environ.get("CONVERSATION_PARTITION_INTERVAL", "3600"))
+    )
+    await manager.setup()
+    manager.start()
+    return manager
+
+async def create_mention_queue(pool, dsn: str):
+    """MENTION_QUEUE_ENABLED=true の場合に複数レプリカでメンションの処理を分担するジョブキューを作成する"""
+    if os.environ.get("MENTION_QUEUE_ENABLED", "false").lower() != "true":
+        return None
+    queue = AsyncMentionQueue(
+        pool, dsn,
+        lambda payload, owns: process_mention(payload['event'], payload.get('event_id'), BOT_USER_ID, still_owned=owns),
+        workers=int(os.environ.get("MENTION_QUEUE_WORKERS", os.environ.get("DIFY_MAX_CONCURRENCY", "8"))),
+        lease=float(os.environ.get("MENTION_QUEUE_LEASE", "60")),
+        poll_interval=float(os.environ.get("MENTION_QUEUE_POLL_INTERVAL", "5")),
+        replica_id=os.environ.get("REPLICA_ID") or None
+    )
+    await queue.start()
+    return queue
+
+def create_slack_sender(client):
+    """チャンネルごとのレート制限と長文の分割を行う送信処理を作成する"""
+    return AsyncSlackSender(
+        client,
+        rate=float(os.environ.get("SLACK_CHANNEL_RATE", "1.0")),
+        burst=int(os.environ.get("SLACK_CHANNEL_BURST", "3")),
+        max_retries=int(os.environ.get("SLACK_MAX_RETRIES", "3")),
+        max_chars=load_message_max_chars()
+    )
+
+# Initialize services
+try:
+    if SLACK_API_URL:
+        app = AsyncApp(client=AsyncWebClient(token=SLACK_BOT_TOKEN, base_url=SLACK_API_URL))
+    else:
+        app = AsyncApp(token=SLACK_BOT_TOKEN)
+    slack_sender = create_slack_sender(app.client)
+    dify_service = AsyncDifyService(api_key=DIFY_API_KEY)
+    conversation_service = AsyncConversationService()
+    event_deduplicator = create_event_deduplicator()
+    # 終了時に完了を待つ、このプロセスで処理中のメンション（ジョブキュー経由の処理はキュー側で待つ）
+    inflight = InFlightTracker()
+    logger.info("Slackアプリ（asyncio）の初期化が完了しました")
+except Exception as e:
+    logger.error(f"Slackアプリの初期化エラー: {str(e)}")
+    raise
+
+@app.command("/stats")
+async def handle_stats_command(ack, command, say, body):
+    """統計情報表示コマンドの処理"""
+    await ack()
+    logger.info(f"統計情報コマンド実行 - ユーザー: {command['user_id']}")
+    trace = Trace("stats", trace_id=body.get('trigger_id'))
+
+    try:
+        if command.get('text') == 'all':
+            # 全体の統計情報を取得（管理者用）
+            with trace.span("db_stats"):
+                stats = await conversation_service.get_total_stats()
+        else:
+            # ユーザー個別の統計情報を取得
+            with trace.span("db_stats"):
+                stats = await conversation_service.get_user_stats(command['user_id'])
+        with trace.span("slack_post"):
+            await say(format_stats_message(stats))
+
+    except Exception as e:
+        error_message = "統計情報の取得中にエラーが発生しました。"
+        logger.error(f"統計情報取得エラー: {str(e)}")
+        await say(error_message)
+
+    finally:
+        trace.finish()
+
+async def stream_reply(query: str, user: str, conversation_id: str, thread_reply: AsyncThreadReply, start_time: float,
+                       on_conversation=None):
+    """Dify APIのストリーミング応答を受信しながらSlackメッセージを途中経過で更新する（最終結果の送信は呼び出し側で行う）"""
+    answer = ""
+    first_token_time = None
+    last_update = 0.0
+
+    async for chunk in dify_service.stream_response(query, user, conversation_id, on_conversation):
+        if first_token_time is None:
+            first_token_time = time.time() - start_time
+        answer += chunk
+
+        # Slackのレート制限を超えないよう一定間隔でのみ更新
+        now = time.time()
+        if now - last_update >= SLACK_UPDATE_INTERVAL:
+            # 途中経過の更新はチャンネルの送信枠が空いている場合のみ（待たずにストリームの受信を続ける）
+            await thread_reply.send(answer, block=False)
+            last_update = now
+
+    if not answer:
+        raise DifyResponseError()
+    return answer, first_token_time
+
+@app.event("app_mention")
+async def handle_app_mention(event, say, context, body):
+    """Handle mentions to the bot and respond with Dify API responses"""
+    if not event or 'text' not in event:
+        logger.warning("メッセージの内容を取得できませんでした: %s", event)
+        await say("申し訳ありません。メッセージを処理できませんでした。")
+        return
+
+    logger.info("メンションイベント受信 - ユーザー: %s, チャンネル: %s, ts: %s",
+                event.get('user'), event.get('channel'), event.get('ts'))
+    logger.debug("イベント詳細: %s", LazyJson(event))
+
+    # Slackの再送（同一イベントID・同一メッセージ）はDify呼び出し前に破棄する
+    if event_deduplicator and not await event_deduplicator.claim_async(body.get('event_id'), event.get('channel'), event.get('ts')):
+        return
+
+    keys = event_keys(body.get('event_id'), event.get('channel'), event.get('ts'))
+    if mention_queue and keys:
+        # ジョブキューに登録し、いずれかのレプリカのワーカーが1回だけ処理する
+        try:
+            await mention_queue.enqueue(keys[-1], {'event': event, 'event_id': body.get('event_id')})
+            return
+        except Exception as e:
+            logger.warning(f"ジョブキューへの登録に失敗したため、このプロセスで処理します: {str(e)}")
+    # Boltが認可時に取得したBot User IDを利用し、イベントごとのauth.testを避ける
+    with inflight.track():
+        await process_mention(event, body.get('event_id'), context.bot_user_id)
+
+async def process_mention(event: dict, event_id: str, bot_user_id: str, still_owned=None):
+    """
+    メンションに対してDify APIの応答をスレッドに返信する
+    still_owned: ジョブキュー経由の場合に、ジョブをまだ保持しているかを返すコルーチン関数（他のレプリカに引き継がれていれば返信しない）
+    """
+    MENTIONS.inc()
+    trace = Trace("app_mention", trace_id=event_id)
+
+    async def owned() -> bool:
+        """返信の直前に、このプロセスが返信してよいかを確認する"""
+        return still_owned is None or await still_owned()
+
+    async def reply(text: str):
+        """プレースホルダーがあれば更新し、なければスレッドに投稿する"""
+        if not await owned():
+            return
+        with trace.span("slack_post"):
+            await thread_reply.send(text)
+        REPLY_LATENCY.observe(trace.elapsed())
+
+    async def save(response: str, error_occurred: bool = False, first_token_time: float = None):
+        """会話を保存（トレースがサンプリング対象なら区間情報も保存）"""
+        response_time = time.time() - start_time
+        # 応答は投稿済みのため、保存に失敗してもユーザーへエラーメッセージを重ねて送らない
+        try:
+            with trace.span("db_save"):
+                await conversation_service.save_conversation(
+                    user, query, response, response_time, error_occurred=error_occurred,
+                    first_token_time=first_token_time, trace=trace.to_dict() if trace.sampled else None
+                )
+        except Exception as e:
+            ERRORS.labels('db_save').inc()
+            logger.warning(f"応答の投稿後に会話の保存に失敗しました: {str(e)}")
+
+    def captured(new_conversation_id: str):
+        """Difyの応答に含まれる会話IDを記録する"""
+        nonlocal dify_conversation_id
+        dify_conversation_id = new_conversation_id
+
+    async def with_conversation(call):
+        """スレッドのDify会話を継続して呼び出す（Dify側で会話が見つからなければ新しい会話としてやり直す）"""
+        nonlocal conversation_id
+        try:
+            return await call(conversation_id)
+        except DifyConversationNotFoundError:
+            try:
+                await conversation_service.forget_dify_conversation(event['channel'], thread_ts, user)
+            except Exception as e:
+                logger.warning(f"スレッドとDify会話の対応の削除に失敗しました: {str(e)}")
+            conversation_id = None
+            return await call(None)
+
+    async def remember_conversation():
+        """新しく払い出されたDifyの会話IDをスレッドに対応付ける（以降のスレッド内の質問で会話を継続する）"""
+        if not THREAD_CONVERSATION_ENABLED or lookup_failed or not dify_conversation_id \
+                or dify_conversation_id == conversation_id:
+            return
+        try:
+            with trace.span("db_thread_map"):
+                await conversation_service.save_dify_conversation(event['channel'], thread_ts, user, dify_conversation_id)
+        except Exception as e:
+            logger.warning(f"スレッドとDify会話の対応の保存に失敗しました: {str(e)}")
+
+    try:
+        query = event['text'].replace(f"<@{bot_user_id}>", "").strip()
+        user = event['user']
+        thread_ts = event.get('thread_ts') or event.get('ts')
+        thread_reply = AsyncThreadReply(slack_sender, event['channel'], thread_ts)
+        trace.set("user", user)
+        trace.set("channel", event.get('channel'))
+
+        # スレッド内の質問は、スレッドに対応付けたDifyの会話を継続する
+        conversation_id = dify_conversation_id = None
+        lookup_failed = False
+        if THREAD_CONVERSATION_ENABLED and event.get('thread_ts'):
+            try:
+                with trace.span("db_thread_map"):
+                    conversation_id = await conversation_service.get_dify_conversation(event['channel'], thread_ts, user)
+            except Exception as e:
+                # 対応を確認できない場合は新しい会話として応答し、既存の対応は上書きしない
+                lookup_failed = True
+                logger.warning(f"スレッドとDify会話の対応の取得に失敗しました: {str(e)}")
+
+        # 応答時間の計測開始
+        start_time = time.time()
+
+        try:
+            if DIFY_RESPONSE_MODE == "streaming":
+                # プレースホルダーを投稿し、トークン受信に合わせて更新
+                with trace.span("slack_placeholder"):
+                    await thread_reply.send(STREAMING_PLACEHOLDER)
+                with trace.span("dify_stream"):
+                    response, first_token_time = await with_conversation(
+                        lambda cid: stream_reply(query, user, cid, thread_reply, start_time, captured))
+                if not await owned():
+                    return
+                with trace.span("slack_post"):
+                    await thread_reply.send(response)
+                REPLY_LATENCY.observe(trace.elapsed())
+                trace.set("first_token_time", round(first_token_time, 4))
+                logger.info(f"ストリーミング応答完了 - 初回トークン: {first_token_time:.2f}秒, 合計: {time.time() - start_time:.2f}秒")
+                await remember_conversation()
+                await save(response, first_token_time=first_token_time)
+            else:
+                # Dify APIからの応答を取得
+                with trace.span("dify"):
+                    response = await with_conversation(
+                        lambda cid: dify_service.get_response(query, user, cid, on_conversation=captured))
+
+                # スレッド内で応答（長い応答は複数のメッセージに分割）
+                if not await owned():
+                    return
+                with trace.span("slack_post"):
+                    await thread_reply.send(response)
+                REPLY_LATENCY.observe(trace.elapsed())
+
+                # 会話を保存（投稿後に行い、DBの待ち時間を応答に含めない）
+                await remember_conversation()
+                await save(response)
+
+        except DifyTimeoutError as e:
+            error_message = "申し訳ありません。応答がタイムアウトしました。しばらく待ってから再度お試しください。"
+            logger.error("Dify APIタイムアウト")
+            ERRORS.labels(type(e).__name__).inc()
+            await reply(error_message)
+            await save(error_message, error_occurred=True)
+
+        except DifyConnectionError as e:
+            error_message = "申し訳ありません。APIサーバーとの接続に問題が発生しました。"
+            logger.error(f"Dify API接続エラー: {str(e.original_error)}")
+            ERRORS.labels(type(e).__name__).inc()
+            await reply(error_message)
+            await save(error_message, error_occurred=True)
+
+        except DifyResponseError as e:
+            error_message = "申し訳ありません。応答の処理中にエラーが発生しました。"
+            logger.error(f"Dify API応答エラー: {str(e)}")
+            ERRORS.labels(type(e).__name__).inc()
+            await reply(error_message)
+            await save(error_message, error_occurred=True)
+
+        except DifyAPIError as e:
+            error_message = "申し訳ありません。予期しないエラーが発生しました。"
+            logger.error(f"Dify APIエラー: {str(e)}")
+            ERRORS.labels(type(e).__name__).inc()
+            await reply(error_message)
+            await save(error_message, error_occurred=True)
+
+    except Exception as e:
+        error_message = "申し訳ありません。システムエラーが発生しました。"
+        logger.error(f"システムエラー: {str(e)}")
+        ERRORS.labels('unexpected').inc()
+        await slack_sender.post(event['channel'], error_message,
+                                thread_ts=thread_ts if 'thread_ts' in locals() else None)
+
+    finally:
+        trace.finish()
+
+async def initialize_slack():
+    """Initialize Slack connection and verify bot credentials"""
+    try:
+        global BOT_USER_ID
+        auth_test = await app.client.auth_test()
+        bot_user_id = auth_test["user_id"]
+        BOT_USER_ID = bot_user_id
+        logger.info("Slack接続成功: Bot User ID = %s", bot_user_id)
+        logger.info("Bot名: %s, チーム: %s", auth_test.get("user"), auth_test.get("team"))
+        return bot_user_id
+    except Exception as e:
+        logger.error("Slack接続エラー: %s", str(e))
+        logger.error("トークンと権限の設定を確認してください")
+        logger.error("必要な権限: app_mentions:read, chat:write, commands")
+        raise
+
+async def startup(timer: StartupTimer = None) -> StartupTimer:
+    """
+    DBのスキーマ確認と接続プールの作成、Dify APIへの事前接続、Slackの認証確認を並行して行い、
+    その後でジョブキューを開始する（Socket Modeで接続する前に呼び出す）
+    """
+    global mention_queue
+    timer = timer or StartupTimer()
+
+    async def database():
+        global partition_manager
+        with timer.phase("database"):
+            await conversation_service.start()
+            pool = conversation_service.pool
+            DB_POOL_IN_USE.set_function(lambda: pool.get_size() - pool.get_idle_size())
+            # 共有イベントストアはasyncpgの接続プール作成後に設定する
+            if event_deduplicator and os.environ.get("EVENT_DEDUP_BACKEND", "memory") == "postgres":
+                event_deduplicator.backend = AsyncPostgresDedupBackend(pool)
+            partition_manager = await create_partition_manager(pool)
+
+    async def dify():
+        with timer.phase("dify"):
+            await dify_service.warm_up(DIFY_WARM_CONNECTIONS)
+
+    async def slack():
+        with timer.phase("slack"):
+            await initialize_slack()
+
+    await asyncio.gather(database(), dify(), slack())
+    mention_queue = await create_mention_queue(conversation_service.pool, conversation_service.db_url)
+    return timer
+
+async def shutdown(handler: AsyncSocketModeHandler = None):
+    """
+    新しいイベントの受付を止め、処理中のメンションの完了を待ってから接続を閉じる
+    待ち時間の合計はSHUTDOWN_DRAIN_TIMEOUT秒まで
+    """
+    deadline = time.monotonic() + SHUTDOWN_DRAIN_TIMEOUT
+    set_ready(False)
+    if handler is not None:
+        await handler.close_async()
+    if mention_queue:
+        # 処理中のジョブの完了を待つ（未処理のジョブは他のレプリカが引き継ぐ）
+        await mention_queue.close(timeout=max(0.0, deadline - time.monotonic()))
+    if not await inflight.wait_idle_async(max(0.0, deadline - time.monotonic())):
+        logger.warning(f"処理中のメンションが{inflight.count}件残っていますが終了します")
+    await dify_service.close()
+    if partition_manager:
+        await partition_manager.close()
+    await conversation_service.close()
+    shutdown_logger()
+
+async def main():
+    """Asyncio application entry point"""
+    logger.info("Slackボットアプリケーションを起動します（asyncioモード）")
+    timer = StartupTimer()
+    start_health_server()
+    # SIGTERM（コンテナ停止時など）・SIGINTで待機を終え、終了処理を実行する
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, stop.set)
+    handler = None
+    try:
+        # 接続の準備が整うまではSocket Modeで接続せず、readyzもunavailableのままにする
+        await startup(timer)
+
+        logger.info("Socket Modeハンドラを開始します...")
+        with timer.phase("socket_mode"):
+            handler = AsyncSocketModeHandler(app, SLACK_APP_TOKEN)
+            await handler.connect_async()
+        set_ready()
+        logger.info("Socket Modeハンドラが正常に開始されました")
+        timer.ready()
+        await stop.wait()
+        logger.info("終了シグナルを受信しました - 処理中のメンションの完了を待って終了します")
+
+    except Exception as e:
+        logger.error("Slackアプリの起動に失敗しました: %s", str(e))
+        raise
+
+    finally:
+        await shutdown(handler)
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1 @@
+"""Offline load-test harness (python -m benchmarks.run)"""
@@ -0,0 +1,267 @@
+"""Local stand-ins for the Slack Web API and the Dify chat-messages API"""
+import json
+import time
+import random
+import threading
+from urllib.parse import parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ERROR_MODES = ('http500', 'timeout', 'malformed')
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 256
+
+class _JsonHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def _read_body(self) -> bytes:
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def _send_json(self, status: int, payload, headers: dict = None):
+        body = payload if isinstance(payload, bytes) else json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class _FakeServer:
+    def __init__(self, handler_class):
+        self._server = _Server(('127.0.0.1', 0), handler_class)
+        self._server.fake = self
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._lock = threading.Lock()
+
+    @property
+    def port(self) -> int:
+        return self._server.server_address[1]
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+class _DifyHandler(_JsonHandler):
+    def do_GET(self):
+        # 起動時の事前接続（DifyService.warm_up）で呼ばれる
+        if self.path.split('?', 1)[0].endswith('/parameters'):
+            self.server.fake.count('warmups')
+            self._send_json(200, {'opening_statement': '', 'suggested_questions': []})
+        else:
+            self._send_json(404, {'code': 'not_found', 'message': self.path})
+
+    def do_POST(self):
+        fake = self.server.fake
+        request = json.loads(self._read_body() or b'{}')
+        if not self.path.endswith('/chat-messages'):
+            self._send_json(404, {'code': 'not_found', 'message': self.path})
+            return
+
+        error_mode = fake.next_error()
+        latency = fake.next_latency()
+        if error_mode == 'timeout':
+            time.sleep(fake.hang_seconds)
+            self.close_connection = True
+            return
+        if error_mode == 'http500':
+            time.sleep(latency)
+            self._send_json(500, {'code': 'internal_error', 'message': 'injected failure'})
+            return
+        if error_mode == 'malformed':
+            time.sleep(latency)
+            self._send_json(200, {'unexpected': True})
+            return
+
+        conversation_id = request.get('conversation_id')
+        if conversation_id and not fake.continue_conversation(conversation_id, request.get('user')):
+            # Difyと同じく、存在しない（または他のユーザーの）会話IDは404
+            self._send_json(404, {'code': 'not_found', 'message': 'Conversation Not Exists.', 'status': 404})
+            return
+        if not conversation_id:
+            conversation_id = fake.new_conversation(request.get('user'))
+
+        answer = fake.make_answer(request.get('query', ''))
+        if request.get('response_mode') == 'streaming':
+            self._stream(answer, conversation_id, latency, fake.stream_chunks)
+        else:
+            time.sleep(latency)
+            self._send_json(200, {'answer': answer, 'conversation_id': conversation_id, 'message_id': 'bench'})
+
+    def _stream(self, answer: str, conversation_id: str, latency: float, chunks: int):
+        """応答をchunks個に分割し、latency秒かけてSSEで送信する"""
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.close_connection = True
+
+        size = max(1, -(-len(answer) // chunks))
+        interval = latency / chunks
+        for i in range(0, len(answer), size):
+            time.sleep(interval)
+            event = {'event': 'message', 'answer': answer[i:i + size], 'conversation_id': conversation_id}
+            self.wfile.write(f"data: {json.dumps(event, ensure_ascii=False)}\n\n".encode('utf-8'))
+            self.wfile.flush()
+        end = {'event': 'message_end', 'conversation_id': conversation_id}
+        self.wfile.write(f"data: {json.dumps(end)}\n\n".encode('utf-8'))
+
+class FakeDifyServer(_FakeServer):
+    """Dify chat-messages API stand-in with injectable latency, streaming and errors"""
+
+    def __init__(self, latency: float = 0.5, jitter: float = 0.0, error_rate: float = 0.0, error_mode: str = 'http500',
+                 stream_chunks: int = 10, answer_size: int = 400, hang_seconds: float = 60.0, seed: int = None):
+        if error_mode not in ERROR_MODES:
+            raise ValueError(f"error_modeが不正です: {error_mode}")
+        super().__init__(_DifyHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_mode = error_mode
+        self.stream_chunks = max(1, stream_chunks)
+        self.answer_size = answer_size
+        self.hang_seconds = hang_seconds
+        self._random = random.Random(seed)
+        self._conversations = {}  # 会話ID -> ユーザー
+        self.stats = {'requests': 0, 'injected_errors': 0, 'conversations': 0, 'continued': 0, 'unknown_conversations': 0,
+                      'warmups': 0}
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.port}/v1"
+
+    def count(self, key: str) -> int:
+        with self._lock:
+            self.stats[key] += 1
+            return self.stats[key]
+
+    def new_conversation(self, user: str) -> str:
+        conversation_id = f"bench-{self.count('conversations')}"
+        with self._lock:
+            self._conversations[conversation_id] = user
+        return conversation_id
+
+    def continue_conversation(self, conversation_id: str, user: str) -> bool:
+        """既存の会話ならTrue（継続回数を数える）"""
+        with self._lock:
+            known = self._conversations.get(conversation_id) == user
+        self.count('continued' if known else 'unknown_conversations')
+        return known
+
+    def next_latency(self) -> float:
+        self.count('requests')
+        with self._lock:
+            return max(0.0, self.latency + self._random.uniform(-self.jitter, self.jitter))
+
+    def next_error(self):
+        with self._lock:
+            failed = self._random.random() < self.error_rate
+        if not failed:
+            return None
+        self.count('injected_errors')
+        return self.error_mode
+
+    def make_answer(self, query: str) -> str:
+        prefix = f"回答: {query}\n"
+        return prefix + 'あ' * max(0, self.answer_size - len(prefix))
+
+class _SlackHandler(_JsonHandler):
+    def do_POST(self):
+        fake = self.server.fake
+        raw = self._read_body().decode('utf-8')
+        if 'application/json' in self.headers.get('Content-Type', ''):
+            params = json.loads(raw or '{}')
+        else:
+            params = {k: v[0] for k, v in parse_qs(raw).items()}
+        path, _, query = self.path.partition('?')
+        # AsyncWebClientは引数をクエリ文字列で送る場合がある
+        params.update({k: v[0] for k, v in parse_qs(query).items()})
+        method = path.rsplit('/', 1)[-1]
+
+        if fake.latency:
+            time.sleep(fake.latency)
+        if method == 'auth.test':
+            self._send_json(200, {'ok': True, 'user_id': fake.bot_user_id, 'bot_id': 'BBENCH', 'user': 'bench-bot',
+                                  'team': 'bench', 'team_id': 'TBENCH', 'url': 'https://bench.slack.com/'})
+        elif method in ('chat.postMessage', 'chat.update'):
+            retry_after = fake.throttle(params.get('channel'))
+            if retry_after:
+                self._send_json(429, {'ok': False, 'error': 'ratelimited'}, {'Retry-After': str(retry_after)})
+                return
+            ts = fake.record(method, params)
+            self._send_json(200, {'ok': True, 'channel': params.get('channel'), 'ts': ts,
+                                  'message': {'text': params.get('text'), 'ts': ts}})
+        elif method == 'chat.delete':
+            retry_after = fake.throttle(params.get('channel'))
+            if retry_after:
+                self._send_json(429, {'ok': False, 'error': 'ratelimited'}, {'Retry-After': str(retry_after)})
+                return
+            fake.count(method)
+            self._send_json(200, {'ok': True, 'channel': params.get('channel'), 'ts': params.get('ts')})
+        else:
+            self._send_json(200, {'ok': True})
+
+class FakeSlackServer(_FakeServer):
+    """Slack Web API stand-in that records when each thread last received a reply"""
+
+    def __init__(self, bot_user_id: str = 'UBENCHBOT', latency: float = 0.0, rate_limit: float = 0.0):
+        """rate_limit: チャンネルごとの許容投稿数/秒。超えた場合はRetry-After付きの429を返す（0は無制限）"""
+        super().__init__(_SlackHandler)
+        self.bot_user_id = bot_user_id
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self._next_ts = 0
+        self._message_threads = {}  # メッセージts -> スレッドts
+        self._replies = {}  # スレッドts -> (初回投稿時刻, 最終投稿時刻, 最終テキスト)
+        self._next_allowed = {}  # チャンネル -> 次に投稿を受け付ける時刻
+        self.stats = {'chat.postMessage': 0, 'chat.update': 0, 'chat.delete': 0, 'rate_limited': 0}
+
+    def throttle(self, channel: str) -> int:
+        """レート制限を超えていれば再試行までの秒数（Slackと同じく整数）を返す"""
+        if not self.rate_limit:
+            return 0
+        now = time.monotonic()
+        with self._lock:
+            next_allowed = self._next_allowed.get(channel, 0.0)
+            if now < next_allowed:
+                self.stats['rate_limited'] += 1
+                return max(1, int(next_allowed - now + 0.999))
+            self._next_allowed[channel] = now + 1.0 / self.rate_limit
+            return 0
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.port}/api/"
+
+    def count(self, method: str):
+        with self._lock:
+            self.stats[method] += 1
+
+    def record(self, method: str, params: dict) -> str:
+        now = time.perf_counter()
+        with self._lock:
+            self.stats[method] += 1
+            if method == 'chat.update':
+                ts = params.get('ts')
+                thread_ts = self._message_threads.get(ts, ts)
+            else:
+                self._next_ts += 1
+                ts = f"{int(time.time())}.{self._next_ts:06d}"
+                thread_ts = params.get('thread_ts') or ts
+                self._message_threads[ts] = thread_ts
+            first = self._replies.get(thread_ts, (now,))[0]
+            self._replies[thread_ts] = (first, now, params.get('text') or '')
+        return ts
+
+    def reply_for(self, thread_ts: str):
+        """スレッドへの（初回投稿時刻, 最終投稿時刻, 最終テキスト）を返す"""
+        with self._lock:
+            return self._replies.get(thread_ts)
@@ -0,0 +1,35 @@
+"""
+Worker-only bot replica started by `benchmarks.run --replicas N`.
+
+Imports the bot with the environment prepared by the harness, starts the
+mention job queue workers and runs until stdin is closed.
+"""
+import sys
+import asyncio
+
+# ボットのログは標準エラーへ出力し、標準出力は準備完了の通知だけに使う
+_signal = sys.stdout
+sys.stdout = sys.stderr
+
+def run_threaded():
+    import main as bot
+
+    bot.startup()
+    bot.mention_queue.start()
+    print('ready', file=_signal, flush=True)
+    sys.stdin.read()
+    bot.shutdown()
+
+async def run_asyncio():
+    import async_main as bot
+
+    await bot.startup()
+    print('ready', file=_signal, flush=True)
+    await asyncio.get_running_loop().run_in_executor(None, sys.stdin.read)
+    await bot.shutdown()
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'asyncio':
+        asyncio.run(run_asyncio())
+    else:
+        run_threaded()
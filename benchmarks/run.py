@@ -0,0 +1,483 @@
+"""
+Offline load test for the app_mention handler.
+
+Dispatches app_mention events through the real Bolt app (so its listener
+executor and middleware are part of the measurement) with DifyService and
+ConversationService against local Slack/Dify stand-ins and a PostgreSQL
+database, then reports reply latency percentiles, throughput and the
+conversation write rate as JSON.
+
+    python -m benchmarks.run --mentions 500 --rate 50 --concurrency 10 --output result.json
+    python -m benchmarks.run --baseline result.json
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import asyncio
+import argparse
+import importlib
+import tempfile
+import threading
+import subprocess
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+
+import psycopg2
+
+from benchmarks.fakes import FakeDifyServer, FakeSlackServer, ERROR_MODES
+
+# 結果に記録する（ベンチマーク結果に影響する）アプリ側の設定
+RECORDED_SETTINGS = [
+    'DIFY_RESPONSE_MODE', 'DIFY_POOL_SIZE', 'DIFY_MAX_CONCURRENCY', 'DIFY_READ_TIMEOUT',
+    'DIFY_ADAPTIVE_TIMEOUT', 'SCHEDULER_MAX_QUEUE', 'SCHEDULER_MAX_QUEUE_PER_USER',
+    'SCHEDULER_MAX_ACTIVE_PER_USER', 'DB_POOL_MAX_SIZE', 'CONVERSATION_WRITE_BEHIND', 'CONVERSATION_BATCH_SIZE',
+    'CONVERSATION_FLUSH_INTERVAL', 'RESPONSE_CACHE_ENABLED', 'THREAD_CONVERSATION_ENABLED', 'TRACE_SAMPLE_RATE',
+    'LOG_ASYNC', 'LOG_LEVEL', 'SLACK_CHANNEL_RATE', 'SLACK_CHANNEL_BURST', 'SLACK_MESSAGE_MAX_CHARS',
+    'MENTION_QUEUE_ENABLED', 'MENTION_QUEUE_WORKERS',
+]
+
+# ベースライン比較の対象（True = 大きいほど良い）
+COMPARED_METRICS = {
+    'reply_latency.p50': False,
+    'reply_latency.p95': False,
+    'reply_latency.p99': False,
+    'throughput': True,
+    'db_write_rate': True,
+}
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Slack Dify Botのオフライン負荷試験")
+    parser.add_argument('--runtime', choices=('threaded', 'asyncio'), default='threaded')
+    parser.add_argument('--mentions', type=int, default=200, help="送信するメンション数")
+    parser.add_argument('--rate', type=float, default=20.0, help="1秒あたりのメンション数（0で可能な限り速く）")
+    parser.add_argument('--concurrency', type=int, default=10,
+                        help="同時にBoltへ渡すイベント数の上限（Socket Modeの受信ワーカー数に相当）")
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--channels', type=int, default=4)
+    parser.add_argument('--distinct-queries', type=int, default=50, help="質問文の種類数（キャッシュ効果の確認用）")
+    parser.add_argument('--response-mode', choices=('blocking', 'streaming'), default='blocking')
+    parser.add_argument('--dify-latency', type=float, default=0.5)
+    parser.add_argument('--dify-jitter', type=float, default=0.1)
+    parser.add_argument('--dify-error-rate', type=float, default=0.0)
+    parser.add_argument('--dify-error-mode', choices=ERROR_MODES, default='http500')
+    parser.add_argument('--stream-chunks', type=int, default=10)
+    parser.add_argument('--answer-size', type=int, default=400)
+    parser.add_argument('--followup-rate', type=float, default=0.0,
+                        help="同じユーザーの前の質問のスレッド内で続けて質問する割合（Dify会話の継続の確認用）")
+    parser.add_argument('--redelivery-rate', type=float, default=0.0, help="Slackの再送を模して同じイベントを再送する割合")
+    parser.add_argument('--slack-latency', type=float, default=0.0, help="Slack APIスタブの応答遅延秒数")
+    parser.add_argument('--slack-rate-limit', type=float, default=0.0,
+                        help="Slack APIスタブがチャンネルごとに受け付ける投稿数/秒（超過時は429、0は無制限）")
+    parser.add_argument('--replicas', type=int, default=1,
+                        help="ボットのレプリカ数（2以上でジョブキューを有効にし、追加のワーカープロセスを起動）")
+    parser.add_argument('--db-url', default=None, help="省略時はDATABASE_URL、未設定ならpgserverで一時DBを起動")
+    parser.add_argument('--drain-timeout', type=float, default=30.0, help="DB書き込み完了を待つ最大秒数")
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--output', default=None, help="結果JSONの保存先")
+    parser.add_argument('--baseline', default=None, help="比較対象の結果JSON")
+    parser.add_argument('--tolerance', type=float, default=0.10, help="回帰とみなす悪化率")
+    return parser.parse_args(argv)
+
+def percentiles(values: list) -> dict:
+    if not values:
+        return {'p50': None, 'p95': None, 'p99': None, 'mean': None, 'max': None}
+    ordered = sorted(values)
+
+    def pick(q):
+        return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))], 4)
+
+    return {
+        'p50': pick(0.50),
+        'p95': pick(0.95),
+        'p99': pick(0.99),
+        'mean': round(sum(ordered) / len(ordered), 4),
+        'max': round(ordered[-1], 4),
+    }
+
+def resolve_database_url(args):
+    """接続先DBを決める（pgserverはオプションの依存）。戻り値は(URL, 後片付け用オブジェクト)"""
+    url = args.db_url or os.environ.get('DATABASE_URL')
+    if url:
+        return url, None
+    try:
+        import pgserver
+    except ImportError:
+        sys.exit("DATABASE_URL（または --db-url）を指定するか、pgserver をインストールしてください")
+    server = pgserver.get_server(tempfile.mkdtemp(prefix='bench-pg-'), cleanup_mode='delete')
+    return server.get_uri(), server
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))).stdout.strip() or None
+    except OSError:
+        return None
+
+def build_events(args, run_id: str) -> tuple:
+    base_ts = int(time.time())
+    rng = random.Random(args.seed)
+    events = []
+    for i in range(args.mentions):
+        ts = f"{base_ts}.{i:06d}"
+        event = {
+            'type': 'app_mention',
+            'user': f"UB{run_id}{i % args.users}",
+            'channel': f"CBENCH{i % args.channels}",
+            'ts': ts,
+            'text': f"<@UBENCHBOT> ベンチマーク質問 {i % args.distinct_queries}",
+            'event_id': f"EvB{run_id}{i}",
+        }
+        if args.followup_rate and i >= args.users and rng.random() < args.followup_rate:
+            # 同じユーザーの直前の質問のスレッドで続けて質問する
+            parent = events[i - args.users]
+            event['channel'] = parent['channel']
+            event['thread_ts'] = parent.get('thread_ts') or parent['ts']
+        events.append(event)
+
+    # 再送イベントは元のイベントより後の位置に挿入する（レイテンシ集計からは除外）
+    redeliveries = []
+    for i, event in enumerate(list(events)):
+        if rng.random() < args.redelivery_rate:
+            redeliveries.append((rng.randint(i + 1, len(events)), dict(event)))
+    for position, event in sorted(redeliveries, key=lambda r: r[0], reverse=True):
+        events.insert(position, event)
+    return events, {id(event) for _, event in redeliveries}
+
+class WriteRateSampler:
+    """ベンチマーク中の会話ログ行数を定期的に数える"""
+
+    def __init__(self, db_url: str, user_prefix: str, interval: float = 0.1):
+        self.conn = psycopg2.connect(db_url)
+        self.conn.autocommit = True
+        self.user_prefix = user_prefix
+        self.interval = interval
+        self.samples = []  # (経過秒, 行数)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def count(self) -> int:
+        with self.conn.cursor() as cur:
+            try:
+                cur.execute("SELECT COUNT(*) FROM conversations WHERE user_id LIKE %s", (self.user_prefix + '%',))
+            except psycopg2.errors.UndefinedTable:
+                # asyncioモードではテーブル作成がサービス開始時に行われる
+                return 0
+            return cur.fetchone()[0]
+
+    def start(self, t0: float):
+        self.t0 = t0
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.samples.append((time.perf_counter() - self.t0, self.count()))
+            self._stop.wait(self.interval)
+
+    def wait_for(self, expected: int, timeout: float) -> int:
+        deadline = time.perf_counter() + timeout
+        while time.perf_counter() < deadline:
+            if self.samples and self.samples[-1][1] >= expected:
+                break
+            time.sleep(self.interval)
+        self._stop.set()
+        self._thread.join()
+        rows = self.count()
+        self.samples.append((time.perf_counter() - self.t0, rows))
+        self.conn.close()
+        return rows
+
+    def write_rate(self) -> float:
+        """最終行数に達した時点までの平均書き込み件数/秒"""
+        if not self.samples or not self.samples[-1][1]:
+            return 0.0
+        final = self.samples[-1][1]
+        reached = next(t for t, n in self.samples if n >= final)
+        return final / reached if reached else 0.0
+
+def start_replicas(args) -> list:
+    """ジョブキューのワーカーのみを動かすレプリカを起動し、準備完了を待つ"""
+    replicas = []
+    for _ in range(args.replicas - 1):
+        process = subprocess.Popen([sys.executable, '-m', 'benchmarks.replica', args.runtime],
+                                   stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True,
+                                   cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        replicas.append(process)
+    for process in replicas:
+        if process.stdout.readline().strip() != 'ready':
+            stop_replicas(replicas)
+            sys.exit("レプリカの起動に失敗しました")
+    return replicas
+
+def stop_replicas(replicas: list):
+    for process in replicas:
+        process.stdin.close()
+    for process in replicas:
+        try:
+            process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+def wait_for_jobs(db_url: str, timeout: float):
+    """ジョブキューの未処理・処理中のジョブがなくなるまで待つ"""
+    conn = psycopg2.connect(db_url)
+    conn.autocommit = True
+    deadline = time.perf_counter() + timeout
+    try:
+        with conn.cursor() as cur:
+            while time.perf_counter() < deadline:
+                cur.execute("SELECT COUNT(*) FROM mention_jobs WHERE status IN ('pending', 'running')")
+                if not cur.fetchone()[0]:
+                    return
+                time.sleep(0.05)
+    finally:
+        conn.close()
+
+def event_body(event: dict) -> dict:
+    """Events APIのペイロード形式に包む"""
+    return {
+        'type': 'event_callback',
+        'team_id': 'TBENCH',
+        'api_app_id': 'ABENCH',
+        'event_id': event['event_id'],
+        'event_time': int(float(event['ts'])),
+        'event': event,
+    }
+
+def dispatch_error(response) -> str:
+    """Boltの応答（ack）が正常でなければエラー内容を返す"""
+    if response.status != 200:
+        return f"HTTP {response.status}: {response.body}"
+    return None
+
+def run_threaded(args, events: list, outcomes: list):
+    import main as bot
+    from slack_bolt.request import BoltRequest
+
+    if bot.mention_queue:
+        bot.mention_queue.start()
+
+    def handle(event: dict, scheduled: float):
+        # Socket Modeと同じくBoltにディスパッチする（ackを返した後、リスナーはBoltのスレッドプールで実行される）
+        error = None
+        try:
+            error = dispatch_error(bot.app.dispatch(BoltRequest(body=event_body(event), mode='socket_mode')))
+        except Exception as e:
+            error = repr(e)
+        outcomes.append((event, scheduled, time.perf_counter(), error))
+
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        for i, event in enumerate(events):
+            # 予定時刻から計測し、処理待ちで送信が遅れた分もレイテンシに含める
+            scheduled = t0 + (i / args.rate if args.rate > 0 else 0.0)
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            executor.submit(handle, event, scheduled)
+    if bot.mention_queue:
+        wait_for_jobs(os.environ['DATABASE_URL'], args.drain_timeout)
+    return t0, lambda: collect_stats(bot, sync=True)
+
+def run_asyncio(args, events: list, outcomes: list):
+    import async_main as bot
+    from slack_bolt.request.async_request import AsyncBoltRequest
+
+    async def run():
+        await bot.startup()
+        semaphore = asyncio.Semaphore(args.concurrency)
+
+        async def handle(event: dict, scheduled: float):
+            async with semaphore:
+                error = None
+                try:
+                    response = await bot.app.async_dispatch(AsyncBoltRequest(body=event_body(event), mode='socket_mode'))
+                    error = dispatch_error(response)
+                except Exception as e:
+                    error = repr(e)
+            outcomes.append((event, scheduled, time.perf_counter(), error))
+
+        t0 = time.perf_counter()
+        tasks = []
+        for i, event in enumerate(events):
+            scheduled = t0 + (i / args.rate if args.rate > 0 else 0.0)
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.create_task(handle(event, scheduled)))
+        await asyncio.gather(*tasks)
+        if bot.mention_queue:
+            await asyncio.get_running_loop().run_in_executor(None, wait_for_jobs, os.environ['DATABASE_URL'],
+                                                             args.drain_timeout)
+        stats = collect_stats(bot, sync=False)
+        await bot.shutdown()
+        return t0, lambda: stats
+
+    return asyncio.run(run())
+
+def collect_stats(bot, sync: bool) -> dict:
+    """各サービスが公開している統計情報をまとめる"""
+    stats = {}
+    sources = {
+        'dify_pool': ('dify_service', 'get_pool_stats'),
+        'dify_breaker': ('dify_service', 'breaker'),
+        'db_pool': ('conversation_service', 'get_pool_stats'),
+        'conversation_writer': ('conversation_service', 'get_writer_stats'),
+        'scheduler': ('scheduler', 'get_stats'),
+        'response_cache': ('response_cache', 'get_stats'),
+        'event_dedup': ('event_deduplicator', 'get_stats'),
+        'slack_sender': ('slack_sender', 'get_stats'),
+        'mention_queue': ('mention_queue', 'get_stats'),
+        'thread_conversations': ('conversation_service', 'get_conversation_map_stats'),
+    }
+    for key, (service_name, attr) in sources.items():
+        service = getattr(bot, service_name, None)
+        target = getattr(service, attr, None) if service is not None else None
+        if attr == 'breaker' and target is not None:
+            target = target.get_stats
+        if callable(target) and (sync or not asyncio.iscoroutinefunction(target)):
+            try:
+                stats[key] = target()
+            except Exception as e:
+                stats[key] = {'error': repr(e)}
+    return stats
+
+def summarize(outcomes: list, redelivered: set, slack: FakeSlackServer, dify: FakeDifyServer, t0: float) -> dict:
+    reply_latencies, ack_latencies = [], []
+    failed = error_replies = missing_replies = followups = 0
+    last_done = t0
+    for event, scheduled, acked, error in outcomes:
+        last_done = max(last_done, acked)
+        if id(event) in redelivered:
+            continue
+        ack_latencies.append(acked - scheduled)
+        if error:
+            failed += 1
+        if event.get('thread_ts'):
+            # スレッド内の質問は前の質問と同じスレッドに返信されるため、返信レイテンシの集計から除外する
+            followups += 1
+            continue
+        reply = slack.reply_for(event['ts'])
+        if reply is None:
+            missing_replies += 1
+            continue
+        reply_latencies.append(reply[1] - scheduled)
+        # Boltはリスナーの完了を待たずにackを返すため、返信の投稿までを処理時間に含める
+        last_done = max(last_done, reply[1])
+        if reply[2].startswith('申し訳') or 'エラー' in reply[2]:
+            error_replies += 1
+
+    duration = last_done - t0
+    return {
+        'mentions': len(outcomes),
+        'redeliveries': len(redelivered),
+        'followups': followups,
+        'failed': failed,
+        'error_replies': error_replies,
+        'missing_replies': missing_replies,
+        'duration': round(duration, 3),
+        'throughput': round(len(outcomes) / duration, 3) if duration else None,
+        'reply_latency': percentiles(reply_latencies),
+        'ack_latency': percentiles(ack_latencies),
+        'slack_calls': dict(slack.stats),
+        'dify': dict(dify.stats),
+    }
+
+def compare(result: dict, baseline: dict, tolerance: float) -> list:
+    """ベースラインから悪化した指標を返す"""
+    regressions = []
+    for path, higher_is_better in COMPARED_METRICS.items():
+        current, previous = result['results'], baseline['results']
+        for key in path.split('.'):
+            current, previous = current.get(key), previous.get(key)
+        if not current or not previous:
+            continue
+        change = (current - previous) / previous
+        worse = -change if higher_is_better else change
+        status = 'REGRESSION' if worse > tolerance else 'ok'
+        print(f"{path:22} {previous:>10.4f} -> {current:>10.4f} ({change:+.1%}) {status}", file=sys.stderr)
+        if worse > tolerance:
+            regressions.append(path)
+    return regressions
+
+def main(argv=None):
+    args = parse_args(argv)
+    run_id = uuid.uuid4().hex[:8]
+
+    dify = FakeDifyServer(latency=args.dify_latency, jitter=args.dify_jitter, error_rate=args.dify_error_rate,
+                          error_mode=args.dify_error_mode, stream_chunks=args.stream_chunks,
+                          answer_size=args.answer_size, seed=args.seed).start()
+    slack = FakeSlackServer(latency=args.slack_latency, rate_limit=args.slack_rate_limit).start()
+    db_url, pg_server = resolve_database_url(args)
+
+    # アプリのimport前に接続先をスタブへ向ける（.envより優先）
+    os.environ.update({
+        'SLACK_BOT_TOKEN': 'xoxb-bench',
+        'SLACK_APP_TOKEN': 'xapp-bench',
+        'SLACK_API_URL': slack.base_url,
+        'DIFY_API_KEY': 'bench',
+        'DIFY_API_URL': dify.base_url,
+        'DATABASE_URL': db_url,
+        'DIFY_RESPONSE_MODE': args.response_mode,
+    })
+    if args.replicas > 1:
+        os.environ['MENTION_QUEUE_ENABLED'] = 'true'
+    # 送信側のチャンネル別レートはスタブの制限に合わせる（制限なしの場合はボット自体の性能を測るため実質無制限）
+    os.environ.setdefault('SLACK_CHANNEL_RATE', str(args.slack_rate_limit or 1000))
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+    os.environ.setdefault('LOG_FILE', '')
+
+    outcomes = []
+    events, redelivered = build_events(args, run_id)
+    runner = run_asyncio if args.runtime == 'asyncio' else run_threaded
+    replicas = []
+    try:
+        # サービス初期化（スキーマ作成・接続の暖機など）は計測前に済ませる
+        bot = importlib.import_module('main' if args.runtime == 'threaded' else 'async_main')
+        if args.runtime == 'threaded':
+            bot.startup()
+        replicas = start_replicas(args)
+        sampler = WriteRateSampler(db_url, f"UB{run_id}")
+        sampler.start(time.perf_counter())
+        t0, get_service_stats = runner(args, events, outcomes)
+        db_rows = sampler.wait_for(len(outcomes) - len(redelivered), args.drain_timeout)
+        service_stats = get_service_stats()
+
+        results = summarize(outcomes, redelivered, slack, dify, t0)
+        results['db_rows'] = db_rows
+        results['db_write_rate'] = round(sampler.write_rate(), 3)
+    finally:
+        stop_replicas(replicas)
+        if args.runtime == 'threaded' and 'main' in sys.modules:
+            sys.modules['main'].shutdown()
+        dify.stop()
+        slack.stop()
+        if pg_server is not None:
+            pg_server.cleanup()
+
+    result = {
+        'run_id': run_id,
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'git_revision': git_revision(),
+        'config': {**vars(args), 'settings': {k: os.environ.get(k) for k in RECORDED_SETTINGS}},
+        'results': results,
+        'service_stats': service_stats,
+    }
+    output = json.dumps(result, ensure_ascii=False, indent=2, default=str)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output + '\n')
+    print(output)
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            regressions = compare(result, json.load(f), args.tolerance)
+        if regressions:
+            print(f"ベースラインから悪化しました: {', '.join(regressions)}", file=sys.stderr)
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,13 +1,31 @@
 import os
+import sys
+import signal
+import threading
 import time
-import requests
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 from slack_bolt import App
 from slack_bolt.adapter.socket_mode import SocketModeHandler
+from slack_sdk import WebClient
 from services.dify_service import DifyService
 from services.conversation_service import ConversationService
-from utils.logger import setup_logger
-from services.errors import DifyAPIError, DifyTimeoutError, DifyConnectionError, DifyResponseError
+from services.response_cache import ResponseCache, PostgresCacheBackend, CacheInvalidationBus
+from services.scheduler import FairScheduler
+from services.event_dedup import EventDeduplicator, PostgresDedupBackend, event_keys
+from services.mention_queue import MentionQueue
+from services.partitioning import PartitionManager
+from services.slack_sender import SlackSender, ThreadReply
+from utils.logger import setup_logger, shutdown_logger, LazyJson
+from utils.config import load_slack_credentials, load_message_max_chars
+from utils.formatters import format_stats_message
+from utils.tracing import Trace
+from utils.metrics import (MENTIONS, ERRORS, REPLY_LATENCY, SCHEDULER_ACTIVE, SCHEDULER_QUEUE_DEPTH,
+                           DB_POOL_IN_USE, WRITER_QUEUE_DEPTH)
+from utils.health_server import start_health_server, set_ready, add_readiness_check
+from utils.lifecycle import StartupTimer, InFlightTracker
+from services.errors import (DifyAPIError, DifyTimeoutError, DifyConnectionError, DifyResponseError,
+                            DifyConversationNotFoundError, SchedulerBusyError)
 
 # Load environment variables from .env file
 load_dotenv()
@@ -15,86 +33,149 @@ load_dotenv()
 # Setup logging
 logger = setup_logger()
 
-def validate_token_format(token: str, token_type: str) -> bool:
-    """トークンの形式を検証する"""
-    if token_type == "bot" and not token.startswith("xoxb-"):
-        logger.error(f"SLACK_BOT_TOKENの形式が正しくありません（'xoxb-'で始まる必要があります）")
-        return False
-    elif token_type == "app" and not token.startswith("xapp-"):
-        logger.error(f"SLACK_APP_TOKENの形式が正しくありません（'xapp-'で始まる必要があります）")
-        return False
-    return True
-
-def get_required_env_var(var_name: str, token_type: str = None) -> str:
-    """環境変数を取得し、必要に応じてトークンの形式を検証する"""
-    value = os.environ.get(var_name)
-    if not value:
-        logger.error(f"環境変数 {var_name} が設定されていません")
-        raise ValueError(f"環境変数 {var_name} が設定されていません")
-
-    if token_type and not validate_token_format(value, token_type):
-        raise ValueError(
-            f"{var_name}の形式が正しくありません。\n"
-            f"{'Bot User OAuth Token' if token_type == 'bot' else 'App-Level Token'}を"
-            f"Slack API設定画面から取得してください。"
-        )
-    return value
+# asyncioモードでは非同期版のエントリポイントに処理を委譲する
+BOT_RUNTIME = os.environ.get("BOT_RUNTIME", "threaded")
+if __name__ == "__main__" and BOT_RUNTIME == "asyncio":
+    import asyncio
+    from async_main import main as async_main
+    asyncio.run(async_main())
+    sys.exit(0)
 
 # Initialize required environment variables
-try:
-    SLACK_BOT_TOKEN = get_required_env_var("SLACK_BOT_TOKEN", "bot")
-    SLACK_APP_TOKEN = get_required_env_var("SLACK_APP_TOKEN", "app")
-    DIFY_API_KEY = get_required_env_var("DIFY_API_KEY")
-except ValueError as e:
-    logger.error(f"環境変数エラー: {str(e)}")
-    logger.error("Slackアプリの設定を確認してください:")
-    logger.error("1. SLACK_BOT_TOKEN: Bot User OAuth Token（api.slack.com/apps > OAuth & Permissions）")
-    logger.error("2. SLACK_APP_TOKEN: App-Level Token（api.slack.com/apps > Basic Information）")
-    logger.error("3. Socket Mode: 有効化（api.slack.com/apps > Socket Mode）")
-    raise
+SLACK_BOT_TOKEN, SLACK_APP_TOKEN, DIFY_API_KEY = load_slack_credentials()
+
+# Response mode settings
+DIFY_RESPONSE_MODE = os.environ.get("DIFY_RESPONSE_MODE", "blocking")
+SLACK_UPDATE_INTERVAL = float(os.environ.get("SLACK_UPDATE_INTERVAL", "1.0"))
+STREAMING_PLACEHOLDER = "考え中です..."
+
+# Slack Web APIの接続先（プロキシやベンチマーク用のスタブを使う場合に変更）
+SLACK_API_URL = os.environ.get("SLACK_API_URL")
+
+# initialize_slackで解決したBot User ID（イベントごとのauth.testを避けるためキャッシュ）
+BOT_USER_ID = None
+
+# 起動時にDify APIへ事前に確立しておく接続数と、終了時に処理中のメンションの完了を待つ最大秒数
+DIFY_WARM_CONNECTIONS = int(os.environ.get("DIFY_WARM_CONNECTIONS", "2"))
+SHUTDOWN_DRAIN_TIMEOUT = float(os.environ.get("SHUTDOWN_DRAIN_TIMEOUT", "25"))
+
+# スレッド内の質問でDifyの会話を継続するか
+THREAD_CONVERSATION_ENABLED = os.environ.get("THREAD_CONVERSATION_ENABLED", "true").lower() == "true"
+
+# Response cache settings
+CACHE_ADMIN_USERS = {u.strip() for u in os.environ.get("CACHE_ADMIN_USERS", "").split(",") if u.strip()}
+
+def create_response_cache(pool):
+    """RESPONSE_CACHE_ENABLED=true の場合に応答キャッシュを作成する"""
+    if os.environ.get("RESPONSE_CACHE_ENABLED", "false").lower() != "true":
+        return None
+    backend = PostgresCacheBackend(pool) if os.environ.get("RESPONSE_CACHE_BACKEND", "memory") == "postgres" else None
+    cache = ResponseCache(
+        max_entries=int(os.environ.get("RESPONSE_CACHE_MAX_ENTRIES", "1000")),
+        ttl=float(os.environ.get("RESPONSE_CACHE_TTL", "3600")),
+        scope=os.environ.get("RESPONSE_CACHE_SCOPE", "global"),
+        backend=backend,
+        # /cache clear をプロセス内のキャッシュを持つすべてのレプリカに伝える
+        bus=CacheInvalidationBus(pool)
+    )
+    logger.info(f"応答キャッシュを有効化しました - スコープ: {cache.scope}, TTL: {cache.ttl}秒")
+    return cache
+
+def create_event_deduplicator(pool):
+    """EVENT_DEDUP_ENABLED=true（デフォルト）の場合にSlackの再送イベントを破棄する仕組みを作成する"""
+    if os.environ.get("EVENT_DEDUP_ENABLED", "true").lower() != "true":
+        return None
+    backend = PostgresDedupBackend(pool) if os.environ.get("EVENT_DEDUP_BACKEND", "memory") == "postgres" else None
+    return EventDeduplicator(
+        ttl=float(os.environ.get("EVENT_DEDUP_TTL", "600")),
+        max_entries=int(os.environ.get("EVENT_DEDUP_MAX_ENTRIES", "10000")),
+        backend=backend
+    )
+
+def create_partition_manager(pool):
+    """CONVERSATION_PARTITIONING=true の場合に会話ログの月次パーティションを管理する仕組みを作成する"""
+    if os.environ.get("CONVERSATION_PARTITIONING", "false").lower() != "true":
+        return None
+    manager = PartitionManager(
+        pool,
+        retention_months=int(os.environ.get("CONVERSATION_RETENTION_MONTHS", "0")),
+        premake_months=int(os.environ.get("CONVERSATION_PARTITION_PREMAKE", "2")),
+        archive_dir=os.environ.get("CONVERSATION_ARCHIVE_DIR", "conversation_archive"),
+        interval=float(os.environ.get("CONVERSATION_PARTITION_INTERVAL", "3600"))
+    )
+    return manager
+
+def create_mention_queue(pool):
+    """MENTION_QUEUE_ENABLED=true の場合に複数レプリカでメンションの処理を分担するジョブキューを作成する"""
+    if os.environ.get("MENTION_QUEUE_ENABLED", "false").lower() != "true":
+        return None
+    return MentionQueue(
+        pool,
+        lambda payload, owns: process_mention(payload['event'], payload.get('event_id'), still_owned=owns),
+        workers=int(os.environ.get("MENTION_QUEUE_WORKERS", os.environ.get("DIFY_MAX_CONCURRENCY", "8"))),
+        lease=float(os.environ.get("MENTION_QUEUE_LEASE", "60")),
+        poll_interval=float(os.environ.get("MENTION_QUEUE_POLL_INTERVAL", "5")),
+        replica_id=os.environ.get("REPLICA_ID") or None
+    )
+
+def create_slack_sender(client):
+    """チャンネルごとのレート制限と長文の分割を行う送信処理を作成する"""
+    return SlackSender(
+        client,
+        rate=float(os.environ.get("SLACK_CHANNEL_RATE", "1.0")),
+        burst=int(os.environ.get("SLACK_CHANNEL_BURST", "3")),
+        max_retries=int(os.environ.get("SLACK_MAX_RETRIES", "3")),
+        max_chars=load_message_max_chars()
+    )
 
 # Initialize services
 try:
-    app = App(token=SLACK_BOT_TOKEN)
+    scheduler = FairScheduler(
+        max_concurrency=int(os.environ.get("DIFY_MAX_CONCURRENCY", "8")),
+        max_queue_depth=int(os.environ.get("SCHEDULER_MAX_QUEUE", "16")),
+        max_queue_per_user=int(os.environ.get("SCHEDULER_MAX_QUEUE_PER_USER", "2")),
+        max_wait=float(os.environ.get("SCHEDULER_MAX_WAIT", "15")),
+        max_active_per_user=int(os.environ.get("SCHEDULER_MAX_ACTIVE_PER_USER", "2"))
+    )
+    # Boltのリスナーを実行するスレッド数は実行枠と待ち行列の合計にする
+    # （既定の5スレッドでは実行枠より先にBolt内部のキューで待たされ、待ち行列の上限や待ち時間の上限が効かない）
+    listener_executor = ThreadPoolExecutor(max_workers=scheduler.max_concurrency + scheduler.max_queue_depth,
+                                           thread_name_prefix="bolt-listener")
+    if SLACK_API_URL:
+        app = App(client=WebClient(token=SLACK_BOT_TOKEN, base_url=SLACK_API_URL), listener_executor=listener_executor)
+    else:
+        app = App(token=SLACK_BOT_TOKEN, listener_executor=listener_executor)
+    slack_sender = create_slack_sender(app.client)
     dify_service = DifyService(api_key=DIFY_API_KEY)
     conversation_service = ConversationService()
+    response_cache = create_response_cache(conversation_service.pool)
+    event_deduplicator = create_event_deduplicator(conversation_service.pool)
+    partition_manager = create_partition_manager(conversation_service.pool)
+    mention_queue = create_mention_queue(conversation_service.pool)
+    # 終了時に完了を待つ、このプロセスで処理中のメンション（ジョブキュー経由の処理はキュー側で待つ）
+    inflight = InFlightTracker()
     logger.info("Slackアプリの初期化が完了しました")
 except Exception as e:
     logger.error(f"Slackアプリの初期化エラー: {str(e)}")
     raise
 
-def format_stats_message(stats: dict) -> str:
-    """統計情報をSlackメッセージ形式に整形"""
-    message = []
-    message.append("*使用統計情報*\n")
-    message.append(f"• 総会話数: {stats['total_conversations']}")
-    message.append(f"• 平均応答時間: {stats['avg_response_time']:.2f}秒")
-    message.append(f"• エラー率: {stats['error_rate']:.1f}%")
-
-    if 'recent_conversations' in stats:
-        message.append("\n*最近の会話*")
-        for conv in stats['recent_conversations'][:3]:  # 最新3件のみ表示
-            message.append(f"• {conv['created_at'].strftime('%Y-%m-%d %H:%M')} - {conv['message'][:50]}...")
-
-    if 'total_users' in stats:
-        message.append(f"\n• 総ユーザー数: {stats['total_users']}")
-
-    return "\n".join(message)
-
 @app.command("/stats")
-def handle_stats_command(ack, command, say):
+def handle_stats_command(ack, command, say, body):
     """統計情報表示コマンドの処理"""
     ack()
     logger.info(f"統計情報コマンド実行 - ユーザー: {command['user_id']}")
+    trace = Trace("stats", trace_id=body.get('trigger_id'))
 
     try:
         if command.get('text') == 'all':
             # 全体の統計情報を取得（管理者用）
-            stats = conversation_service.get_total_stats()
-            say(format_stats_message(stats))
+            with trace.span("db_stats"):
+                stats = conversation_service.get_total_stats()
         else:
             # ユーザー個別の統計情報を取得
-            stats = conversation_service.get_user_stats(command['user_id'])
+            with trace.span("db_stats"):
+                stats = conversation_service.get_user_stats(command['user_id'])
+        with trace.span("slack_post"):
             say(format_stats_message(stats))
 
     except Exception as e:
@@ -102,72 +183,299 @@ def handle_stats_command(ack, command, say):
         logger.error(f"統計情報取得エラー: {str(e)}")
         say(error_message)
 
+    finally:
+        trace.finish()
+
+@app.command("/cache")
+def handle_cache_command(ack, command, respond):
+    """応答キャッシュの管理コマンド（stats / clear [質問]）"""
+    ack()
+    if not response_cache:
+        respond("応答キャッシュは無効です。")
+        return
+    if command['user_id'] not in CACHE_ADMIN_USERS:
+        respond("このコマンドを実行する権限がありません。")
+        return
+
+    action, _, query = (command.get('text') or '').strip().partition(' ')
+    if action == 'clear':
+        count = response_cache.invalidate(query.strip() or None)
+        logger.info(f"応答キャッシュ無効化 - ユーザー: {command['user_id']}, 件数: {count}")
+        respond(f"応答キャッシュを無効化しました（{count}件）。")
+    else:
+        stats = response_cache.get_stats()
+        respond(
+            f"*応答キャッシュ*\n"
+            f"• 件数: {stats['entries']}\n"
+            f"• ヒット率: {stats['hit_rate'] * 100:.1f}%"
+            f"（ヒット {stats['hits'] + stats['backend_hits']} / ミス {stats['misses']} / 集約 {stats['coalesced']}）"
+        )
+
+def stream_reply(query: str, user: str, conversation_id: str, thread_reply: ThreadReply, start_time: float,
+                 on_conversation=None):
+    """Dify APIのストリーミング応答を受信しながらSlackメッセージを途中経過で更新する（最終結果の送信は呼び出し側で行う）"""
+    answer = ""
+    first_token_time = None
+    last_update = 0.0
+
+    for chunk in dify_service.stream_response(query, user, conversation_id, on_conversation):
+        if first_token_time is None:
+            first_token_time = time.time() - start_time
+        answer += chunk
+
+        # Slackのレート制限を超えないよう一定間隔でのみ更新
+        now = time.time()
+        if now - last_update >= SLACK_UPDATE_INTERVAL:
+            # 途中経過の更新はチャンネルの送信枠が空いている場合のみ（待たずにストリームの受信を続ける）
+            thread_reply.send(answer, block=False)
+            last_update = now
+
+    if not answer:
+        raise DifyResponseError()
+    return answer, first_token_time
+
 @app.event("app_mention")
-def handle_app_mention(event, say):
+def handle_app_mention(event, say, body):
     """Handle mentions to the bot and respond with Dify API responses"""
-    logger.info("メンションイベント受信: %s", event)
-
     if not event or 'text' not in event:
         logger.warning("メッセージの内容を取得できませんでした: %s", event)
         say("申し訳ありません。メッセージを処理できませんでした。")
         return
 
+    logger.info("メンションイベント受信 - ユーザー: %s, チャンネル: %s, ts: %s",
+                event.get('user'), event.get('channel'), event.get('ts'))
+    logger.debug("イベント詳細: %s", LazyJson(event))
+
+    # Slackの再送（同一イベントID・同一メッセージ）はDify呼び出し前に破棄する
+    if event_deduplicator and not event_deduplicator.claim(body.get('event_id'), event.get('channel'), event.get('ts')):
+        return
+
+    keys = event_keys(body.get('event_id'), event.get('channel'), event.get('ts'))
+    if mention_queue and keys:
+        # ジョブキューに登録し、いずれかのレプリカのワーカーが1回だけ処理する
+        try:
+            mention_queue.enqueue(keys[-1], {'event': event, 'event_id': body.get('event_id')})
+            return
+        except Exception as e:
+            logger.warning(f"ジョブキューへの登録に失敗したため、このプロセスで処理します: {str(e)}")
+    with inflight.track():
+        process_mention(event, body.get('event_id'))
+
+def process_mention(event: dict, event_id: str = None, still_owned=None):
+    """
+    メンションに対してDify APIの応答をスレッドに返信する
+    still_owned: ジョブキュー経由の場合に、ジョブをまだ保持しているかを返す関数（他のレプリカに引き継がれていれば返信しない）
+    """
+    MENTIONS.inc()
+    trace = Trace("app_mention", trace_id=event_id)
+
+    def owned() -> bool:
+        """返信の直前に、このプロセスが返信してよいかを確認する"""
+        return still_owned is None or still_owned()
+
+    def reply(text: str):
+        """プレースホルダーがあれば更新し、なければスレッドに投稿する"""
+        if not owned():
+            return
+        with trace.span("slack_post"):
+            thread_reply.send(text)
+        REPLY_LATENCY.observe(trace.elapsed())
+
+    def save(response: str, error_occurred: bool = False, first_token_time: float = None):
+        """会話を保存（トレースがサンプリング対象なら区間情報も保存）"""
+        response_time = time.time() - start_time
+        # 応答は投稿済みのため、保存に失敗してもユーザーへエラーメッセージを重ねて送らない
+        try:
+            with trace.span("db_save"):
+                conversation_service.save_conversation(
+                    user, query, response, response_time, error_occurred=error_occurred,
+                    first_token_time=first_token_time, trace=trace.to_dict() if trace.sampled else None
+                )
+        except Exception as e:
+            ERRORS.labels('db_save').inc()
+            logger.warning(f"応答の投稿後に会話の保存に失敗しました: {str(e)}")
+
+    def captured(new_conversation_id: str):
+        """Difyの応答に含まれる会話IDを記録する"""
+        nonlocal dify_conversation_id
+        dify_conversation_id = new_conversation_id
+
+    def with_conversation(call):
+        """スレッドのDify会話を継続して呼び出す（Dify側で会話が見つからなければ新しい会話としてやり直す）"""
+        nonlocal conversation_id
+        try:
+            return call(conversation_id)
+        except DifyConversationNotFoundError:
+            try:
+                conversation_service.forget_dify_conversation(event['channel'], thread_ts, user)
+            except Exception as e:
+                logger.warning(f"スレッドとDify会話の対応の削除に失敗しました: {str(e)}")
+            conversation_id = None
+            return call(None)
+
+    def remember_conversation():
+        """新しく払い出されたDifyの会話IDをスレッドに対応付ける（以降のスレッド内の質問で会話を継続する）"""
+        if not THREAD_CONVERSATION_ENABLED or lookup_failed or not dify_conversation_id \
+                or dify_conversation_id == conversation_id:
+            return
+        try:
+            with trace.span("db_thread_map"):
+                conversation_service.save_dify_conversation(event['channel'], thread_ts, user, dify_conversation_id)
+        except Exception as e:
+            logger.warning(f"スレッドとDify会話の対応の保存に失敗しました: {str(e)}")
+
+    def call_dify() -> str:
+        """実行枠を確保してからDify APIを呼び出す"""
+        with trace.span("queue_wait"):
+            scheduler.acquire(user, event.get('channel'))
+        try:
+            return with_conversation(lambda cid: dify_service.get_response(query, user, cid, on_conversation=captured))
+        finally:
+            scheduler.release(user)
+
     try:
-        bot_user_id = app.client.auth_test()["user_id"]
+        with trace.span("bot_identity"):
+            bot_user_id = get_bot_user_id()
         query = event['text'].replace(f"<@{bot_user_id}>", "").strip()
         user = event['user']
-        conversation_id = event.get('thread_ts') or event.get('ts')
+        thread_ts = event.get('thread_ts') or event.get('ts')
+        thread_reply = ThreadReply(slack_sender, event['channel'], thread_ts)
+        trace.set("user", user)
+        trace.set("channel", event.get('channel'))
+
+        # スレッド内の質問は、スレッドに対応付けたDifyの会話を継続する
+        conversation_id = dify_conversation_id = None
+        lookup_failed = False
+        if THREAD_CONVERSATION_ENABLED and event.get('thread_ts'):
+            try:
+                with trace.span("db_thread_map"):
+                    conversation_id = conversation_service.get_dify_conversation(event['channel'], thread_ts, user)
+            except Exception as e:
+                # 対応を確認できない場合は新しい会話として応答し、既存の対応は上書きしない
+                lookup_failed = True
+                logger.warning(f"スレッドとDify会話の対応の取得に失敗しました: {str(e)}")
 
         # 応答時間の計測開始
         start_time = time.time()
 
-        try:
-            # Dify APIからの応答を取得
-            response = dify_service.get_response(query, user, conversation_id)
-
-            # 応答時間の計算（秒単位）
-            response_time = time.time() - start_time
-
-            # 会話を保存
-            conversation_service.save_conversation(user, query, response, response_time)
+        # スレッド外の質問は応答キャッシュの対象
+        cache_key = query_hash = None
+        if response_cache and not event.get('thread_ts'):
+            cache_key, query_hash = response_cache.make_key(query, user, event.get('channel'))
 
-            # スレッド内で応答
-            say(text=response, thread_ts=conversation_id)
-
-        except DifyTimeoutError:
+        try:
+            cached = None
+            if cache_key and DIFY_RESPONSE_MODE == "streaming":
+                with trace.span("cache"):
+                    cached = response_cache.get(cache_key)
+
+            if DIFY_RESPONSE_MODE == "streaming" and cached is None:
+                # プレースホルダーを投稿し、トークン受信に合わせて更新
+                # （Slackへの送信待ちで実行枠を占有しないよう、投稿と最終結果の送信は実行枠の外で行う）
+                with trace.span("slack_placeholder"):
+                    thread_reply.send(STREAMING_PLACEHOLDER)
+                with trace.span("queue_wait"):
+                    scheduler.acquire(user, event.get('channel'))
+                try:
+                    with trace.span("dify_stream"):
+                        response, first_token_time = with_conversation(
+                            lambda cid: stream_reply(query, user, cid, thread_reply, start_time, captured))
+                finally:
+                    scheduler.release(user)
+                if not owned():
+                    return
+                with trace.span("slack_post"):
+                    thread_reply.send(response)
+                REPLY_LATENCY.observe(trace.elapsed())
+                trace.set("first_token_time", round(first_token_time, 4))
+                logger.info(f"ストリーミング応答完了 - 初回トークン: {first_token_time:.2f}秒, 合計: {time.time() - start_time:.2f}秒")
+                if cache_key:
+                    response_cache.set(cache_key, query_hash, response)
+                remember_conversation()
+                save(response, first_token_time=first_token_time)
+            else:
+                if cached is not None:
+                    response = cached
+                elif cache_key:
+                    # キャッシュ経由で取得（同一質問の同時ミスは1回のDify呼び出しにまとめる）
+                    with trace.span("dify"):
+                        response = response_cache.get_or_compute(cache_key, query_hash, call_dify)
+                else:
+                    # Dify APIからの応答を取得
+                    with trace.span("dify"):
+                        response = call_dify()
+
+                # スレッド内で応答（長い応答は複数のメッセージに分割）
+                if not owned():
+                    return
+                with trace.span("slack_post"):
+                    thread_reply.send(response)
+                REPLY_LATENCY.observe(trace.elapsed())
+
+                # 会話を保存（投稿後に行い、DBの待ち時間を応答に含めない）
+                # キャッシュやまとめた呼び出しで返した応答はDifyの会話を作らないため、スレッドへの対応付けは行われない
+                remember_conversation()
+                save(response)
+
+        except SchedulerBusyError as e:
+            error_message = "申し訳ありません。現在混雑しています。しばらく待ってから再度お試しください。"
+            logger.warning(f"負荷制限により応答を見送りました: {e.reason}")
+            ERRORS.labels(type(e).__name__).inc()
+            reply(error_message)
+            save(error_message, error_occurred=True)
+
+        except DifyTimeoutError as e:
             error_message = "申し訳ありません。応答がタイムアウトしました。しばらく待ってから再度お試しください。"
             logger.error("Dify APIタイムアウト")
-            say(text=error_message, thread_ts=conversation_id)
-            conversation_service.save_conversation(user, query, error_message, time.time() - start_time, error_occurred=True)
+            ERRORS.labels(type(e).__name__).inc()
+            reply(error_message)
+            save(error_message, error_occurred=True)
 
         except DifyConnectionError as e:
             error_message = "申し訳ありません。APIサーバーとの接続に問題が発生しました。"
             logger.error(f"Dify API接続エラー: {str(e.original_error)}")
-            say(text=error_message, thread_ts=conversation_id)
-            conversation_service.save_conversation(user, query, error_message, time.time() - start_time, error_occurred=True)
+            ERRORS.labels(type(e).__name__).inc()
+            reply(error_message)
+            save(error_message, error_occurred=True)
 
         except DifyResponseError as e:
             error_message = "申し訳ありません。応答の処理中にエラーが発生しました。"
             logger.error(f"Dify API応答エラー: {str(e)}")
-            say(text=error_message, thread_ts=conversation_id)
-            conversation_service.save_conversation(user, query, error_message, time.time() - start_time, error_occurred=True)
+            ERRORS.labels(type(e).__name__).inc()
+            reply(error_message)
+            save(error_message, error_occurred=True)
 
         except DifyAPIError as e:
             error_message = "申し訳ありません。予期しないエラーが発生しました。"
             logger.error(f"Dify APIエラー: {str(e)}")
-            say(text=error_message, thread_ts=conversation_id)
-            conversation_service.save_conversation(user, query, error_message, time.time() - start_time, error_occurred=True)
+            ERRORS.labels(type(e).__name__).inc()
+            reply(error_message)
+            save(error_message, error_occurred=True)
 
     except Exception as e:
         error_message = "申し訳ありません。システムエラーが発生しました。"
         logger.error(f"システムエラー: {str(e)}")
-        say(text=error_message, thread_ts=conversation_id if 'conversation_id' in locals() else None)
+        ERRORS.labels('unexpected').inc()
+        slack_sender.post(event['channel'], error_message,
+                          thread_ts=thread_ts if 'thread_ts' in locals() else None)
+
+    finally:
+        trace.finish()
+
+def get_bot_user_id() -> str:
+    """Bot User IDを取得（initialize_slackで解決した値をキャッシュして再利用）"""
+    global BOT_USER_ID
+    if BOT_USER_ID is None:
+        BOT_USER_ID = app.client.auth_test()["user_id"]
+    return BOT_USER_ID
 
 def initialize_slack():
     """Initialize Slack connection and verify bot credentials"""
     try:
+        global BOT_USER_ID
         auth_test = app.client.auth_test()
         bot_user_id = auth_test["user_id"]
+        BOT_USER_ID = bot_user_id
         logger.info("Slack接続成功: Bot User ID = %s", bot_user_id)
         logger.info("Bot名: %s, チーム: %s", auth_test.get("user"), auth_test.get("team"))
         logger.info("認証スコープ: %s", auth_test.get("scope", "不明"))
@@ -178,25 +486,99 @@ def initialize_slack():
         logger.error("必要な権限: app_mentions:read, chat:write, commands")
         raise
 
+def register_service_metrics():
+    """各サービスの状態をメトリクスのゲージとして公開する"""
+    SCHEDULER_ACTIVE.set_function(lambda: scheduler.get_stats()['active'])
+    SCHEDULER_QUEUE_DEPTH.set_function(lambda: scheduler.get_stats()['queue_depth'])
+    DB_POOL_IN_USE.set_function(lambda: conversation_service.get_pool_stats()['in_use'])
+    if conversation_service.writer:
+        WRITER_QUEUE_DEPTH.set_function(lambda: conversation_service.get_writer_stats()['queue_depth'])
+
+def startup(timer: StartupTimer = None) -> StartupTimer:
+    """
+    DBのスキーマ確認と接続プールの暖機、Dify APIへの事前接続、Slackの認証確認を並列に行う
+    Socket Modeで接続する（イベントを受け付ける）前に呼び出す
+    """
+    timer = timer or StartupTimer()
+
+    def database():
+        with timer.phase("database"):
+            conversation_service.start()
+            if partition_manager:
+                partition_manager.setup()
+
+    def dify():
+        with timer.phase("dify"):
+            dify_service.warm_up(DIFY_WARM_CONNECTIONS)
+
+    def slack():
+        with timer.phase("slack"):
+            initialize_slack()
+
+    with ThreadPoolExecutor(max_workers=3, thread_name_prefix="startup") as executor:
+        futures = [executor.submit(phase) for phase in (database, dify, slack)]
+    for future in futures:
+        future.result()
+    return timer
+
+def shutdown(handler: SocketModeHandler = None):
+    """
+    新しいイベントの受付を止め、処理中のメンションの完了を待ってから未保存の会話ログを書き込んで終了する
+    待ち時間の合計はSHUTDOWN_DRAIN_TIMEOUT秒まで
+    """
+    deadline = time.monotonic() + SHUTDOWN_DRAIN_TIMEOUT
+    set_ready(False)
+    if handler is not None:
+        handler.close()
+    if mention_queue:
+        # 処理中のジョブの完了を待つ（未処理のジョブは他のレプリカが引き継ぐ）
+        mention_queue.close(timeout=max(0.0, deadline - time.monotonic()))
+    if not inflight.wait_idle(max(0.0, deadline - time.monotonic())):
+        logger.warning(f"処理中のメンションが{inflight.count}件残っていますが終了します")
+    if partition_manager:
+        partition_manager.close()
+    if response_cache:
+        response_cache.close()
+    conversation_service.close()
+    dify_service.close()
+    shutdown_logger()
+
 def main():
     """Main application entry point"""
     logger.info("Slackボットアプリケーションを起動します")
+    timer = StartupTimer()
+    register_service_metrics()
+    start_health_server()
+    handler = None
     try:
-        # Initialize and verify Slack connection
-        bot_user_id = initialize_slack()
+        # 接続の準備が整うまではSocket Modeで接続せず、readyzもunavailableのままにする
+        startup(timer)
         logger.info("Slack接続の初期化が完了しました")
+        if partition_manager:
+            partition_manager.start()
+        if response_cache:
+            response_cache.start()
+        if mention_queue:
+            mention_queue.start()
 
         # Start Socket Mode handler
         logger.info("Socket Modeハンドラを開始します...")
         try:
-            handler = SocketModeHandler(app, SLACK_APP_TOKEN)
-            handler.start()
+            with timer.phase("socket_mode"):
+                handler = SocketModeHandler(app, SLACK_APP_TOKEN)
+                add_readiness_check("socket_mode", handler.client.is_connected)
+                handler.connect()
+            set_ready()
             logger.info("Socket Modeハンドラが正常に開始されました")
+            timer.ready()
         except Exception as e:
             logger.error(f"Socket Mode起動エラー: {str(e)}")
             logger.error("Socket Modeが有効になっているか確認してください（api.slack.com/apps > Socket Mode）")
             raise
 
+        # 接続はSocket Modeクライアントのスレッドが維持するため、メインスレッドは終了まで待機する
+        threading.Event().wait()
+
     except Exception as e:
         logger.error("Slackアプリの起動に失敗しました: %s", str(e))
         logger.error("設定を確認してください:")
@@ -205,5 +587,10 @@ def main():
         logger.error("3. SLACK_BOT_TOKEN: Bot User OAuth Token（api.slack.com/apps > OAuth & Permissions）")
         raise
 
+    finally:
+        shutdown(handler)
+
 if __name__ == "__main__":
+    # SIGTERM（コンテナ停止時など）でもfinallyの終了処理を実行する
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
     main()
\ No newline at end of file
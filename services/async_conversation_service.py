@@ -0,0 +1,181 @@
+import os
+import json
+import time
+import asyncpg
+from utils.logger import setup_logger
+from utils.metrics import DB_WRITE_LATENCY
+from .schema import SCHEMA_STATEMENTS, SCHEMA_VERSION, HISTOGRAM_SIZE, ensure_schema_async, summarize_rollup
+from .conversation_map import ConversationMap, LOOKUP_SQL, SAVE_SQL, TOUCH_SQL, FORGET_SQL, PURGE_SQL
+
+logger = setup_logger()
+
+class AsyncConversationService:
+    """Asyncio counterpart of ConversationService built on an asyncpg pool"""
+
+    def __init__(self):
+        self.db_url = os.environ["DATABASE_URL"]
+        self.min_size = int(os.environ.get('DB_POOL_MIN_SIZE', '1'))
+        self.max_size = int(os.environ.get('DB_POOL_MAX_SIZE', '10'))
+        self.pool = None
+        self.conversation_map = ConversationMap(
+            max_entries=int(os.environ.get('THREAD_CONVERSATION_CACHE_SIZE', '10000')),
+            ttl=float(os.environ.get('THREAD_CONVERSATION_TTL', '604800'))
+        )
+
+    async def start(self):
+        """接続プールを作成し、テーブルを初期化する"""
+        if self.pool is not None:
+            return
+        self.pool = await asyncpg.create_pool(self.db_url, min_size=self.min_size, max_size=self.max_size)
+        await self._init_database()
+
+    async def close(self):
+        """接続プールを閉じる"""
+        if self.pool is not None:
+            await self.pool.close()
+            self.pool = None
+
+    async def _init_database(self):
+        """Initialize database tables if the recorded schema version differs"""
+        if await ensure_schema_async(self.pool, 'conversations', SCHEMA_VERSION, SCHEMA_STATEMENTS):
+            logger.info(f"データベーステーブルの初期化が完了しました - スキーマバージョン: {SCHEMA_VERSION}")
+        else:
+            logger.info(f"データベーススキーマは最新です - バージョン: {SCHEMA_VERSION}")
+
+    async def save_conversation(self, user_id: str, message: str, response: str, response_time: float, error_occurred: bool = False,
+                                first_token_time: float = None, trace: dict = None):
+        """Save a conversation to the database"""
+        start = time.perf_counter()
+        try:
+            async with self.pool.acquire() as conn:
+                await conn.execute("""
+                    INSERT INTO conversations
+                    (user_id, message, response, response_time, error_occurred, first_token_time, trace)
+                    VALUES ($1, $2, $3, $4, $5, $6, $7)
+                """, user_id, message, response, response_time, error_occurred, first_token_time,
+                    json.dumps(trace, ensure_ascii=False) if trace else None)
+            DB_WRITE_LATENCY.labels('insert').observe(time.perf_counter() - start)
+            logger.info(f"会話履歴を保存しました - ユーザー: {user_id}")
+        except Exception as e:
+            logger.error(f"会話履歴の保存に失敗しました: {str(e)}")
+            raise
+
+    def get_conversation_map_stats(self) -> dict:
+        """スレッドとDify会話IDの対応のキャッシュ状況を取得"""
+        return self.conversation_map.get_stats()
+
+    async def get_dify_conversation(self, channel: str, thread_ts: str, user_id: str):
+        """Slackスレッドに対応するDifyの会話IDを取得（未登録または期限切れならNone）"""
+        key = (channel, thread_ts, user_id)
+        cached = self.conversation_map.get(key)
+        if cached:
+            conversation_id, touch = cached
+            if touch:
+                async with self.pool.acquire() as conn:
+                    await conn.execute(TOUCH_SQL.format(channel='$1', thread_ts='$2', user='$3'), *key)
+            return conversation_id
+
+        async with self.pool.acquire() as conn:
+            conversation_id = await conn.fetchval(
+                LOOKUP_SQL.format(channel='$1', thread_ts='$2', user='$3', ttl='$4::float8'),
+                *key, self.conversation_map.ttl
+            )
+        if conversation_id is not None:
+            self.conversation_map.put(key, conversation_id)
+        return conversation_id
+
+    async def save_dify_conversation(self, channel: str, thread_ts: str, user_id: str, conversation_id: str):
+        """Difyの最初の応答で払い出された会話IDをスレッドに対応付ける"""
+        key = (channel, thread_ts, user_id)
+        async with self.pool.acquire() as conn:
+            if self.conversation_map.should_purge():
+                await conn.execute(PURGE_SQL.format(ttl='$1::float8'), self.conversation_map.ttl)
+            await conn.execute(SAVE_SQL.format(channel='$1', thread_ts='$2', user='$3', conversation_id='$4'),
+                               *key, conversation_id)
+        self.conversation_map.put(key, conversation_id, stored=True)
+        logger.info(f"スレッドをDifyの会話に対応付けました - スレッド: {channel}/{thread_ts}, 会話ID: {conversation_id}")
+
+    async def forget_dify_conversation(self, channel: str, thread_ts: str, user_id: str):
+        """Dify側で見つからなくなった会話の対応を削除する"""
+        key = (channel, thread_ts, user_id)
+        self.conversation_map.discard(key)
+        async with self.pool.acquire() as conn:
+            await conn.execute(FORGET_SQL.format(channel='$1', thread_ts='$2', user='$3'), *key)
+
+    async def get_user_history(self, user_id: str, limit: int = 10) -> list:
+        """Get conversation history for a specific user"""
+        try:
+            async with self.pool.acquire() as conn:
+                rows = await conn.fetch("""
+                    SELECT * FROM conversations
+                    WHERE user_id = $1
+                    ORDER BY created_at DESC
+                    LIMIT $2
+                """, user_id, limit)
+                return [dict(row) for row in rows]
+        except Exception as e:
+            logger.error(f"会話履歴の取得に失敗しました: {str(e)}")
+            raise
+
+    async def get_user_stats(self, user_id: str) -> dict:
+        """Get usage statistics for a specific user"""
+        try:
+            async with self.pool.acquire() as conn:
+                # 集計テーブルから取得（会話数に依存しない）
+                row = await conn.fetchrow("""
+                    SELECT total_conversations, error_count, response_time_sum,
+                           response_time_count, latency_histogram
+                    FROM conversation_user_stats
+                    WHERE user_id = $1
+                """, user_id)
+                if row:
+                    stats = summarize_rollup(row['total_conversations'], row['error_count'], row['response_time_sum'],
+                                             row['response_time_count'], list(row['latency_histogram']))
+                    stats['error_count'] = row['error_count']
+                else:
+                    stats = summarize_rollup(0, 0, 0.0, 0, [0] * HISTOGRAM_SIZE)
+                    stats['error_count'] = 0
+
+                # 最近の会話
+                rows = await conn.fetch("""
+                    SELECT created_at, message, response, response_time
+                    FROM conversations
+                    WHERE user_id = $1
+                    ORDER BY created_at DESC
+                    LIMIT 5
+                """, user_id)
+                stats['recent_conversations'] = [dict(row) for row in rows]
+
+                return stats
+        except Exception as e:
+            logger.error(f"統計情報の取得に失敗しました: {str(e)}")
+            raise
+
+    async def get_total_stats(self) -> dict:
+        """Get overall usage statistics"""
+        try:
+            async with self.pool.acquire() as conn:
+                # 日別集計を合算（日数に比例するコスト）
+                rows = await conn.fetch("""
+                    SELECT day, total_conversations, error_count, response_time_sum,
+                           response_time_count, latency_histogram
+                    FROM conversation_daily_stats
+                """)
+                histogram = [0] * HISTOGRAM_SIZE
+                for row in rows:
+                    histogram = [a + b for a, b in zip(histogram, row['latency_histogram'])]
+                total_errors = sum(row['error_count'] for row in rows)
+                stats = summarize_rollup(
+                    sum(row['total_conversations'] for row in rows),
+                    total_errors,
+                    sum(row['response_time_sum'] for row in rows),
+                    sum(row['response_time_count'] for row in rows),
+                    histogram
+                )
+                stats['total_errors'] = total_errors
+                stats['total_users'] = await conn.fetchval("SELECT total_users FROM conversation_total_stats") or 0
+
+                return stats
+        except Exception as e:
+            logger.error(f"全体統計情報の取得に失敗しました: {str(e)}")
+            raise
@@ -0,0 +1,278 @@
+import os
+import json
+import random
+import asyncio
+import aiohttp
+from typing import AsyncIterator, Callable, Optional
+from datetime import datetime
+from utils.logger import setup_logger
+from utils.metrics import DIFY_LATENCY
+from .errors import DifyAPIError, DifyTimeoutError, DifyConnectionError, DifyResponseError, DifyConversationNotFoundError
+from .resilience import CircuitOpenError
+from .dify_service import create_circuit_breaker, create_adaptive_timeout
+
+logger = setup_logger()
+
+class AsyncDifyService:
+    """Asyncio counterpart of DifyService built on aiohttp"""
+
+    def __init__(self, api_key: str):
+        if not api_key:
+            raise ValueError("Dify API keyが必要です")
+        self.api_key = api_key
+        self.base_url = os.environ.get('DIFY_API_URL')
+        if not self.base_url:
+            logger.error("DIFY_API_URLが設定されていません")
+            raise ValueError("DIFY_API_URLが環境変数に設定されていません")
+        logger.info(f"Dify API URL: {self.base_url}")
+        self.headers = {
+            'Authorization': f'Bearer {api_key}',
+            'Content-Type': 'application/json'
+        }
+        self.connect_timeout = float(os.environ.get('DIFY_CONNECT_TIMEOUT', '5'))
+        self.read_timeout = float(os.environ.get('DIFY_READ_TIMEOUT', '30'))
+        self.pool_size = int(os.environ.get('DIFY_POOL_SIZE', '10'))
+        self.keepalive = os.environ.get('DIFY_KEEPALIVE', 'true').lower() == 'true'
+        self.max_retries = int(os.environ.get('DIFY_MAX_RETRIES', '2'))
+        self.retry_backoff = float(os.environ.get('DIFY_RETRY_BACKOFF', '0.5'))
+        self.retry_jitter = float(os.environ.get('DIFY_RETRY_JITTER', '0.5'))
+        self.session: Optional[aiohttp.ClientSession] = None
+        self.breaker = create_circuit_breaker()
+        self.adaptive_timeout = create_adaptive_timeout(self.read_timeout)
+
+    async def start(self):
+        """接続プール付きのHTTPセッションを作成（イベントループ内で呼び出す）"""
+        if self.session is not None:
+            return
+        connector = aiohttp.TCPConnector(
+            limit=self.pool_size,
+            force_close=not self.keepalive
+        )
+        timeout = aiohttp.ClientTimeout(
+            sock_connect=self.connect_timeout,
+            sock_read=self.read_timeout
+        )
+        self.session = aiohttp.ClientSession(headers=self.headers, connector=connector, timeout=timeout)
+        logger.info(f"Dify 非同期HTTPセッションを作成しました - プールサイズ: {self.pool_size}, keep-alive: {self.keepalive}")
+
+    async def warm_up(self, connections: int = 2) -> int:
+        """DifyService.warm_upの非同期版"""
+        await self.start()
+        if connections <= 0 or not self.keepalive:
+            return 0
+
+        async def request() -> bool:
+            try:
+                async with self.session.get(f"{self.base_url}/parameters", params={'user': 'warmup'}) as response:
+                    await response.read()
+                return True
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logger.warning(f"Dify APIへの事前接続に失敗しました: {str(e)}")
+                return False
+
+        warmed = sum(await asyncio.gather(*(request() for _ in range(connections))))
+        logger.info(f"Dify APIへの接続を事前に確立しました - {warmed}/{connections}本")
+        return warmed
+
+    async def close(self):
+        """HTTPセッションを閉じる"""
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    def _check_circuit(self) -> bool:
+        """サーキットブレーカーが開いていれば接続エラーとして即座に失敗させる（半開状態の試行呼び出しならTrue）"""
+        try:
+            return self.breaker.before_call()
+        except CircuitOpenError as e:
+            logger.warning(f"Dify APIへの呼び出しを遮断しました: {str(e)}")
+            raise DifyConnectionError(e)
+
+    def _record_outcome(self, failed: bool, response_time: float = None):
+        if failed:
+            self.breaker.record_failure()
+            return
+        self.breaker.record_success()
+        if response_time is not None and self.adaptive_timeout:
+            self.adaptive_timeout.observe(response_time)
+
+    @staticmethod
+    def _is_upstream_failure(error: aiohttp.ClientError) -> bool:
+        """接続エラー・5xxをDify側の障害とみなす"""
+        if isinstance(error, aiohttp.ClientResponseError):
+            return error.status >= 500
+        return True
+
+    @staticmethod
+    def _is_conversation_not_found(error: aiohttp.ClientError, conversation_id: Optional[str]) -> bool:
+        """指定した会話IDがDify側に存在しない（削除済み・別ユーザーの会話など）場合のエラーか"""
+        return bool(conversation_id) and isinstance(error, aiohttp.ClientResponseError) and error.status == 404
+
+    async def _post(self, path: str, data: dict, read_timeout: float = None) -> aiohttp.ClientResponse:
+        """POSTリクエストを送信（接続確立前の失敗のみジッター付き指数バックオフで再試行）"""
+        await self.start()
+        timeout = aiohttp.ClientTimeout(
+            sock_connect=self.connect_timeout,
+            sock_read=read_timeout or self.read_timeout
+        )
+        attempt = 0
+        while True:
+            try:
+                return await self.session.post(f"{self.base_url}{path}", data=json.dumps(data), timeout=timeout)
+            except aiohttp.ClientConnectorError:
+                if attempt >= self.max_retries:
+                    raise
+                delay = self.retry_backoff * (2 ** attempt) + random.uniform(0, self.retry_jitter)
+                attempt += 1
+                logger.warning(f"Dify API接続失敗 - {delay:.2f}秒後に再試行します（{attempt}/{self.max_retries}）")
+                await asyncio.sleep(delay)
+
+    def _build_request(self, query: str, user: str, conversation_id: Optional[str], response_mode: str) -> dict:
+        if not query:
+            logger.error("空のクエリを受信")
+            raise ValueError("クエリが空です")
+
+        return {
+            'inputs': {},
+            'query': query,
+            'user': user,
+            'response_mode': response_mode,
+            'conversation_id': conversation_id if conversation_id else ''
+        }
+
+    async def get_response(self, query: str, user: str, conversation_id: Optional[str] = None,
+                           on_conversation: Optional[Callable[[str], None]] = None) -> str:
+        """
+        Get response from Dify API (blocking response mode)
+        on_conversation: 応答に含まれる会話IDを受け取る関数（新しい会話で払い出されたIDの記録に使用）
+        """
+        data = self._build_request(query, user, conversation_id, 'blocking')
+
+        probe = self._check_circuit()
+        # ブレーカーの試行呼び出しでは設定値のタイムアウトを使う
+        read_timeout = self.adaptive_timeout.current() if self.adaptive_timeout and not probe else self.read_timeout
+        failed = False
+        start_time = datetime.now()
+        try:
+            logger.info(f"Dify APIリクエスト開始 - ユーザー: {user}")
+            response = await self._post('/chat-messages', data, read_timeout)
+            async with response:
+                logger.debug("APIレスポンス状態コード: %s", response.status)
+                response.raise_for_status()
+                response_data = await response.json()
+            if on_conversation and response_data.get('conversation_id'):
+                on_conversation(response_data['conversation_id'])
+
+            if 'answer' in response_data:
+                return response_data['answer']
+            elif 'message' in response_data:
+                return response_data['message']
+            else:
+                logger.warning(f"予期しない応答形式: {response_data}")
+                raise DifyResponseError(response_data)
+
+        except DifyAPIError:
+            raise
+
+        except asyncio.TimeoutError:
+            failed = True
+            logger.error(f"Dify APIリクエストがタイムアウト（{read_timeout:.1f}秒）")
+            if self.adaptive_timeout:
+                self.adaptive_timeout.observe_timeout(read_timeout)
+            raise DifyTimeoutError()
+
+        except aiohttp.ClientError as e:
+            failed = self._is_upstream_failure(e)
+            if self._is_conversation_not_found(e, conversation_id):
+                logger.warning(f"Difyの会話が見つかりません - 会話ID: {conversation_id}")
+                raise DifyConversationNotFoundError(conversation_id, e)
+            logger.error(f"Dify APIリクエストエラー: {str(e)}")
+            raise DifyConnectionError(e)
+
+        except Exception as e:
+            logger.error(f"予期しないエラー: {str(e)}")
+            raise DifyAPIError(f"予期しないエラーが発生しました: {str(e)}", e)
+
+        finally:
+            response_time = (datetime.now() - start_time).total_seconds()
+            self._record_outcome(failed, response_time)
+            DIFY_LATENCY.labels('blocking').observe(response_time)
+            if response_time > read_timeout * 0.8:
+                logger.warning(f"応答時間が長い: {response_time:.2f}秒")
+
+    async def stream_response(self, query: str, user: str, conversation_id: Optional[str] = None,
+                              on_conversation: Optional[Callable[[str], None]] = None) -> AsyncIterator[str]:
+        """
+        Stream response chunks from Dify API (streaming response mode)
+        on_conversation: 最初のイベントに含まれる会話IDを受け取る関数
+        """
+        data = self._build_request(query, user, conversation_id, 'streaming')
+
+        self._check_circuit()
+        failed = False
+        start_time = datetime.now()
+        try:
+            logger.info(f"Dify APIストリーミングリクエスト開始 - ユーザー: {user}")
+            response = await self._post('/chat-messages', data)
+            async with response:
+                response.raise_for_status()
+                async for raw_line in response.content:
+                    line = raw_line.decode('utf-8').strip()
+                    if not line.startswith('data:'):
+                        continue
+                    event = json.loads(line[len('data:'):].strip())
+                    event_type = event.get('event')
+                    if on_conversation and event.get('conversation_id'):
+                        on_conversation(event['conversation_id'])
+                        on_conversation = None
+
+                    if event_type in ('message', 'agent_message'):
+                        chunk = event.get('answer', '')
+                        if chunk:
+                            yield chunk
+                    elif event_type == 'message_end':
+                        return
+                    elif event_type == 'error':
+                        logger.warning(f"ストリーミング中のエラーイベント: {event}")
+                        raise DifyResponseError(event)
+
+        except DifyAPIError:
+            raise
+
+        except asyncio.TimeoutError:
+            failed = True
+            logger.error("Dify APIストリーミングリクエストがタイムアウト")
+            raise DifyTimeoutError()
+
+        except aiohttp.ClientError as e:
+            failed = self._is_upstream_failure(e)
+            if self._is_conversation_not_found(e, conversation_id):
+                logger.warning(f"Difyの会話が見つかりません - 会話ID: {conversation_id}")
+                raise DifyConversationNotFoundError(conversation_id, e)
+            logger.error(f"Dify APIストリーミングリクエストエラー: {str(e)}")
+            raise DifyConnectionError(e)
+
+        except Exception as e:
+            logger.error(f"予期しないエラー: {str(e)}")
+            raise DifyAPIError(f"予期しないエラーが発生しました: {str(e)}", e)
+
+        finally:
+            self._record_outcome(failed)
+            response_time = (datetime.now() - start_time).total_seconds()
+            DIFY_LATENCY.labels('streaming').observe(response_time)
+            if response_time > self.read_timeout * 0.8:
+                logger.warning(f"ストリーミング応答時間が長い: {response_time:.2f}秒")
+
+    async def get_conversation_history(self, user: str, conversation_id: str) -> list:
+        """会話履歴を取得"""
+        await self.start()
+        try:
+            async with self.session.get(
+                f"{self.base_url}/messages",
+                params={'conversation_id': conversation_id}
+            ) as response:
+                response.raise_for_status()
+                return (await response.json()).get('data', [])
+        except Exception as e:
+            logger.error(f"会話履歴の取得に失敗: {str(e)}")
+            raise DifyAPIError("会話履歴の取得に失敗しました", e)
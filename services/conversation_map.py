@@ -0,0 +1,99 @@
+import time
+import threading
+from collections import OrderedDict
+
+# (channel, thread_ts, user_id) -> Dify conversation_id。last_used_atからttl秒使われていない対応は期限切れ
+# 取得と同時に最終使用時刻を更新する
+LOOKUP_SQL = """
+    UPDATE thread_conversations SET last_used_at = now()
+    WHERE channel = {channel} AND thread_ts = {thread_ts} AND user_id = {user}
+      AND last_used_at > now() - {ttl} * interval '1 second'
+    RETURNING conversation_id
+"""
+SAVE_SQL = """
+    INSERT INTO thread_conversations (channel, thread_ts, user_id, conversation_id)
+    VALUES ({channel}, {thread_ts}, {user}, {conversation_id})
+    ON CONFLICT (channel, thread_ts, user_id) DO UPDATE SET
+        conversation_id = EXCLUDED.conversation_id,
+        last_used_at = now()
+"""
+TOUCH_SQL = """
+    UPDATE thread_conversations SET last_used_at = now()
+    WHERE channel = {channel} AND thread_ts = {thread_ts} AND user_id = {user}
+"""
+FORGET_SQL = """
+    DELETE FROM thread_conversations
+    WHERE channel = {channel} AND thread_ts = {thread_ts} AND user_id = {user}
+"""
+PURGE_SQL = "DELETE FROM thread_conversations WHERE last_used_at <= now() - {ttl} * interval '1 second'"
+
+class ConversationMap:
+    """In-process LRU + TTL cache of Slack thread -> Dify conversation_id mappings stored in thread_conversations"""
+
+    def __init__(self, max_entries: int = 10000, ttl: float = 604800.0, purge_interval: float = 3600.0):
+        """
+        max_entries: プロセス内に保持する対応の最大件数（超えた分は最も古く使われたものから削除）
+        ttl: 最後に使われてからこの秒数を過ぎた対応は期限切れとし、新しい会話として扱う
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.purge_interval = purge_interval
+        # 最終使用時刻のDBへの反映は間引く（期限判定の精度はttlの1割程度）
+        self.touch_interval = ttl / 10
+
+        self._entries = OrderedDict()  # key -> [conversation_id, DBへ最終使用時刻を反映した時刻]
+        self._lock = threading.Lock()
+        self._last_purge = time.monotonic()
+        self._stats = {'hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0, 'expired': 0}
+
+    def get(self, key: tuple):
+        """キャッシュ済みなら(conversation_id, DBの最終使用時刻を更新すべきか)、なければNoneを返す"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._stats['misses'] += 1
+                return None
+            if now - entry[1] >= self.ttl:
+                # 他のプロセスが使用している可能性があるため、DBで確認し直す
+                del self._entries[key]
+                self._stats['expired'] += 1
+                self._stats['misses'] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._stats['hits'] += 1
+            touch = now - entry[1] >= self.touch_interval
+            if touch:
+                entry[1] = now
+            return entry[0], touch
+
+    def put(self, key: tuple, conversation_id: str, stored: bool = False):
+        with self._lock:
+            self._entries[key] = [conversation_id, time.monotonic()]
+            self._entries.move_to_end(key)
+            if stored:
+                self._stats['stores'] += 1
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._stats['evictions'] += 1
+
+    def discard(self, key: tuple):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def should_purge(self) -> bool:
+        now = time.monotonic()
+        with self._lock:
+            if now - self._last_purge < self.purge_interval:
+                return False
+            self._last_purge = now
+            return True
+
+    def get_stats(self) -> dict:
+        """キャッシュのヒット率と件数を取得"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats['entries'] = len(self._entries)
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits'] / lookups if lookups else 0.0
+        return stats
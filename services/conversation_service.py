@@ -1,54 +1,179 @@
 import os
+import time
 from datetime import datetime
 import psycopg2
-from psycopg2.extras import DictCursor
+from psycopg2.extras import DictCursor, Json, execute_values
 from utils.logger import setup_logger
+from utils.metrics import DB_WRITE_LATENCY
+from .db_pool import ConnectionPool
+from .conversation_writer import ConversationWriter
+from .conversation_map import ConversationMap, LOOKUP_SQL, SAVE_SQL, TOUCH_SQL, FORGET_SQL, PURGE_SQL
+from .schema import SCHEMA_STATEMENTS, SCHEMA_VERSION, HISTOGRAM_SIZE, ensure_schema, summarize_rollup
 
 logger = setup_logger()
 
+# 会話ログとして保存する列
+CONVERSATION_COLUMNS = ('user_id', 'message', 'response', 'response_time', 'error_occurred', 'first_token_time', 'trace', 'created_at')
+
 class ConversationService:
     def __init__(self):
         self.db_url = os.environ["DATABASE_URL"]
+        self.pool = ConnectionPool(
+            self.db_url,
+            min_size=int(os.environ.get('DB_POOL_MIN_SIZE', '1')),
+            max_size=int(os.environ.get('DB_POOL_MAX_SIZE', '10')),
+            checkout_timeout=float(os.environ.get('DB_POOL_TIMEOUT', '10')),
+            healthcheck_idle=float(os.environ.get('DB_POOL_HEALTHCHECK_IDLE', '30'))
+        )
+
+        # Slackスレッド -> Dify会話IDの対応（DBに保存し、プロセス内ではLRUでキャッシュする）
+        self.conversation_map = ConversationMap(
+            max_entries=int(os.environ.get('THREAD_CONVERSATION_CACHE_SIZE', '10000')),
+            ttl=float(os.environ.get('THREAD_CONVERSATION_TTL', '604800'))
+        )
+
+        # write-behindモードでは会話ログをキューに積み、バックグラウンドで一括保存する
+        self.writer = None
+        if os.environ.get('CONVERSATION_WRITE_BEHIND', 'false').lower() == 'true':
+            self.writer = ConversationWriter(
+                self.save_conversations_batch,
+                max_queue_size=int(os.environ.get('CONVERSATION_QUEUE_SIZE', '1000')),
+                batch_size=int(os.environ.get('CONVERSATION_BATCH_SIZE', '100')),
+                flush_interval=float(os.environ.get('CONVERSATION_FLUSH_INTERVAL', '1.0')),
+                spill_path=os.environ.get('CONVERSATION_SPILL_PATH', 'conversation_spill.jsonl'),
+                quarantine_path=os.environ.get('CONVERSATION_QUARANTINE_PATH', 'conversation_quarantine.jsonl'),
+                # 値の長さや型、制約違反は再試行しても解消しない
+                is_data_error=lambda e: isinstance(e, (psycopg2.DataError, psycopg2.IntegrityError))
+            )
+
+    def get_pool_stats(self) -> dict:
+        """接続プールの使用状況と待ち時間メトリクスを取得"""
+        return self.pool.get_stats()
+
+    def get_conversation_map_stats(self) -> dict:
+        """スレッドとDify会話IDの対応のキャッシュ状況を取得"""
+        return self.conversation_map.get_stats()
+
+    def get_writer_stats(self) -> dict:
+        """write-behindキューの状況を取得"""
+        return self.writer.get_stats() if self.writer else {}
+
+    def close(self):
+        """未保存の会話ログを書き込み、接続プールを閉じる"""
+        if self.writer:
+            self.writer.close()
+        self.pool.close()
+
+    def start(self):
+        """テーブルを初期化し、接続プールを暖機する（起動時に1回呼び出す）"""
         self._init_database()
+        self.pool.open()
 
     def _init_database(self):
-        """Initialize database tables if they don't exist"""
-        with psycopg2.connect(self.db_url) as conn:
-            with conn.cursor() as cur:
-                cur.execute("""
-                    CREATE TABLE IF NOT EXISTS conversations (
-                        id SERIAL PRIMARY KEY,
-                        user_id VARCHAR(50) NOT NULL,
-                        message TEXT NOT NULL,
-                        response TEXT NOT NULL,
-                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                        response_time FLOAT,
-                        error_occurred BOOLEAN DEFAULT FALSE
-                    )
-                """)
-                conn.commit()
-                logger.info("データベーステーブルの初期化が完了しました")
+        """Initialize database tables if the recorded schema version differs"""
+        if ensure_schema(self.pool, 'conversations', SCHEMA_VERSION, SCHEMA_STATEMENTS):
+            logger.info(f"データベーステーブルの初期化が完了しました - スキーマバージョン: {SCHEMA_VERSION}")
+        else:
+            logger.info(f"データベーススキーマは最新です - バージョン: {SCHEMA_VERSION}")
 
-    def save_conversation(self, user_id: str, message: str, response: str, response_time: float, error_occurred: bool = False):
+    def save_conversation(self, user_id: str, message: str, response: str, response_time: float, error_occurred: bool = False,
+                          first_token_time: float = None, trace: dict = None):
         """Save a conversation to the database"""
+        if self.writer:
+            self.writer.submit({
+                'user_id': user_id,
+                'message': message,
+                'response': response,
+                'response_time': response_time,
+                'error_occurred': error_occurred,
+                'first_token_time': first_token_time,
+                'trace': trace
+            })
+            return
+
+        start = time.perf_counter()
         try:
-            with psycopg2.connect(self.db_url) as conn:
+            with self.pool.connection() as conn:
                 with conn.cursor() as cur:
                     cur.execute("""
                         INSERT INTO conversations 
-                        (user_id, message, response, response_time, error_occurred)
-                        VALUES (%s, %s, %s, %s, %s)
-                    """, (user_id, message, response, response_time, error_occurred))
-                    conn.commit()
-                    logger.info(f"会話履歴を保存しました - ユーザー: {user_id}")
+                        (user_id, message, response, response_time, error_occurred, first_token_time, trace)
+                        VALUES (%s, %s, %s, %s, %s, %s, %s)
+                    """, (user_id, message, response, response_time, error_occurred, first_token_time,
+                          Json(trace) if trace else None))
+            DB_WRITE_LATENCY.labels('insert').observe(time.perf_counter() - start)
+            logger.info(f"会話履歴を保存しました - ユーザー: {user_id}")
         except Exception as e:
             logger.error(f"会話履歴の保存に失敗しました: {str(e)}")
             raise
 
+    def get_dify_conversation(self, channel: str, thread_ts: str, user_id: str):
+        """Slackスレッドに対応するDifyの会話IDを取得（未登録または期限切れならNone）"""
+        key = (channel, thread_ts, user_id)
+        cached = self.conversation_map.get(key)
+        if cached:
+            conversation_id, touch = cached
+            if touch:
+                with self.pool.connection() as conn:
+                    with conn.cursor() as cur:
+                        cur.execute(TOUCH_SQL.format(channel='%s', thread_ts='%s', user='%s'), key)
+            return conversation_id
+
+        with self.pool.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(LOOKUP_SQL.format(channel='%s', thread_ts='%s', user='%s', ttl='%s'),
+                            key + (self.conversation_map.ttl,))
+                row = cur.fetchone()
+        if row is None:
+            return None
+        self.conversation_map.put(key, row[0])
+        return row[0]
+
+    def save_dify_conversation(self, channel: str, thread_ts: str, user_id: str, conversation_id: str):
+        """Difyの最初の応答で払い出された会話IDをスレッドに対応付ける"""
+        key = (channel, thread_ts, user_id)
+        with self.pool.connection() as conn:
+            with conn.cursor() as cur:
+                if self.conversation_map.should_purge():
+                    cur.execute(PURGE_SQL.format(ttl='%s'), (self.conversation_map.ttl,))
+                cur.execute(SAVE_SQL.format(channel='%s', thread_ts='%s', user='%s', conversation_id='%s'),
+                            key + (conversation_id,))
+        self.conversation_map.put(key, conversation_id, stored=True)
+        logger.info(f"スレッドをDifyの会話に対応付けました - スレッド: {channel}/{thread_ts}, 会話ID: {conversation_id}")
+
+    def forget_dify_conversation(self, channel: str, thread_ts: str, user_id: str):
+        """Dify側で見つからなくなった会話の対応を削除する"""
+        key = (channel, thread_ts, user_id)
+        self.conversation_map.discard(key)
+        with self.pool.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(FORGET_SQL.format(channel='%s', thread_ts='%s', user='%s'), key)
+
+    @staticmethod
+    def _to_row(record: dict) -> tuple:
+        row = dict(record)
+        if row.get('trace'):
+            row['trace'] = Json(row['trace'])
+        return tuple(row.get(column) for column in CONVERSATION_COLUMNS)
+
+    def save_conversations_batch(self, records: list):
+        """Save multiple conversations with a single multi-row INSERT"""
+        start = time.perf_counter()
+        with self.pool.connection() as conn:
+            with conn.cursor() as cur:
+                execute_values(
+                    cur,
+                    f"INSERT INTO conversations ({', '.join(CONVERSATION_COLUMNS)}) VALUES %s",
+                    [self._to_row(record) for record in records],
+                    page_size=len(records)
+                )
+        DB_WRITE_LATENCY.labels('batch').observe(time.perf_counter() - start)
+        logger.info(f"会話履歴を一括保存しました - {len(records)}件")
+
     def get_user_history(self, user_id: str, limit: int = 10) -> list:
         """Get conversation history for a specific user"""
         try:
-            with psycopg2.connect(self.db_url) as conn:
+            with self.pool.connection() as conn:
                 with conn.cursor(cursor_factory=DictCursor) as cur:
                     cur.execute("""
                         SELECT * FROM conversations
@@ -64,21 +189,23 @@ class ConversationService:
     def get_user_stats(self, user_id: str) -> dict:
         """Get usage statistics for a specific user"""
         try:
-            with psycopg2.connect(self.db_url) as conn:
+            with self.pool.connection() as conn:
                 with conn.cursor(cursor_factory=DictCursor) as cur:
-                    # 総会話数
+                    # 集計テーブルから取得（会話数に依存しない）
                     cur.execute("""
-                        SELECT COUNT(*) as total_conversations,
-                               COUNT(*) FILTER (WHERE error_occurred = true) as error_count,
-                               AVG(response_time) as avg_response_time
-                        FROM conversations
+                        SELECT total_conversations, error_count, response_time_sum,
+                               response_time_count, latency_histogram
+                        FROM conversation_user_stats
                         WHERE user_id = %s
                     """, (user_id,))
-                    stats = dict(cur.fetchone())
-
-                    # エラー率の計算
-                    total = stats['total_conversations']
-                    stats['error_rate'] = (stats['error_count'] / total * 100) if total > 0 else 0
+                    row = cur.fetchone()
+                    if row:
+                        stats = summarize_rollup(row['total_conversations'], row['error_count'], row['response_time_sum'],
+                                                 row['response_time_count'], row['latency_histogram'])
+                        stats['error_count'] = row['error_count']
+                    else:
+                        stats = summarize_rollup(0, 0, 0.0, 0, [0] * HISTOGRAM_SIZE)
+                        stats['error_count'] = 0
 
                     # 最近の会話
                     cur.execute("""
@@ -98,23 +225,33 @@ class ConversationService:
     def get_total_stats(self) -> dict:
         """Get overall usage statistics"""
         try:
-            with psycopg2.connect(self.db_url) as conn:
+            with self.pool.connection() as conn:
                 with conn.cursor(cursor_factory=DictCursor) as cur:
+                    # 日別集計を合算（日数に比例するコスト）
                     cur.execute("""
-                        SELECT 
-                            COUNT(DISTINCT user_id) as total_users,
-                            COUNT(*) as total_conversations,
-                            AVG(response_time) as avg_response_time,
-                            COUNT(*) FILTER (WHERE error_occurred = true) as total_errors
-                        FROM conversations
+                        SELECT day, total_conversations, error_count, response_time_sum,
+                               response_time_count, latency_histogram
+                        FROM conversation_daily_stats
                     """)
-                    stats = dict(cur.fetchone())
+                    rows = cur.fetchall()
+                    histogram = [0] * HISTOGRAM_SIZE
+                    for row in rows:
+                        histogram = [a + b for a, b in zip(histogram, row['latency_histogram'])]
+                    total_errors = sum(row['error_count'] for row in rows)
+                    stats = summarize_rollup(
+                        sum(row['total_conversations'] for row in rows),
+                        total_errors,
+                        sum(row['response_time_sum'] for row in rows),
+                        sum(row['response_time_count'] for row in rows),
+                        histogram
+                    )
+                    stats['total_errors'] = total_errors
 
-                    # エラー率の計算
-                    total = stats['total_conversations']
-                    stats['error_rate'] = (stats['total_errors'] / total * 100) if total > 0 else 0
+                    cur.execute("SELECT total_users FROM conversation_total_stats")
+                    row = cur.fetchone()
+                    stats['total_users'] = row['total_users'] if row else 0
 
                     return stats
         except Exception as e:
             logger.error(f"全体統計情報の取得に失敗しました: {str(e)}")
-            raise
\ No newline at end of file
+            raise
@@ -0,0 +1,273 @@
+import os
+import json
+import queue
+import threading
+import time
+from datetime import datetime
+from utils.logger import setup_logger
+
+logger = setup_logger()
+
+# 停止時にキューの待機を解除するための目印（記録としては扱わない）
+_WAKEUP = object()
+
+class ConversationWriter:
+    """Write-behind buffer that persists conversation records in batches from a background thread"""
+
+    def __init__(self, flush_batch, max_queue_size: int = 1000, batch_size: int = 100, flush_interval: float = 1.0,
+                 put_timeout: float = 0.5, spill_path: str = 'conversation_spill.jsonl',
+                 quarantine_path: str = 'conversation_quarantine.jsonl', is_data_error=None):
+        """
+        flush_batch: 記録（dict）のリストを一括で書き込む関数。失敗時は例外を送出する
+        is_data_error: 例外が記録の内容による（再試行しても書き込めない）ものかを判定する関数
+        quarantine_path: 内容の問題で書き込めない記録の移動先（他の記録の書き込みを妨げないよう分離する）
+        """
+        self.flush_batch = flush_batch
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.put_timeout = put_timeout
+        self.spill_path = spill_path
+        self.quarantine_path = quarantine_path
+        self.is_data_error = is_data_error or (lambda e: False)
+        self._replay_path = f"{spill_path}.replay"
+        self._progress_path = f"{spill_path}.replay.progress"
+
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._stop = threading.Event()
+        # 停止の確認を通過してキューへ追加中の記録の数（closeはこれが0になってから残りを書き込む）
+        self._submitting = 0
+        self._submit_cond = threading.Condition()
+        self._spill_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._stats = {'enqueued': 0, 'written': 0, 'batches': 0, 'spilled': 0, 'replayed': 0, 'quarantined': 0,
+                       'blocked': 0}
+
+        # 前回の書き戻し中に停止した場合は、書き戻し済みの分を除いてスピルファイルへ戻す
+        if os.path.exists(self._replay_path):
+            done = self._replay_progress()
+            with open(self._replay_path, encoding='utf-8') as src, open(self.spill_path, 'a', encoding='utf-8') as dst:
+                for line in [line for line in src if line.strip()][done:]:
+                    dst.write(line)
+            os.remove(self._replay_path)
+        if os.path.exists(self._progress_path):
+            os.remove(self._progress_path)
+
+        self._thread = threading.Thread(target=self._run, name='conversation-writer', daemon=True)
+        self._thread.start()
+        logger.info(f"会話ログの非同期書き込みを開始しました - バッチサイズ: {batch_size}, 間隔: {flush_interval}秒")
+
+    def _count(self, key: str, value: int = 1):
+        with self._stats_lock:
+            self._stats[key] += value
+
+    def submit(self, record: dict):
+        """記録をキューへ追加（満杯の場合は一定時間待機し、それでも空かなければスピルファイルへ退避）"""
+        record.setdefault('created_at', datetime.now())
+        with self._submit_cond:
+            stopped = self._stop.is_set()
+            if not stopped:
+                self._submitting += 1
+        if stopped:
+            # 停止後に届いた記録はその場で書き込む
+            self._flush([record])
+            return
+        try:
+            try:
+                self._queue.put_nowait(record)
+            except queue.Full:
+                self._count('blocked')
+                try:
+                    self._queue.put(record, timeout=self.put_timeout)
+                except queue.Full:
+                    logger.warning("書き込みキューが満杯のため、会話ログをスピルファイルへ退避します")
+                    self._spill([record])
+                    return
+            self._count('enqueued')
+        finally:
+            with self._submit_cond:
+                self._submitting -= 1
+                if not self._submitting:
+                    self._submit_cond.notify_all()
+
+    def _run(self):
+        while not self._stop.is_set():
+            batch = self._collect(self.flush_interval)
+            if batch:
+                self._flush(batch)
+
+        # 停止時はキューに残った記録をすべて書き込む
+        while True:
+            batch = self._collect(0)
+            if not batch:
+                break
+            self._flush(batch)
+
+    def _collect(self, wait: float) -> list:
+        """バッチサイズに達するか、待機時間が経過するまで記録を集める"""
+        batch = []
+        deadline = time.monotonic() + wait
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining > 0:
+                    record = self._queue.get(timeout=remaining)
+                else:
+                    record = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if record is _WAKEUP:
+                # 待たずに、キューに残っている分だけ集める
+                deadline = time.monotonic()
+                continue
+            batch.append(record)
+        return batch
+
+    def _drain(self) -> list:
+        """キューに残っている記録をすべて取り出す"""
+        records = []
+        while True:
+            try:
+                record = self._queue.get_nowait()
+            except queue.Empty:
+                return records
+            if record is not _WAKEUP:
+                records.append(record)
+
+    def _flush(self, batch: list):
+        processed, written = self._write(batch)
+        self._count('written', written)
+        if processed < len(batch):
+            logger.error(f"会話ログを書き込めなかったため、{len(batch) - processed}件をスピルファイルへ退避します")
+            self._spill(batch[processed:])
+            return
+
+        self._count('batches')
+        self._replay_spill()
+
+    def _write(self, batch: list) -> tuple:
+        """
+        記録を一括で書き込み、(処理を終えた件数, 書き込んだ件数)を返す
+        内容の問題で失敗した場合は1件ずつ書き込み、それでも書き込めない記録は隔離ファイルへ移す
+        接続障害など内容以外の理由で失敗した場合は、その記録以降を処理せずに戻る
+        """
+        try:
+            self.flush_batch(batch)
+            return len(batch), len(batch)
+        except Exception as e:
+            if not self.is_data_error(e):
+                logger.error(f"会話ログの一括書き込みに失敗しました: {str(e)}")
+                return 0, 0
+            logger.warning(f"書き込めない記録を含むため、{len(batch)}件を1件ずつ書き込みます: {str(e)}")
+
+        written = 0
+        for i, record in enumerate(batch):
+            try:
+                self.flush_batch([record])
+                written += 1
+            except Exception as e:
+                if not self.is_data_error(e):
+                    logger.error(f"会話ログの書き込みに失敗しました: {str(e)}")
+                    return i, written
+                self._quarantine(record, e)
+        return len(batch), written
+
+    def _quarantine(self, record: dict, error: Exception):
+        row = dict(record)
+        row['created_at'] = row['created_at'].isoformat()
+        row['error'] = str(error)
+        with self._spill_lock:
+            with open(self.quarantine_path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(row, ensure_ascii=False) + '\n')
+        self._count('quarantined')
+        logger.error(f"書き込めない会話ログを隔離しました（{self.quarantine_path}） - ユーザー: {record.get('user_id')}, "
+                     f"{str(error)}")
+
+    def _spill(self, records: list):
+        """書き込めなかった記録をローカルファイルへ追記する"""
+        self._write_spill(records)
+        self._count('spilled', len(records))
+
+    def _write_spill(self, records: list):
+        with self._spill_lock:
+            with open(self.spill_path, 'a', encoding='utf-8') as f:
+                for record in records:
+                    row = dict(record)
+                    row['created_at'] = row['created_at'].isoformat()
+                    f.write(json.dumps(row, ensure_ascii=False) + '\n')
+
+    def _replay_spill(self):
+        """データベースが復旧したらスピルファイルの記録を書き戻す"""
+        with self._spill_lock:
+            if not os.path.exists(self.spill_path):
+                return
+            os.replace(self.spill_path, self._replay_path)
+
+        with open(self._replay_path, encoding='utf-8') as f:
+            records = [json.loads(line) for line in f if line.strip()]
+        for record in records:
+            record['created_at'] = datetime.fromisoformat(record['created_at'])
+
+        done = replayed = 0
+        while done < len(records):
+            chunk = records[done:done + self.batch_size]
+            processed, written = self._write(chunk)
+            done += processed
+            replayed += written
+            # 途中で停止しても、次回の起動時に書き戻し済みの記録を再度書き込まないよう進捗を残す
+            self._save_replay_progress(done)
+            if processed < len(chunk):
+                break
+        if done < len(records):
+            # 書き戻せなかった残りはスピルファイルへ戻す
+            logger.error(f"スピルファイルの書き戻しを中断しました（残り{len(records) - done}件）")
+            self._write_spill(records[done:])
+        else:
+            logger.info(f"スピルファイルから{replayed}件の会話ログを書き戻しました")
+        self._count('replayed', replayed)
+        os.remove(self._replay_path)
+        if os.path.exists(self._progress_path):
+            os.remove(self._progress_path)
+
+    def _replay_progress(self) -> int:
+        try:
+            with open(self._progress_path, encoding='utf-8') as f:
+                return int(f.read().strip() or 0)
+        except (OSError, ValueError):
+            return 0
+
+    def _save_replay_progress(self, done: int):
+        tmp_path = f"{self._progress_path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(str(done))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self._progress_path)
+
+    def get_stats(self) -> dict:
+        """書き込みキューの状況を取得"""
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats['queue_depth'] = self._queue.qsize()
+        return stats
+
+    def close(self, timeout: float = 10.0):
+        """新規受付を止め、残りの記録を書き込んでからスレッドを終了する"""
+        deadline = time.monotonic() + timeout
+        with self._submit_cond:
+            self._stop.set()
+            # 停止前に受け付けた記録がキューへ入り終わるまで待つ（満杯の場合もput_timeout秒で退避される）
+            self._submit_cond.wait_for(lambda: not self._submitting, self.put_timeout)
+        try:
+            # flush_intervalの待機中でもすぐに残りの書き込みへ移る（満杯なら待機していないため不要）
+            self._queue.put_nowait(_WAKEUP)
+        except queue.Full:
+            pass
+        self._thread.join(max(0.0, deadline - time.monotonic()))
+        if self._thread.is_alive():
+            # 書き込みが終わらない分は失わないようスピルファイルへ退避し、次回の起動後に書き戻す
+            remaining = self._drain()
+            logger.warning(f"会話ログの書き込みが時間内に完了しませんでした（{len(remaining)}件をスピルファイルへ退避）")
+            if remaining:
+                self._spill(remaining)
+        else:
+            logger.info("会話ログの書き込みキューをフラッシュしました")
@@ -0,0 +1,195 @@
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import psycopg2
+from utils.logger import setup_logger
+
+logger = setup_logger()
+
+class PoolTimeoutError(Exception):
+    """Raised when no database connection becomes available in time"""
+
+class ConnectionPool:
+    """Bounded, thread-safe psycopg2 connection pool with health checks on checkout"""
+
+    def __init__(self, db_url: str, min_size: int = 1, max_size: int = 10, checkout_timeout: float = 10.0,
+                 healthcheck_idle: float = 30.0):
+        if min_size < 0 or max_size < 1 or min_size > max_size:
+            raise ValueError("接続プールのサイズ設定が不正です")
+        self.db_url = db_url
+        self.min_size = min_size
+        self.max_size = max_size
+        self.checkout_timeout = checkout_timeout
+        self.healthcheck_idle = healthcheck_idle
+
+        self._idle = []  # (connection, 最終返却時刻)
+        self._size = 0
+        self._closed = False
+        self._cond = threading.Condition()
+
+        # 待ち時間メトリクス
+        self._checkouts = 0
+        self._total_wait = 0.0
+        self._max_wait = 0.0
+        self._timeouts = 0
+        self._recycled = 0
+
+    def open(self):
+        """
+        min_size本になるまで接続を並列に作成する（起動時の暖機用。作成済みの分は作らない）
+        呼び出さない場合も接続は必要になった時点で作成される
+        """
+        with self._cond:
+            missing = max(0, self.min_size - self._size)
+            self._size += missing
+        if not missing:
+            return
+        with ThreadPoolExecutor(max_workers=missing) as executor:
+            futures = [executor.submit(self._connect) for _ in range(missing)]
+        errors = []
+        with self._cond:
+            for future in futures:
+                if future.exception() is not None:
+                    self._size -= 1
+                    errors.append(future.exception())
+                else:
+                    self._idle.append((future.result(), time.monotonic()))
+            self._cond.notify_all()
+        if errors:
+            raise errors[0]
+
+    def _connect(self):
+        return psycopg2.connect(self.db_url)
+
+    def _is_healthy(self, conn, idle_since: float) -> bool:
+        """切断済みの接続、または一定時間アイドルだった接続を検査する"""
+        if conn.closed:
+            return False
+        if time.monotonic() - idle_since < self.healthcheck_idle:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _discard(self, conn):
+        """壊れた接続を破棄し、プールの枠を解放する"""
+        try:
+            conn.close()
+        except Exception:
+            pass
+        with self._cond:
+            self._size -= 1
+            self._recycled += 1
+            self._cond.notify()
+
+    def getconn(self):
+        """プールから接続を取得（空きがなければタイムアウトまで待機）"""
+        start = time.monotonic()
+        deadline = start + self.checkout_timeout
+        while True:
+            with self._cond:
+                while True:
+                    if self._closed:
+                        raise PoolTimeoutError("接続プールは閉じられています")
+                    if self._idle:
+                        conn, idle_since = self._idle.pop()
+                        create = False
+                        break
+                    if self._size < self.max_size:
+                        self._size += 1
+                        conn, idle_since = None, None
+                        create = True
+                        break
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._timeouts += 1
+                        logger.warning(f"データベース接続の取得がタイムアウトしました（{self.checkout_timeout}秒）")
+                        raise PoolTimeoutError("データベース接続の取得がタイムアウトしました")
+                    self._cond.wait(remaining)
+
+            # 接続の作成・ヘルスチェックはロックの外で行う
+            if create:
+                try:
+                    conn = self._connect()
+                except Exception:
+                    with self._cond:
+                        self._size -= 1
+                        self._cond.notify()
+                    raise
+            elif not self._is_healthy(conn, idle_since):
+                logger.warning("不正な接続を検出したため再作成します")
+                self._discard(conn)
+                continue
+
+            wait = time.monotonic() - start
+            with self._cond:
+                self._checkouts += 1
+                self._total_wait += wait
+                self._max_wait = max(self._max_wait, wait)
+            return conn
+
+    def putconn(self, conn, broken: bool = False):
+        """接続をプールへ返却（壊れている場合は破棄）"""
+        if broken or conn.closed:
+            self._discard(conn)
+            return
+        with self._cond:
+            if self._closed:
+                conn.close()
+                self._size -= 1
+                return
+            self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self):
+        """接続を取得し、正常終了時はコミット、例外時はロールバックして返却する"""
+        conn = self.getconn()
+        broken = False
+        try:
+            yield conn
+            conn.commit()
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            broken = True
+            raise
+        except Exception:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                broken = True
+            raise
+        finally:
+            self.putconn(conn, broken=broken)
+
+    def get_stats(self) -> dict:
+        """プールの使用状況と待ち時間メトリクスを取得"""
+        with self._cond:
+            return {
+                'size': self._size,
+                'idle': len(self._idle),
+                'in_use': self._size - len(self._idle),
+                'max_size': self.max_size,
+                'checkouts': self._checkouts,
+                'avg_wait': self._total_wait / self._checkouts if self._checkouts else 0.0,
+                'max_wait': self._max_wait,
+                'timeouts': self._timeouts,
+                'recycled': self._recycled
+            }
+
+    def close(self):
+        """アイドル接続をすべて閉じ、以降の取得を拒否する"""
+        with self._cond:
+            self._closed = True
+            for conn, _ in self._idle:
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+                self._size -= 1
+            self._idle.clear()
+            self._cond.notify_all()
@@ -1,13 +1,69 @@
 import os
 import json
+import socket
 import requests
-from typing import Optional
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterator, Optional
 from datetime import datetime
-from utils.logger import setup_logger
-from .errors import DifyAPIError, DifyTimeoutError, DifyConnectionError, DifyResponseError
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
+from urllib3.util.retry import Retry
+from utils.logger import setup_logger, LazyJson
+from utils.metrics import DIFY_LATENCY
+from .errors import DifyAPIError, DifyTimeoutError, DifyConnectionError, DifyResponseError, DifyConversationNotFoundError
+from .resilience import CircuitBreaker, CircuitOpenError, AdaptiveTimeout
 
 logger = setup_logger()
 
+class KeepAliveHTTPAdapter(HTTPAdapter):
+    """HTTPAdapter that enables TCP keep-alive on pooled sockets"""
+
+    def __init__(self, keepalive: bool = True, **kwargs):
+        self.keepalive = keepalive
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        if self.keepalive:
+            kwargs['socket_options'] = HTTPConnection.default_socket_options + [
+                (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            ]
+        super().init_poolmanager(*args, **kwargs)
+
+def create_circuit_breaker() -> CircuitBreaker:
+    """環境変数の設定からDify API用のサーキットブレーカーを作成"""
+    return CircuitBreaker(
+        'dify',
+        failure_rate_threshold=float(os.environ.get('DIFY_BREAKER_FAILURE_RATE', '0.5')),
+        window_size=int(os.environ.get('DIFY_BREAKER_WINDOW', '20')),
+        min_calls=int(os.environ.get('DIFY_BREAKER_MIN_CALLS', '10')),
+        open_duration=float(os.environ.get('DIFY_BREAKER_OPEN_SECONDS', '30'))
+    )
+
+def create_adaptive_timeout(read_timeout: float) -> Optional[AdaptiveTimeout]:
+    """DIFY_ADAPTIVE_TIMEOUT=true の場合に観測レイテンシから読み取りタイムアウトを決める"""
+    if os.environ.get('DIFY_ADAPTIVE_TIMEOUT', 'false').lower() != 'true':
+        return None
+    return AdaptiveTimeout(
+        default=read_timeout,
+        minimum=float(os.environ.get('DIFY_TIMEOUT_MIN', '15')),
+        maximum=read_timeout,
+        percentile=float(os.environ.get('DIFY_TIMEOUT_PERCENTILE', '0.99')),
+        multiplier=float(os.environ.get('DIFY_TIMEOUT_MULTIPLIER', '1.5'))
+    )
+
+def is_conversation_not_found(error: requests.exceptions.RequestException, conversation_id: Optional[str]) -> bool:
+    """指定した会話IDがDify側に存在しない（削除済み・別ユーザーの会話など）場合のエラーか"""
+    return bool(conversation_id) and isinstance(error, requests.exceptions.HTTPError) \
+        and error.response is not None and error.response.status_code == 404
+
+def is_upstream_failure(error: requests.exceptions.RequestException) -> bool:
+    """タイムアウト・接続エラー・5xxをDify側の障害とみなす"""
+    if isinstance(error, requests.exceptions.HTTPError):
+        return error.response is not None and error.response.status_code >= 500
+    if isinstance(error, requests.exceptions.InvalidJSONError):
+        return False
+    return True
+
 class DifyService:
     """Service class for interacting with Dify API"""
 
@@ -24,11 +80,120 @@ class DifyService:
             'Authorization': f'Bearer {api_key}',
             'Content-Type': 'application/json'
         }
-        self.timeout = 30
+        self.connect_timeout = float(os.environ.get('DIFY_CONNECT_TIMEOUT', '5'))
+        self.read_timeout = float(os.environ.get('DIFY_READ_TIMEOUT', '30'))
+        self.timeout = (self.connect_timeout, self.read_timeout)
+        self.session = self._create_session()
+        self.breaker = create_circuit_breaker()
+        self.adaptive_timeout = create_adaptive_timeout(self.read_timeout)
+
+    def _create_session(self) -> requests.Session:
+        """接続プール付きのHTTPセッションを作成"""
+        pool_size = int(os.environ.get('DIFY_POOL_SIZE', '10'))
+        keepalive = os.environ.get('DIFY_KEEPALIVE', 'true').lower() == 'true'
+        max_retries = int(os.environ.get('DIFY_MAX_RETRIES', '2'))
+
+        # 接続確立前の失敗はPOSTでも再試行し、読み取り・ステータスの再試行は冪等メソッドに限定
+        retry = Retry(
+            total=max_retries,
+            connect=max_retries,
+            read=max_retries,
+            status=max_retries,
+            other=0,
+            allowed_methods=frozenset(['GET', 'HEAD', 'OPTIONS']),
+            status_forcelist=(502, 503, 504),
+            backoff_factor=float(os.environ.get('DIFY_RETRY_BACKOFF', '0.5')),
+            backoff_jitter=float(os.environ.get('DIFY_RETRY_JITTER', '0.5')),
+            raise_on_status=False
+        )
+        adapter = KeepAliveHTTPAdapter(
+            keepalive=keepalive,
+            pool_connections=pool_size,
+            pool_maxsize=pool_size,
+            max_retries=retry
+        )
+
+        session = requests.Session()
+        session.headers.update(self.headers)
+        if not keepalive:
+            session.headers['Connection'] = 'close'
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        logger.info(f"Dify HTTPセッションを作成しました - プールサイズ: {pool_size}, keep-alive: {keepalive}")
+        return session
+
+    def get_pool_stats(self) -> dict:
+        """接続プールの再利用状況を取得"""
+        requests_count = 0
+        new_connections = 0
+        for adapter in set(self.session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools.get(key)
+                if pool is None:
+                    continue
+                requests_count += pool.num_requests
+                new_connections += pool.num_connections
+
+        return {
+            'requests': requests_count,
+            'hits': max(requests_count - new_connections, 0),
+            'misses': new_connections
+        }
+
+    def close(self):
+        """HTTPセッションを閉じる"""
+        self.session.close()
+
+    def warm_up(self, connections: int = 2) -> int:
+        """
+        起動時にDify APIへの接続（DNS解決・TCP/TLSハンドシェイク）を事前に確立し、接続プールに保持する
+        応答の内容は問わず、失敗してもサーキットブレーカーには記録しない。確立できた接続数を返す
+        """
+        if connections <= 0 or self.session.headers.get('Connection') == 'close':
+            return 0
+
+        def request() -> bool:
+            try:
+                with self.session.get(f"{self.base_url}/parameters", params={'user': 'warmup'},
+                                      timeout=self.timeout) as response:
+                    response.content
+                return True
+            except requests.exceptions.RequestException as e:
+                logger.warning(f"Dify APIへの事前接続に失敗しました: {str(e)}")
+                return False
+
+        with ThreadPoolExecutor(max_workers=connections) as executor:
+            warmed = sum(executor.map(lambda _: request(), range(connections)))
+        logger.info(f"Dify APIへの接続を事前に確立しました - {warmed}/{connections}本")
+        return warmed
+
+    def _check_circuit(self) -> bool:
+        """サーキットブレーカーが開いていれば接続エラーとして即座に失敗させる（半開状態の試行呼び出しならTrue）"""
+        try:
+            return self.breaker.before_call()
+        except CircuitOpenError as e:
+            logger.warning(f"Dify APIへの呼び出しを遮断しました: {str(e)}")
+            raise DifyConnectionError(e)
+
+    def _record_outcome(self, failed: bool, response_time: float = None):
+        if failed:
+            self.breaker.record_failure()
+            return
+        self.breaker.record_success()
+        if response_time is not None and self.adaptive_timeout:
+            self.adaptive_timeout.observe(response_time)
 
-    def get_response(self, query: str, user: str, conversation_id: Optional[str] = None) -> str:
+    def current_timeout(self, probe: bool = False) -> tuple:
+        """現在の（接続, 読み取り）タイムアウト。ブレーカーの試行呼び出しでは設定値をそのまま使う"""
+        read_timeout = self.adaptive_timeout.current() if self.adaptive_timeout and not probe else self.read_timeout
+        return (self.connect_timeout, read_timeout)
+
+    def get_response(self, query: str, user: str, conversation_id: Optional[str] = None,
+                     on_conversation: Optional[Callable[[str], None]] = None) -> str:
         """
         Get response from Dify API with enhanced error handling and monitoring
+        on_conversation: 応答に含まれる会話IDを受け取る関数（新しい会話で払い出されたIDの記録に使用）
         """
         if not query:
             logger.error("空のクエリを受信")
@@ -43,25 +208,28 @@ class DifyService:
             'conversation_id': conversation_id if conversation_id else ''
         }
 
+        probe = self._check_circuit()
+        timeout = self.current_timeout(probe)
+        failed = False
         start_time = datetime.now()
         try:
             logger.info(f"Dify APIリクエスト開始 - ユーザー: {user}")
-            logger.debug(f"API URL: {self.base_url}/chat-messages")
-            logger.debug(f"Request Headers: {self.headers}")
-            logger.debug(f"Request Data: {json.dumps(data, ensure_ascii=False, indent=2)}")
+            logger.debug("API URL: %s/chat-messages", self.base_url)
+            logger.debug("Request Data: %s", LazyJson(data, indent=2))
 
             # Chat Message APIエンドポイントにリクエスト
-            response = requests.post(
+            response = self.session.post(
                 f"{self.base_url}/chat-messages",
-                headers=self.headers,
                 data=json.dumps(data),
-                timeout=self.timeout
+                timeout=timeout
             )
 
-            logger.debug(f"APIレスポンス状態コード: {response.status_code}")
+            logger.debug("APIレスポンス状態コード: %s", response.status_code)
             response.raise_for_status()
             response_data = response.json()
-            logger.debug(f"APIレスポンス: {response_data}")
+            logger.debug("APIレスポンス: %s", LazyJson(response_data))
+            if on_conversation and response_data.get('conversation_id'):
+                on_conversation(response_data['conversation_id'])
 
             if 'answer' in response_data:
                 return response_data['answer']
@@ -72,12 +240,19 @@ class DifyService:
                 raise DifyResponseError(response_data)
 
         except requests.exceptions.Timeout:
-            logger.error("Dify APIリクエストがタイムアウト")
+            failed = True
+            logger.error(f"Dify APIリクエストがタイムアウト（{timeout[1]:.1f}秒）")
+            if self.adaptive_timeout:
+                self.adaptive_timeout.observe_timeout(timeout[1])
             raise DifyTimeoutError()
 
         except requests.exceptions.RequestException as e:
+            failed = is_upstream_failure(e)
+            if is_conversation_not_found(e, conversation_id):
+                logger.warning(f"Difyの会話が見つかりません - 会話ID: {conversation_id}")
+                raise DifyConversationNotFoundError(conversation_id, e)
             logger.error(f"Dify APIリクエストエラー: {str(e)}")
-            logger.debug(f"詳細なエラー情報: {e.__class__.__name__}, {e.args}")
+            logger.debug("詳細なエラー情報: %s, %s", e.__class__.__name__, e.args)
             raise DifyConnectionError(e)
 
         except Exception as e:
@@ -86,20 +261,103 @@ class DifyService:
 
         finally:
             response_time = (datetime.now() - start_time).total_seconds()
-            if response_time > self.timeout * 0.8:
+            self._record_outcome(failed, response_time)
+            DIFY_LATENCY.labels('blocking').observe(response_time)
+            if response_time > timeout[1] * 0.8:
                 logger.warning(f"応答時間が長い: {response_time:.2f}秒")
 
+    def stream_response(self, query: str, user: str, conversation_id: Optional[str] = None,
+                        on_conversation: Optional[Callable[[str], None]] = None) -> Iterator[str]:
+        """
+        Stream response chunks from Dify API (response_mode: streaming)
+        on_conversation: 最初のイベントに含まれる会話IDを受け取る関数
+        """
+        if not query:
+            logger.error("空のクエリを受信")
+            raise ValueError("クエリが空です")
+
+        data = {
+            'inputs': {},
+            'query': query,
+            'user': user,
+            'response_mode': 'streaming',
+            'conversation_id': conversation_id if conversation_id else ''
+        }
+
+        self._check_circuit()
+        failed = False
+        start_time = datetime.now()
+        try:
+            logger.info(f"Dify APIストリーミングリクエスト開始 - ユーザー: {user}")
+            with self.session.post(
+                f"{self.base_url}/chat-messages",
+                data=json.dumps(data),
+                timeout=self.timeout,
+                stream=True
+            ) as response:
+                logger.debug("APIレスポンス状態コード: %s", response.status_code)
+                response.raise_for_status()
+                # SSEは常にUTF-8（Content-Typeにcharsetがない場合のISO-8859-1扱いを避ける）
+                response.encoding = 'utf-8'
+
+                for line in response.iter_lines(decode_unicode=True):
+                    # SSEのdata行のみを処理（空行・ping等は無視）
+                    if not line or not line.startswith('data:'):
+                        continue
+                    event = json.loads(line[len('data:'):].strip())
+                    event_type = event.get('event')
+                    if on_conversation and event.get('conversation_id'):
+                        on_conversation(event['conversation_id'])
+                        on_conversation = None
+
+                    if event_type in ('message', 'agent_message'):
+                        chunk = event.get('answer', '')
+                        if chunk:
+                            yield chunk
+                    elif event_type == 'message_end':
+                        return
+                    elif event_type == 'error':
+                        logger.warning(f"ストリーミング中のエラーイベント: {event}")
+                        raise DifyResponseError(event)
+
+        except DifyAPIError:
+            raise
+
+        except requests.exceptions.Timeout:
+            failed = True
+            logger.error("Dify APIストリーミングリクエストがタイムアウト")
+            raise DifyTimeoutError()
+
+        except requests.exceptions.RequestException as e:
+            failed = is_upstream_failure(e)
+            if is_conversation_not_found(e, conversation_id):
+                logger.warning(f"Difyの会話が見つかりません - 会話ID: {conversation_id}")
+                raise DifyConversationNotFoundError(conversation_id, e)
+            logger.error(f"Dify APIストリーミングリクエストエラー: {str(e)}")
+            raise DifyConnectionError(e)
+
+        except Exception as e:
+            logger.error(f"予期しないエラー: {str(e)}")
+            raise DifyAPIError(f"予期しないエラーが発生しました: {str(e)}", e)
+
+        finally:
+            # ストリーミングの所要時間は生成長に依存するため、適応タイムアウトの観測には含めない
+            self._record_outcome(failed)
+            response_time = (datetime.now() - start_time).total_seconds()
+            DIFY_LATENCY.labels('streaming').observe(response_time)
+            if response_time > self.read_timeout * 0.8:
+                logger.warning(f"ストリーミング応答時間が長い: {response_time:.2f}秒")
+
     def get_conversation_history(self, user: str, conversation_id: str) -> list:
         """会話履歴を取得"""
         try:
-            response = requests.get(
+            response = self.session.get(
                 f"{self.base_url}/messages",
                 params={'conversation_id': conversation_id},
-                headers=self.headers,
                 timeout=self.timeout
             )
             response.raise_for_status()
             return response.json().get('data', [])
         except Exception as e:
             logger.error(f"会話履歴の取得に失敗: {str(e)}")
-            raise DifyAPIError("会話履歴の取得に失敗しました", e)
\ No newline at end of file
+            raise DifyAPIError("会話履歴の取得に失敗しました", e)
@@ -24,3 +24,15 @@ class DifyResponseError(DifyAPIError):
         if response_data:
             message += f" 詳細: {response_data}"
         super().__init__(message)
+
+class DifyConversationNotFoundError(DifyAPIError):
+    """Raised when Dify no longer knows the conversation_id sent with a request"""
+    def __init__(self, conversation_id: str, original_error: Exception = None):
+        self.conversation_id = conversation_id
+        super().__init__(f"会話が見つかりません: {conversation_id}", original_error)
+
+class SchedulerBusyError(Exception):
+    """Raised when a Dify call is shed by admission control"""
+    def __init__(self, reason: str = "混雑しています"):
+        self.reason = reason
+        super().__init__(f"リクエストを受け付けられませんでした: {reason}")
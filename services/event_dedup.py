@@ -0,0 +1,155 @@
+import time
+import threading
+from collections import OrderedDict
+from utils.logger import setup_logger
+from utils.metrics import EVENTS_DEDUPLICATED
+
+logger = setup_logger()
+
+_CLAIM_SQL = """
+    INSERT INTO processed_events (event_key, expires_at)
+    SELECT unnest({keys}::text[]), now() + {ttl} * interval '1 second'
+    ON CONFLICT (event_key) DO UPDATE SET expires_at = EXCLUDED.expires_at
+    WHERE processed_events.expires_at <= now()
+    RETURNING event_key
+"""
+_PURGE_SQL = "DELETE FROM processed_events WHERE expires_at <= now()"
+
+def event_keys(event_id: str, channel: str, ts: str) -> list:
+    """再送判定に使うキー（イベントIDとメッセージのts）"""
+    keys = []
+    if event_id:
+        keys.append(f"event:{event_id}")
+    if channel and ts:
+        keys.append(f"msg:{channel}:{ts}")
+    return keys
+
+class PostgresDedupBackend:
+    """Processed-event store shared between processes via the processed_events table"""
+
+    def __init__(self, pool):
+        self.pool = pool
+
+    def claim(self, keys: list, ttl: float) -> bool:
+        """すべてのキーを新規に登録できた場合のみTrue（期限切れのキーは再利用する）"""
+        with self.pool.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(_CLAIM_SQL.format(keys='%s', ttl='%s'), (keys, ttl))
+                return len(cur.fetchall()) == len(keys)
+
+    def purge(self):
+        with self.pool.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(_PURGE_SQL)
+
+class AsyncPostgresDedupBackend:
+    """asyncpg counterpart of PostgresDedupBackend"""
+
+    def __init__(self, pool):
+        self.pool = pool
+
+    async def claim(self, keys: list, ttl: float) -> bool:
+        async with self.pool.acquire() as conn:
+            rows = await conn.fetch(_CLAIM_SQL.format(keys='$1', ttl='$2::float8'), keys, ttl)
+            return len(rows) == len(keys)
+
+    async def purge(self):
+        async with self.pool.acquire() as conn:
+            await conn.execute(_PURGE_SQL)
+
+class EventDeduplicator:
+    """Drops redelivered Slack events using a bounded TTL set, optionally backed by Postgres"""
+
+    def __init__(self, ttl: float = 600.0, max_entries: int = 10000, backend=None, purge_interval: float = 60.0):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.backend = backend
+        self.purge_interval = purge_interval
+
+        self._seen = OrderedDict()  # key -> expires_at（登録順 = 期限順）
+        self._lock = threading.Lock()
+        self._last_purge = time.monotonic()
+        self._stats = {'checked': 0, 'suppressed': 0, 'evictions': 0, 'backend_errors': 0}
+
+    def _claim_local(self, keys: list) -> bool:
+        """ローカルで未登録ならキーを登録してTrue（判定と登録は同時に行う）"""
+        now = time.monotonic()
+        with self._lock:
+            self._stats['checked'] += 1
+            while self._seen:
+                key, expires_at = next(iter(self._seen.items()))
+                if expires_at > now:
+                    break
+                del self._seen[key]
+            if any(key in self._seen for key in keys):
+                return False
+
+            for key in keys:
+                self._seen[key] = now + self.ttl
+            while len(self._seen) > self.max_entries:
+                self._seen.popitem(last=False)
+                self._stats['evictions'] += 1
+            return True
+
+    def _suppressed(self, keys: list, source: str) -> bool:
+        with self._lock:
+            self._stats['suppressed'] += 1
+            total = self._stats['suppressed']
+        EVENTS_DEDUPLICATED.inc()
+        logger.info(f"再送イベントを破棄しました（{source}） - キー: {', '.join(keys)}, 累計: {total}件")
+        return False
+
+    def _should_purge(self) -> bool:
+        now = time.monotonic()
+        with self._lock:
+            if now - self._last_purge < self.purge_interval:
+                return False
+            self._last_purge = now
+            return True
+
+    def claim(self, event_id: str, channel: str, ts: str) -> bool:
+        """初めて見るイベントならTrue、再送ならFalseを返す（共有ストア障害時は処理を続行する）"""
+        keys = event_keys(event_id, channel, ts)
+        if not keys:
+            return True
+        if not self._claim_local(keys):
+            return self._suppressed(keys, 'ローカル')
+
+        if self.backend:
+            try:
+                if self._should_purge():
+                    self.backend.purge()
+                if not self.backend.claim(keys, self.ttl):
+                    return self._suppressed(keys, '共有ストア')
+            except Exception as e:
+                logger.warning(f"共有イベントストアの参照に失敗しました: {str(e)}")
+                with self._lock:
+                    self._stats['backend_errors'] += 1
+        return True
+
+    async def claim_async(self, event_id: str, channel: str, ts: str) -> bool:
+        """claimの非同期版（AsyncPostgresDedupBackendを使用）"""
+        keys = event_keys(event_id, channel, ts)
+        if not keys:
+            return True
+        if not self._claim_local(keys):
+            return self._suppressed(keys, 'ローカル')
+
+        if self.backend:
+            try:
+                if self._should_purge():
+                    await self.backend.purge()
+                if not await self.backend.claim(keys, self.ttl):
+                    return self._suppressed(keys, '共有ストア')
+            except Exception as e:
+                logger.warning(f"共有イベントストアの参照に失敗しました: {str(e)}")
+                with self._lock:
+                    self._stats['backend_errors'] += 1
+        return True
+
+    def get_stats(self) -> dict:
+        """判定件数と破棄した再送イベント数を取得"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats['entries'] = len(self._seen)
+        return stats
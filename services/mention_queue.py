@@ -0,0 +1,505 @@
+import os
+import json
+import time
+import socket
+import select
+import asyncio
+import threading
+import psycopg2
+from psycopg2.extras import Json
+from utils.logger import setup_logger
+from utils.metrics import MENTION_JOBS
+
+logger = setup_logger()
+
+# 登録時に通知するチャンネル（各レプリカの待機中ワーカーを起こす）
+NOTIFY_CHANNEL = 'mention_jobs'
+
+_ENQUEUE_SQL = """
+    WITH job AS (
+        INSERT INTO mention_jobs (event_key, payload)
+        VALUES ({key}, {payload})
+        ON CONFLICT (event_key) DO NOTHING
+        RETURNING id
+    )
+    SELECT id, pg_notify('mention_jobs', id::text) FROM job
+"""
+# 未処理のジョブ、またはリース切れ（処理中のレプリカが停止した）ジョブを1件取得する
+_CLAIM_SQL = """
+    UPDATE mention_jobs
+    SET status = 'running', attempts = attempts + 1, locked_by = {replica},
+        locked_until = now() + {lease} * interval '1 second'
+    WHERE id = (
+        SELECT id FROM mention_jobs
+        WHERE status = 'pending'
+           OR (status = 'running' AND locked_until <= now() AND attempts < {max_attempts})
+        ORDER BY id
+        LIMIT 1
+        FOR UPDATE SKIP LOCKED
+    )
+    RETURNING id, payload, attempts
+"""
+# 処理中のジョブのリースを延長する（このレプリカが保持していないジョブは返らない）
+_EXTEND_SQL = """
+    UPDATE mention_jobs SET locked_until = now() + {lease} * interval '1 second'
+    WHERE id = ANY({ids}) AND locked_by = {replica} AND status = 'running'
+    RETURNING id
+"""
+_COMPLETE_SQL = """
+    UPDATE mention_jobs SET status = 'done', finished_at = now(), locked_until = NULL
+    WHERE id = {id} AND locked_by = {replica} AND status = 'running'
+    RETURNING id
+"""
+# 処理に失敗したジョブを再試行の上限までは未処理に戻し、上限に達していれば失敗とする
+_FAIL_SQL = """
+    UPDATE mention_jobs
+    SET status = CASE WHEN attempts < {max_attempts} THEN 'pending' ELSE 'failed' END,
+        finished_at = CASE WHEN attempts < {max_attempts} THEN NULL ELSE now() END,
+        locked_until = NULL
+    WHERE id = {id} AND locked_by = {replica} AND status = 'running'
+    RETURNING status
+"""
+_EXPIRE_SQL = """
+    UPDATE mention_jobs SET status = 'failed', finished_at = now(), locked_until = NULL
+    WHERE status = 'running' AND locked_until <= now() AND attempts >= {max_attempts}
+    RETURNING event_key
+"""
+_PURGE_SQL = """
+    DELETE FROM mention_jobs
+    WHERE status IN ('done', 'failed') AND finished_at <= now() - {retention} * interval '1 second'
+"""
+
+def default_replica_id() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+class _MentionQueueBase:
+    def __init__(self, dsn: str, workers: int = 8, lease: float = 60.0, poll_interval: float = 5.0,
+                 max_attempts: int = 2, retention: float = 3600.0, replica_id: str = None):
+        """
+        workers: このレプリカで同時に処理するジョブ数
+        lease: 処理中のジョブを他のレプリカが引き継ぐまでの秒数（処理中はこの1/3の間隔で延長する）
+        poll_interval: 通知を受け取れなかった場合に備えてキューを確認する間隔
+        max_attempts: リース切れで引き継ぐ回数の上限（超えたジョブは失敗として破棄）
+        retention: 処理済みジョブを残しておく秒数
+        """
+        self.dsn = dsn
+        self.workers = workers
+        self.lease = lease
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.retention = retention
+        self.replica_id = replica_id or default_replica_id()
+
+        self.heartbeat_interval = lease / 3
+
+        self._last_purge = time.monotonic()
+        self._held = set()  # このレプリカが処理中のジョブID
+        self._stats_lock = threading.Lock()
+        self._stats = {'enqueued': 0, 'duplicates': 0, 'claimed': 0, 'reclaimed': 0, 'completed': 0,
+                       'retried': 0, 'failed': 0, 'expired': 0, 'lease_lost': 0, 'dropped_replies': 0,
+                       'errors': 0, 'notifications': 0, 'active': 0}
+
+    def _count(self, key: str, amount: int = 1):
+        with self._stats_lock:
+            self._stats[key] += amount
+
+    def _should_purge(self) -> bool:
+        now = time.monotonic()
+        with self._stats_lock:
+            if now - self._last_purge < self.poll_interval * 12:
+                return False
+            self._last_purge = now
+            return True
+
+    def _on_enqueued(self, inserted: bool, key: str) -> bool:
+        if inserted:
+            self._count('enqueued')
+            MENTION_JOBS.labels('enqueued').inc()
+        else:
+            self._count('duplicates')
+            MENTION_JOBS.labels('duplicate').inc()
+            logger.info(f"ジョブキューに登録済みのイベントのため破棄しました - キー: {key}")
+        return inserted
+
+    def _on_claimed(self, job_id: int, attempts: int):
+        self._count('claimed')
+        with self._stats_lock:
+            self._held.add(job_id)
+        if attempts > 1:
+            self._count('reclaimed')
+            MENTION_JOBS.labels('reclaimed').inc()
+            logger.warning(f"前回の処理が完了しなかったジョブを再度処理します - ID: {job_id}, 試行: {attempts}/{self.max_attempts}")
+
+    def _on_finished(self, job_id: int):
+        with self._stats_lock:
+            self._held.discard(job_id)
+
+    def _held_jobs(self) -> list:
+        with self._stats_lock:
+            return list(self._held)
+
+    def _on_extended(self, job_ids: list, extended: list):
+        """リースを延長できなかった（他のレプリカに引き継がれた）ジョブを記録する"""
+        with self._stats_lock:
+            lost = (set(job_ids) - set(extended)) & self._held
+            self._held -= lost
+        if lost:
+            self._count('lease_lost', len(lost))
+            logger.warning(f"処理中のジョブのリースが失われました（他のレプリカが引き継いだ可能性があります） - ID: "
+                           f"{', '.join(str(job_id) for job_id in sorted(lost))}")
+
+    def _on_owned(self, job_id: int, owned: bool) -> bool:
+        if not owned:
+            self._count('dropped_replies')
+            logger.warning(f"他のレプリカに引き継がれたジョブのため返信を見送りました - ID: {job_id}")
+        return owned
+
+    def _on_owns_error(self, job_id: int, error: Exception) -> bool:
+        # 保持を確認できない場合は、返信が重複する可能性よりも返信しないことを避ける
+        self._count('errors')
+        logger.warning(f"ジョブの保持を確認できないまま返信します - ID: {job_id}, {str(error)}")
+        return True
+
+    def _on_completed(self, job_id: int, completed: bool):
+        if completed:
+            self._count('completed')
+            MENTION_JOBS.labels('completed').inc()
+        else:
+            logger.info(f"他のレプリカに引き継がれたジョブのため完了を記録しませんでした - ID: {job_id}")
+
+    def _on_failed(self, job_id: int, status: str):
+        if status == 'pending':
+            self._count('retried')
+            MENTION_JOBS.labels('retried').inc()
+            logger.warning(f"処理に失敗したジョブを再試行します - ID: {job_id}")
+        elif status == 'failed':
+            self._count('failed')
+            MENTION_JOBS.labels('failed').inc()
+            logger.error(f"再試行の上限に達したため処理に失敗したジョブを破棄しました - ID: {job_id}")
+
+    def _on_expired(self, keys: list):
+        if keys:
+            self._count('expired', len(keys))
+            MENTION_JOBS.labels('expired').inc(len(keys))
+            logger.error(f"再試行の上限に達したジョブを破棄しました - キー: {', '.join(keys)}")
+
+    def get_stats(self) -> dict:
+        """ジョブの登録・処理件数と処理中のジョブ数を取得"""
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats['replica_id'] = self.replica_id
+        return stats
+
+class MentionQueue(_MentionQueueBase):
+    """Postgres-backed work queue (FOR UPDATE SKIP LOCKED) so exactly one replica handles each mention (psycopg2)"""
+
+    def __init__(self, pool, handler, **kwargs):
+        """
+        handler: ジョブのpayload（dict）と、返信の前に呼び出してジョブをまだ保持しているかを返す関数を受け取って処理する関数
+        （Falseが返った場合は他のレプリカに引き継がれているため返信しない）
+        """
+        super().__init__(pool.db_url, **kwargs)
+        self.pool = pool
+        self.handler = handler
+        self._wakeup = threading.Semaphore(0)
+        self._stop = threading.Event()
+        self._closed = threading.Event()
+        self._threads = []
+        self._heartbeat_thread = None
+
+    def enqueue(self, key: str, payload: dict) -> bool:
+        """ジョブを登録する（同じキーが登録済みならFalse）"""
+        with self.pool.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(_ENQUEUE_SQL.format(key='%s', payload='%s'), (key, Json(payload)))
+                inserted = cur.fetchone() is not None
+        return self._on_enqueued(inserted, key)
+
+    def start(self):
+        """ワーカーと通知の受信スレッドを開始する"""
+        self._threads = [threading.Thread(target=self._listen, name='mention-queue-listener', daemon=True)]
+        self._threads += [threading.Thread(target=self._work, name=f'mention-worker-{i}', daemon=True)
+                          for i in range(self.workers)]
+        self._heartbeat_thread = threading.Thread(target=self._heartbeat, name='mention-queue-heartbeat', daemon=True)
+        for thread in self._threads + [self._heartbeat_thread]:
+            thread.start()
+        logger.info(f"メンションのジョブキューを開始しました - レプリカ: {self.replica_id}, ワーカー: {self.workers}")
+
+    def close(self, timeout: float = 30.0):
+        """新しいジョブの取得を止め、処理中のジョブの完了を待つ（未処理のジョブは他のレプリカが処理する）"""
+        self._stop.set()
+        for _ in range(self.workers):
+            self._wakeup.release()
+        deadline = time.monotonic() + timeout
+        for thread in self._threads:
+            thread.join(max(0.0, deadline - time.monotonic()))
+        if any(thread.is_alive() for thread in self._threads[1:]):
+            logger.warning(f"処理中のジョブが終了しないままジョブキューを停止しました - {self.get_stats()['active']}件")
+        # 処理中のジョブが終わるまではリースを延長し続ける
+        self._closed.set()
+        if self._heartbeat_thread is not None:
+            self._heartbeat_thread.join(max(0.0, deadline - time.monotonic()))
+
+    def _claim(self):
+        with self.pool.connection() as conn:
+            with conn.cursor() as cur:
+                if self._should_purge():
+                    cur.execute(_EXPIRE_SQL.format(max_attempts='%s'), (self.max_attempts,))
+                    self._on_expired([row[0] for row in cur.fetchall()])
+                    cur.execute(_PURGE_SQL.format(retention='%s'), (self.retention,))
+                cur.execute(_CLAIM_SQL.format(replica='%s', lease='%s', max_attempts='%s'),
+                            (self.replica_id, self.lease, self.max_attempts))
+                return cur.fetchone()
+
+    def _complete(self, job_id: int) -> bool:
+        with self.pool.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(_COMPLETE_SQL.format(id='%s', replica='%s'), (job_id, self.replica_id))
+                return cur.fetchone() is not None
+
+    def _fail(self, job_id: int) -> str:
+        with self.pool.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(_FAIL_SQL.format(id='%s', replica='%s', max_attempts='%s'),
+                            (self.max_attempts, self.max_attempts, job_id, self.replica_id))
+                row = cur.fetchone()
+                return row[0] if row else None
+
+    def _extend(self, job_ids: list) -> list:
+        """リースを延長し、延長できた（このレプリカが保持している）ジョブIDを返す"""
+        with self.pool.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(_EXTEND_SQL.format(lease='%s', ids='%s', replica='%s'),
+                            (self.lease, job_ids, self.replica_id))
+                extended = [row[0] for row in cur.fetchall()]
+        self._on_extended(job_ids, extended)
+        return extended
+
+    def _owns(self, job_id: int) -> bool:
+        """返信の前にジョブをまだ保持しているかを確認する（保持していればリースも延長する）"""
+        try:
+            owned = bool(self._extend([job_id]))
+        except Exception as e:
+            return self._on_owns_error(job_id, e)
+        return self._on_owned(job_id, owned)
+
+    def _heartbeat(self):
+        """処理中のジョブのリースを定期的に延長し、処理が長引いても他のレプリカに引き継がれないようにする"""
+        while not self._closed.wait(self.heartbeat_interval):
+            job_ids = self._held_jobs()
+            if not job_ids:
+                continue
+            try:
+                self._extend(job_ids)
+            except Exception as e:
+                self._count('errors')
+                logger.error(f"ジョブのリースの延長に失敗しました: {str(e)}")
+
+    def _work(self):
+        while not self._stop.is_set():
+            try:
+                job = self._claim()
+            except Exception as e:
+                self._count('errors')
+                logger.error(f"ジョブの取得に失敗しました: {str(e)}")
+                self._stop.wait(self.poll_interval)
+                continue
+            if job is None:
+                # 登録の通知を待つ（通知を取りこぼした場合も一定間隔で確認する）
+                self._wakeup.acquire(timeout=self.poll_interval)
+                continue
+
+            job_id, payload, attempts = job
+            self._on_claimed(job_id, attempts)
+            self._count('active')
+            failed = False
+            try:
+                self.handler(payload, lambda: self._owns(job_id))
+            except Exception as e:
+                failed = True
+                logger.error(f"ジョブの処理中にエラーが発生しました - ID: {job_id}, {str(e)}")
+            finally:
+                self._count('active', -1)
+                self._on_finished(job_id)
+            try:
+                if failed:
+                    self._on_failed(job_id, self._fail(job_id))
+                else:
+                    self._on_completed(job_id, self._complete(job_id))
+            except Exception as e:
+                self._count('errors')
+                logger.error(f"ジョブの完了の記録に失敗しました - ID: {job_id}, {str(e)}")
+
+    def _listen(self):
+        """LISTENで他のレプリカ（自身を含む）の登録を受け取り、待機中のワーカーを起こす"""
+        while not self._stop.is_set():
+            conn = None
+            try:
+                conn = psycopg2.connect(self.dsn)
+                conn.autocommit = True
+                with conn.cursor() as cur:
+                    cur.execute(f"LISTEN {NOTIFY_CHANNEL}")
+                while not self._stop.is_set():
+                    if select.select([conn], [], [], 1.0) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        conn.notifies.pop(0)
+                        self._count('notifications')
+                        self._wakeup.release()
+            except Exception as e:
+                self._count('errors')
+                logger.warning(f"ジョブ登録の通知の受信に失敗しました（{self.poll_interval}秒間隔の確認で処理を続けます）: {str(e)}")
+                self._stop.wait(self.poll_interval)
+            finally:
+                if conn is not None:
+                    conn.close()
+
+class AsyncMentionQueue(_MentionQueueBase):
+    """asyncpg counterpart of MentionQueue"""
+
+    def __init__(self, pool, dsn: str, handler, **kwargs):
+        """
+        handler: ジョブのpayload（dict）と、返信の前に呼び出してジョブをまだ保持しているかを返すコルーチン関数を
+        受け取って処理するコルーチン関数
+        """
+        super().__init__(dsn, **kwargs)
+        self.pool = pool
+        self.handler = handler
+        self._wakeup = None
+        self._stopping = False
+        self._closed = None
+        self._tasks = []
+        self._heartbeat_task = None
+        self._listener = None
+
+    async def enqueue(self, key: str, payload: dict) -> bool:
+        async with self.pool.acquire() as conn:
+            row = await conn.fetchrow(_ENQUEUE_SQL.format(key='$1', payload='$2::jsonb'), key,
+                                      json.dumps(payload, ensure_ascii=False))
+        return self._on_enqueued(row is not None, key)
+
+    async def start(self):
+        import asyncpg  # asyncioモードのみの依存
+        self._wakeup = asyncio.Semaphore(0)
+        try:
+            self._listener = await asyncpg.connect(self.dsn)
+            await self._listener.add_listener(NOTIFY_CHANNEL, self._on_notify)
+        except Exception as e:
+            self._count('errors')
+            logger.warning(f"ジョブ登録の通知の受信に失敗しました（{self.poll_interval}秒間隔の確認で処理を続けます）: {str(e)}")
+        self._closed = asyncio.Event()
+        self._tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+        self._heartbeat_task = asyncio.create_task(self._heartbeat())
+        logger.info(f"メンションのジョブキューを開始しました - レプリカ: {self.replica_id}, ワーカー: {self.workers}")
+
+    async def close(self, timeout: float = 30.0):
+        self._stopping = True
+        for _ in range(self.workers):
+            self._wakeup.release()
+        if self._tasks:
+            done, pending = await asyncio.wait(self._tasks, timeout=timeout)
+            if pending:
+                logger.warning(f"処理中のジョブが終了しないままジョブキューを停止しました - {len(pending)}件")
+                for task in pending:
+                    task.cancel()
+        if self._heartbeat_task is not None:
+            self._closed.set()
+            await self._heartbeat_task
+        if self._listener is not None:
+            await self._listener.close()
+
+    def _on_notify(self, connection, pid, channel, payload):
+        self._count('notifications')
+        self._wakeup.release()
+
+    async def _claim(self):
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                if self._should_purge():
+                    rows = await conn.fetch(_EXPIRE_SQL.format(max_attempts='$1'), self.max_attempts)
+                    self._on_expired([row['event_key'] for row in rows])
+                    await conn.execute(_PURGE_SQL.format(retention='$1::float8'), self.retention)
+                return await conn.fetchrow(_CLAIM_SQL.format(replica='$1', lease='$2::float8', max_attempts='$3'),
+                                           self.replica_id, self.lease, self.max_attempts)
+
+    async def _complete(self, job_id: int) -> bool:
+        async with self.pool.acquire() as conn:
+            row = await conn.fetchrow(_COMPLETE_SQL.format(id='$1', replica='$2'), job_id, self.replica_id)
+        return row is not None
+
+    async def _fail(self, job_id: int) -> str:
+        async with self.pool.acquire() as conn:
+            return await conn.fetchval(_FAIL_SQL.format(id='$1', replica='$2', max_attempts='$3'),
+                                       job_id, self.replica_id, self.max_attempts)
+
+    async def _extend(self, job_ids: list) -> list:
+        """リースを延長し、延長できた（このレプリカが保持している）ジョブIDを返す"""
+        async with self.pool.acquire() as conn:
+            rows = await conn.fetch(_EXTEND_SQL.format(lease='$1::float8', ids='$2::bigint[]', replica='$3'),
+                                    self.lease, job_ids, self.replica_id)
+        extended = [row['id'] for row in rows]
+        self._on_extended(job_ids, extended)
+        return extended
+
+    async def _owns(self, job_id: int) -> bool:
+        """返信の前にジョブをまだ保持しているかを確認する（保持していればリースも延長する）"""
+        try:
+            owned = bool(await self._extend([job_id]))
+        except Exception as e:
+            return self._on_owns_error(job_id, e)
+        return self._on_owned(job_id, owned)
+
+    async def _heartbeat(self):
+        """処理中のジョブのリースを定期的に延長し、処理が長引いても他のレプリカに引き継がれないようにする"""
+        while True:
+            try:
+                await asyncio.wait_for(self._closed.wait(), self.heartbeat_interval)
+                return
+            except asyncio.TimeoutError:
+                pass
+            job_ids = self._held_jobs()
+            if not job_ids:
+                continue
+            try:
+                await self._extend(job_ids)
+            except Exception as e:
+                self._count('errors')
+                logger.error(f"ジョブのリースの延長に失敗しました: {str(e)}")
+
+    async def _work(self):
+        while not self._stopping:
+            try:
+                job = await self._claim()
+            except Exception as e:
+                self._count('errors')
+                logger.error(f"ジョブの取得に失敗しました: {str(e)}")
+                await asyncio.sleep(self.poll_interval)
+                continue
+            if job is None:
+                try:
+                    await asyncio.wait_for(self._wakeup.acquire(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            job_id = job['id']
+            self._on_claimed(job_id, job['attempts'])
+            self._count('active')
+            failed = False
+            try:
+                await self.handler(json.loads(job['payload']), lambda: self._owns(job_id))
+            except Exception as e:
+                failed = True
+                logger.error(f"ジョブの処理中にエラーが発生しました - ID: {job_id}, {str(e)}")
+            finally:
+                self._count('active', -1)
+                self._on_finished(job_id)
+            try:
+                if failed:
+                    self._on_failed(job_id, await self._fail(job_id))
+                else:
+                    self._on_completed(job_id, await self._complete(job_id))
+            except Exception as e:
+                self._count('errors')
+                logger.error(f"ジョブの完了の記録に失敗しました - ID: {job_id}, {str(e)}")
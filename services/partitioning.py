@@ -0,0 +1,371 @@
+"""Monthly range partitioning, retention and archiving for the conversations table"""
+import os
+import gzip
+import asyncio
+import threading
+import time
+from utils.logger import setup_logger
+from .schema import schema_version, ensure_schema, ensure_schema_async
+
+logger = setup_logger()
+
+# 月次パーティションの命名規則（conversations_pYYYYMM）
+PARTITION_PREFIX = 'conversations_p'
+
+PARTITION_STATEMENTS = [
+    # first_month〜last_monthの月次パーティションのうち未作成のものを作成する
+    f"""
+    CREATE OR REPLACE FUNCTION conversations_create_partitions(first_month DATE, last_month DATE) RETURNS INTEGER AS $$
+    DECLARE
+        month DATE := date_trunc('month', first_month)::date;
+        next_month DATE;
+        partition_name TEXT;
+        created INTEGER := 0;
+    BEGIN
+        WHILE month <= last_month LOOP
+            partition_name := '{PARTITION_PREFIX}' || to_char(month, 'YYYYMM');
+            next_month := (month + interval '1 month')::date;
+            IF to_regclass(partition_name) IS NULL THEN
+                -- defaultパーティションに同じ月の行があると作成できないため、行を新しいテーブルへ移してから接続する
+                IF EXISTS (SELECT 1 FROM conversations_default WHERE created_at >= month AND created_at < next_month) THEN
+                    -- 移動中に同じ月の行がdefaultへ書き込まれないよう、トランザクション終了までロックする
+                    -- （事前作成など、defaultに該当する行がない通常の場合は書き込みを止めない）
+                    LOCK TABLE conversations_default IN EXCLUSIVE MODE;
+                    EXECUTE format('CREATE TABLE %I (LIKE conversations INCLUDING DEFAULTS INCLUDING CONSTRAINTS)',
+                                   partition_name);
+                    EXECUTE format('WITH moved AS (DELETE FROM conversations_default WHERE created_at >= %L AND created_at < %L '
+                                   'RETURNING *) INSERT INTO %I SELECT * FROM moved', month, next_month, partition_name);
+                    EXECUTE format('ALTER TABLE conversations ATTACH PARTITION %I FOR VALUES FROM (%L) TO (%L)',
+                                   partition_name, month, next_month);
+                ELSE
+                    EXECUTE format('CREATE TABLE %I PARTITION OF conversations FOR VALUES FROM (%L) TO (%L)',
+                                   partition_name, month, next_month);
+                END IF;
+                created := created + 1;
+            END IF;
+            month := next_month;
+        END LOOP;
+        RETURN created;
+    END;
+    $$ LANGUAGE plpgsql
+    """,
+    # 既存の非パーティションテーブルをパーティションテーブルへ移行する（移行済みの場合はNULLを返す）
+    """
+    CREATE OR REPLACE FUNCTION conversations_migrate_to_partitioned() RETURNS BIGINT AS $$
+    DECLARE
+        id_sequence TEXT;
+        first_month DATE;
+        moved BIGINT;
+    BEGIN
+        PERFORM pg_advisory_xact_lock(hashtext('conversations_partition_maintenance'));
+        IF (SELECT relkind FROM pg_class WHERE oid = 'conversations'::regclass) = 'p' THEN
+            RETURN NULL;
+        END IF;
+
+        LOCK TABLE conversations IN ACCESS EXCLUSIVE MODE;
+        id_sequence := pg_get_serial_sequence('conversations', 'id');
+        ALTER TABLE conversations RENAME TO conversations_unpartitioned;
+        ALTER INDEX IF EXISTS conversations_pkey RENAME TO conversations_unpartitioned_pkey;
+        DROP INDEX IF EXISTS idx_conversations_user_created;
+        DROP INDEX IF EXISTS idx_conversations_created_at;
+        DROP TRIGGER IF EXISTS conversations_rollup_trigger ON conversations_unpartitioned;
+        EXECUTE format('ALTER SEQUENCE %s OWNED BY NONE', id_sequence);
+
+        -- パーティションキーを主キーに含める必要があるため (id, created_at) を主キーとする
+        EXECUTE format($create$
+            CREATE TABLE conversations (
+                id INTEGER NOT NULL DEFAULT nextval(%L::regclass),
+                user_id VARCHAR(50) NOT NULL,
+                message TEXT NOT NULL,
+                response TEXT NOT NULL,
+                created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                response_time FLOAT,
+                error_occurred BOOLEAN DEFAULT FALSE,
+                first_token_time FLOAT,
+                trace JSONB,
+                PRIMARY KEY (id, created_at)
+            ) PARTITION BY RANGE (created_at)
+        $create$, id_sequence);
+        EXECUTE format('ALTER SEQUENCE %s OWNED BY conversations.id', id_sequence);
+        CREATE TABLE conversations_default PARTITION OF conversations DEFAULT;
+
+        SELECT date_trunc('month', COALESCE(MIN(created_at), LOCALTIMESTAMP))::date INTO first_month
+        FROM conversations_unpartitioned;
+        PERFORM conversations_create_partitions(first_month, date_trunc('month', LOCALTIMESTAMP)::date);
+
+        -- 集計テーブルには反映済みのため、トリガーは移行後に作成する
+        INSERT INTO conversations
+            (id, user_id, message, response, created_at, response_time, error_occurred, first_token_time, trace)
+        SELECT id, user_id, message, response, COALESCE(created_at, LOCALTIMESTAMP), response_time, error_occurred,
+               first_token_time, trace
+        FROM conversations_unpartitioned;
+        GET DIAGNOSTICS moved = ROW_COUNT;
+        DROP TABLE conversations_unpartitioned;
+
+        CREATE INDEX idx_conversations_user_created ON conversations (user_id, created_at DESC);
+        CREATE INDEX idx_conversations_created_at ON conversations (created_at);
+        CREATE TRIGGER conversations_rollup_trigger
+        AFTER INSERT ON conversations
+        REFERENCING NEW TABLE AS new_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION conversations_rollup();
+        RETURN moved;
+    END;
+    $$ LANGUAGE plpgsql
+    """,
+]
+
+PARTITION_SCHEMA_VERSION = schema_version(PARTITION_STATEMENTS)
+
+# 移行済みであれば移行関数（テーブルロックを取る）を呼ばない
+_IS_PARTITIONED_SQL = "SELECT relkind = 'p' FROM pg_class WHERE oid = 'conversations'::regclass"
+_MIGRATE_SQL = "SELECT conversations_migrate_to_partitioned()"
+# 複数プロセスで同時にメンテナンスしないよう、取得できなければその回は何もしない
+_TRY_LOCK_SQL = "SELECT pg_try_advisory_xact_lock(hashtext('conversations_partition_maintenance'))"
+# defaultパーティションに過去の月の行があれば、その月からパーティションを作成して行を移す
+# （移した月が保持期間を過ぎていれば、同じメンテナンスでアーカイブ・削除される）
+_CREATE_SQL = """
+    SELECT conversations_create_partitions(
+        LEAST(date_trunc('month', LOCALTIMESTAMP),
+              (SELECT date_trunc('month', MIN(created_at)) FROM conversations_default))::date,
+        (date_trunc('month', LOCALTIMESTAMP) + {months} * interval '1 month')::date
+    )
+"""
+# 保持期間（月数）より前の月のパーティション。当月は保持期間に含めない
+_EXPIRED_SQL = """
+    SELECT c.relname
+    FROM pg_inherits i
+    JOIN pg_class c ON c.oid = i.inhrelid
+    WHERE i.inhparent = 'conversations'::regclass
+      AND c.relname ~ '^conversations_p[0-9]{{6}}$'
+      AND to_date(right(c.relname, 6), 'YYYYMM')
+          < date_trunc('month', LOCALTIMESTAMP) - {months} * interval '1 month'
+    ORDER BY c.relname
+"""
+_LOCK_PARTITION_SQL = 'LOCK TABLE "{name}" IN SHARE MODE'
+_DETACH_SQL = 'ALTER TABLE conversations DETACH PARTITION "{name}"'
+_DROP_SQL = 'DROP TABLE "{name}"'
+# DETACH中は会話ログの書き込みが待たされるため、ロックを長く待たない（次回に再試行する）
+_DETACH_LOCK_TIMEOUT_SQL = "SET LOCAL lock_timeout = '5s'"
+
+class _PartitionManagerBase:
+    def __init__(self, retention_months: int = 0, premake_months: int = 2, archive_dir: str = 'conversation_archive',
+                 interval: float = 3600.0):
+        """
+        retention_months: 当月より前に保持する月数（0の場合は削除しない）
+        archive_dir: 削除前にパーティションをgzip圧縮CSVで書き出すディレクトリ（空の場合は書き出さずに削除）
+        """
+        self.retention_months = retention_months
+        self.premake_months = premake_months
+        self.archive_dir = archive_dir
+        self.interval = interval
+        self._stats = {'runs': 0, 'skipped': 0, 'errors': 0, 'partitions_created': 0, 'partitions_dropped': 0,
+                       'rows_archived': 0, 'last_run': None}
+
+    def _archive_paths(self, name: str) -> tuple:
+        os.makedirs(self.archive_dir, exist_ok=True)
+        path = os.path.join(self.archive_dir, f"{name}.csv.gz")
+        return path, f"{path}.partial"
+
+    @staticmethod
+    def _finish_archive(partial: str, path: str):
+        """書き出しが完了したファイルを最終的なファイル名へ移動する"""
+        with open(partial, 'rb') as f:
+            os.fsync(f.fileno())
+        os.replace(partial, path)
+
+    @staticmethod
+    def _discard_archive(partial: str):
+        if partial and os.path.exists(partial):
+            os.remove(partial)
+
+    def _log_dropped(self, name: str, rows, path):
+        self._stats['partitions_dropped'] += 1
+        if path:
+            self._stats['rows_archived'] += rows or 0
+            logger.info(f"保持期間を過ぎたパーティションをアーカイブして削除しました - {name}, {rows}件, 保存先: {path}")
+        else:
+            logger.info(f"保持期間を過ぎたパーティションを削除しました（アーカイブなし） - {name}")
+
+    def get_stats(self) -> dict:
+        """パーティション作成・削除の実行状況を取得"""
+        return dict(self._stats)
+
+class PartitionManager(_PartitionManagerBase):
+    """Keeps monthly conversations partitions ahead of time and archives/drops expired ones (psycopg2)"""
+
+    def __init__(self, pool, **kwargs):
+        super().__init__(**kwargs)
+        self.pool = pool
+        self._stop = threading.Event()
+        self._thread = None
+
+    def setup(self):
+        """パーティション管理用の関数を作成し、必要であれば既存テーブルを移行する"""
+        start = time.perf_counter()
+        ensure_schema(self.pool, 'partitioning', PARTITION_SCHEMA_VERSION, PARTITION_STATEMENTS)
+        with self.pool.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(_IS_PARTITIONED_SQL)
+                moved = None
+                if not cur.fetchone()[0]:
+                    cur.execute(_MIGRATE_SQL)
+                    moved = cur.fetchone()[0]
+        if moved is not None:
+            logger.info(f"conversationsテーブルを月次パーティションへ移行しました - {moved}件, "
+                        f"{time.perf_counter() - start:.1f}秒")
+        self.run_maintenance()
+
+    def start(self):
+        """一定間隔でメンテナンスを実行するスレッドを開始する"""
+        self._thread = threading.Thread(target=self._run, name='partition-maintenance', daemon=True)
+        self._thread.start()
+
+    def close(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=5)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.run_maintenance()
+
+    def run_maintenance(self):
+        """先の月のパーティションを作成し、保持期間を過ぎたパーティションをアーカイブ・削除する"""
+        self._stats['runs'] += 1
+        self._stats['last_run'] = time.time()
+        try:
+            with self.pool.connection() as conn:
+                with conn.cursor() as cur:
+                    cur.execute(_TRY_LOCK_SQL)
+                    if not cur.fetchone()[0]:
+                        self._stats['skipped'] += 1
+                        logger.debug("他のプロセスがパーティションのメンテナンス中のためスキップします")
+                        return
+                    cur.execute(_CREATE_SQL.format(months='%s'), (self.premake_months,))
+                    created = cur.fetchone()[0]
+                    expired = []
+                    if self.retention_months > 0:
+                        cur.execute(_EXPIRED_SQL.format(months='%s'), (self.retention_months,))
+                        expired = [row[0] for row in cur.fetchall()]
+            if created:
+                self._stats['partitions_created'] += created
+                logger.info(f"会話ログの月次パーティションを作成しました - {created}件")
+
+            for name in expired:
+                self._drop_partition(name)
+        except Exception as e:
+            self._stats['errors'] += 1
+            logger.error(f"パーティションのメンテナンスに失敗しました: {str(e)}")
+
+    def _drop_partition(self, name: str):
+        """パーティションを書き出してからDETACHしてDROPする（同一トランザクションで実行）"""
+        path, partial, rows = None, None, None
+        try:
+            with self.pool.connection() as conn:
+                with conn.cursor() as cur:
+                    cur.execute(_TRY_LOCK_SQL)
+                    if not cur.fetchone()[0]:
+                        self._stats['skipped'] += 1
+                        return
+                    cur.execute(_LOCK_PARTITION_SQL.format(name=name))
+                    if self.archive_dir:
+                        path, partial = self._archive_paths(name)
+                        # copy_expertの後のrowcountは件数にならないため、ロック済みのパーティションを先に数える
+                        cur.execute(f'SELECT count(*) FROM "{name}"')
+                        rows = cur.fetchone()[0]
+                        with gzip.open(partial, 'wb') as f:
+                            cur.copy_expert(f'COPY "{name}" TO STDOUT WITH (FORMAT csv, HEADER)', f)
+                        self._finish_archive(partial, path)
+                    cur.execute(_DETACH_LOCK_TIMEOUT_SQL)
+                    cur.execute(_DETACH_SQL.format(name=name))
+                    cur.execute(_DROP_SQL.format(name=name))
+        except Exception:
+            self._discard_archive(partial)
+            raise
+        self._log_dropped(name, rows, path)
+
+class AsyncPartitionManager(_PartitionManagerBase):
+    """asyncpg counterpart of PartitionManager"""
+
+    def __init__(self, pool, **kwargs):
+        super().__init__(**kwargs)
+        self.pool = pool
+        self._task = None
+
+    async def setup(self):
+        start = time.perf_counter()
+        await ensure_schema_async(self.pool, 'partitioning', PARTITION_SCHEMA_VERSION, PARTITION_STATEMENTS)
+        async with self.pool.acquire() as conn:
+            moved = None
+            if not await conn.fetchval(_IS_PARTITIONED_SQL):
+                moved = await conn.fetchval(_MIGRATE_SQL)
+        if moved is not None:
+            logger.info(f"conversationsテーブルを月次パーティションへ移行しました - {moved}件, "
+                        f"{time.perf_counter() - start:.1f}秒")
+        await self.run_maintenance()
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.run_maintenance()
+
+    async def run_maintenance(self):
+        self._stats['runs'] += 1
+        self._stats['last_run'] = time.time()
+        try:
+            async with self.pool.acquire() as conn:
+                async with conn.transaction():
+                    if not await conn.fetchval(_TRY_LOCK_SQL):
+                        self._stats['skipped'] += 1
+                        logger.debug("他のプロセスがパーティションのメンテナンス中のためスキップします")
+                        return
+                    created = await conn.fetchval(_CREATE_SQL.format(months='$1::int'), self.premake_months)
+                    expired = []
+                    if self.retention_months > 0:
+                        rows = await conn.fetch(_EXPIRED_SQL.format(months='$1::int'), self.retention_months)
+                        expired = [row[0] for row in rows]
+            if created:
+                self._stats['partitions_created'] += created
+                logger.info(f"会話ログの月次パーティションを作成しました - {created}件")
+
+            for name in expired:
+                await self._drop_partition(name)
+        except Exception as e:
+            self._stats['errors'] += 1
+            logger.error(f"パーティションのメンテナンスに失敗しました: {str(e)}")
+
+    async def _drop_partition(self, name: str):
+        path, partial, rows = None, None, None
+        try:
+            async with self.pool.acquire() as conn:
+                async with conn.transaction():
+                    if not await conn.fetchval(_TRY_LOCK_SQL):
+                        self._stats['skipped'] += 1
+                        return
+                    await conn.execute(_LOCK_PARTITION_SQL.format(name=name))
+                    if self.archive_dir:
+                        path, partial = self._archive_paths(name)
+                        with gzip.open(partial, 'wb') as f:
+                            async def write(chunk):
+                                f.write(chunk)
+                            status = await conn.copy_from_table(name, output=write, format='csv', header=True)
+                        rows = int(status.split()[-1])
+                        self._finish_archive(partial, path)
+                    await conn.execute(_DETACH_LOCK_TIMEOUT_SQL)
+                    await conn.execute(_DETACH_SQL.format(name=name))
+                    await conn.execute(_DROP_SQL.format(name=name))
+        except Exception:
+            self._discard_archive(partial)
+            raise
+        self._log_dropped(name, rows, path)
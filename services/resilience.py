@@ -0,0 +1,144 @@
+import time
+import threading
+from collections import deque
+from utils.logger import setup_logger
+from utils.metrics import CIRCUIT_STATE
+
+logger = setup_logger()
+
+class CircuitOpenError(Exception):
+    """Raised when a call is rejected because the circuit breaker is open"""
+    def __init__(self, retry_after: float):
+        self.retry_after = retry_after
+        super().__init__(f"サーキットブレーカーが開いています（約{retry_after:.0f}秒後に再試行）")
+
+class CircuitBreaker:
+    """Closed / open / half-open circuit breaker driven by the failure rate of recent calls"""
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+    _STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+    def __init__(self, name: str, failure_rate_threshold: float = 0.5, window_size: int = 20, min_calls: int = 10,
+                 open_duration: float = 30.0, half_open_max_calls: int = 1):
+        self.name = name
+        self.failure_rate_threshold = failure_rate_threshold
+        self.min_calls = min_calls
+        self.open_duration = open_duration
+        self.half_open_max_calls = half_open_max_calls
+
+        self._lock = threading.Lock()
+        self._state = self.CLOSED
+        self._results = deque(maxlen=window_size)  # True = 失敗
+        self._opened_at = 0.0
+        self._half_open_calls = 0
+        self._stats = {'rejected': 0, 'opened': 0, 'half_opened': 0, 'closed': 0}
+        CIRCUIT_STATE.labels(name).set(0)
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._state
+
+    def before_call(self) -> bool:
+        """
+        呼び出し可否を判定（開いている間はCircuitOpenErrorで即座に失敗させる）
+        半開状態の試行呼び出しとして通した場合はTrueを返す
+        """
+        with self._lock:
+            if self._state == self.OPEN:
+                elapsed = time.monotonic() - self._opened_at
+                if elapsed < self.open_duration:
+                    self._stats['rejected'] += 1
+                    raise CircuitOpenError(self.open_duration - elapsed)
+                self._transition(self.HALF_OPEN)
+
+            if self._state == self.HALF_OPEN:
+                if self._half_open_calls >= self.half_open_max_calls:
+                    self._stats['rejected'] += 1
+                    raise CircuitOpenError(0.0)
+                self._half_open_calls += 1
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            if self._state == self.HALF_OPEN:
+                self._transition(self.CLOSED)
+            else:
+                self._results.append(False)
+
+    def record_failure(self):
+        with self._lock:
+            if self._state == self.HALF_OPEN:
+                self._transition(self.OPEN)
+                return
+            self._results.append(True)
+            if self._state == self.CLOSED and len(self._results) >= self.min_calls:
+                failure_rate = sum(self._results) / len(self._results)
+                if failure_rate >= self.failure_rate_threshold:
+                    self._transition(self.OPEN)
+
+    def _transition(self, state: str):
+        previous = self._state
+        self._state = state
+        CIRCUIT_STATE.labels(self.name).set(self._STATE_VALUES[state])
+        if state == self.OPEN:
+            self._opened_at = time.monotonic()
+            self._stats['opened'] += 1
+        elif state == self.HALF_OPEN:
+            self._half_open_calls = 0
+            self._stats['half_opened'] += 1
+        else:
+            self._results.clear()
+            self._stats['closed'] += 1
+
+        log = logger.warning if state == self.OPEN else logger.info
+        log(f"サーキットブレーカー[{self.name}]の状態が変化しました: {previous} -> {state}")
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats['state'] = self._state
+            stats['failure_rate'] = sum(self._results) / len(self._results) if self._results else 0.0
+        return stats
+
+class AdaptiveTimeout:
+    """Derives a request timeout from a percentile of recently observed latencies"""
+
+    def __init__(self, default: float, minimum: float = 5.0, maximum: float = None, percentile: float = 0.99,
+                 multiplier: float = 1.5, window_size: int = 200, min_samples: int = 20):
+        self.default = default
+        self.minimum = minimum
+        self.maximum = maximum if maximum is not None else default
+        self.percentile = percentile
+        self.multiplier = multiplier
+        self.min_samples = min_samples
+
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=window_size)
+
+    def observe(self, latency: float):
+        with self._lock:
+            self._latencies.append(latency)
+
+    def observe_timeout(self, timeout: float):
+        """
+        タイムアウトした呼び出しを記録する。上限より短い適応値で打ち切った場合は、
+        応答時間の傾向が変わったとみなして観測値を破棄し、既定値に戻す（成功だけでは値が伸びないため）
+        """
+        if timeout >= self.maximum:
+            return
+        with self._lock:
+            self._latencies.clear()
+        logger.warning(f"適応タイムアウト（{timeout:.1f}秒）で打ち切られたため、既定値（{self.default:.1f}秒）に戻します")
+
+    def current(self) -> float:
+        """観測値が十分あればパーセンタイル×係数を上下限で丸めた値、なければ既定値を返す"""
+        with self._lock:
+            if len(self._latencies) < self.min_samples:
+                return self.default
+            samples = sorted(self._latencies)
+        index = min(int(len(samples) * self.percentile), len(samples) - 1)
+        return max(self.minimum, min(self.maximum, samples[index] * self.multiplier))
@@ -0,0 +1,303 @@
+import re
+import time
+import uuid
+import select
+import hashlib
+import threading
+import unicodedata
+from collections import OrderedDict
+import psycopg2
+from utils.logger import setup_logger
+
+logger = setup_logger()
+
+CACHE_SCOPES = ('global', 'channel', 'user')
+
+# キャッシュの無効化を他のプロセスへ伝えるチャンネル
+INVALIDATION_CHANNEL = 'response_cache_invalidation'
+
+def normalize_query(query: str) -> str:
+    """表記ゆれを吸収したキャッシュ用のクエリ文字列を返す"""
+    text = unicodedata.normalize('NFKC', query).lower()
+    text = re.sub(r'\s+', ' ', text).strip()
+    return text.rstrip('?？!！。.、, ')
+
+class PostgresCacheBackend:
+    """Shared cache backend stored in the response_cache table"""
+
+    def __init__(self, pool):
+        self.pool = pool
+
+    def get(self, key: str):
+        with self.pool.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    SELECT response FROM response_cache
+                    WHERE cache_key = %s AND expires_at > now()
+                """, (key,))
+                row = cur.fetchone()
+                return row[0] if row else None
+
+    def set(self, key: str, query_hash: str, response: str, ttl: float):
+        with self.pool.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    INSERT INTO response_cache (cache_key, query_hash, response, expires_at)
+                    VALUES (%s, %s, %s, now() + %s * interval '1 second')
+                    ON CONFLICT (cache_key) DO UPDATE SET
+                        response = EXCLUDED.response,
+                        expires_at = EXCLUDED.expires_at
+                """, (key, query_hash, response, ttl))
+
+    def delete(self, query_hash: str = None):
+        with self.pool.connection() as conn:
+            with conn.cursor() as cur:
+                if query_hash:
+                    cur.execute("DELETE FROM response_cache WHERE query_hash = %s", (query_hash,))
+                else:
+                    cur.execute("DELETE FROM response_cache")
+
+class CacheInvalidationBus:
+    """Broadcasts cache invalidation to every process's in-memory cache through Postgres LISTEN/NOTIFY"""
+
+    def __init__(self, pool, reconnect_interval: float = 5.0):
+        self.pool = pool
+        self.reconnect_interval = reconnect_interval
+        self.sender_id = uuid.uuid4().hex
+        self._stop = threading.Event()
+        self._thread = None
+
+    def publish(self, query_hash: str = None):
+        """無効化を通知する（query_hashがNoneなら全件）"""
+        with self.pool.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("SELECT pg_notify(%s, %s)", (INVALIDATION_CHANNEL, f"{self.sender_id}:{query_hash or '*'}"))
+
+    def start(self, on_invalidate):
+        """on_invalidate: 他のプロセスで無効化されたクエリハッシュ（全件の場合はNone）を受け取る関数"""
+        self._thread = threading.Thread(target=self._listen, args=(on_invalidate,),
+                                        name='cache-invalidation-listener', daemon=True)
+        self._thread.start()
+
+    def close(self, timeout: float = 5.0):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _listen(self, on_invalidate):
+        connected = False
+        while not self._stop.is_set():
+            conn = None
+            try:
+                conn = psycopg2.connect(self.pool.db_url)
+                conn.autocommit = True
+                with conn.cursor() as cur:
+                    cur.execute(f"LISTEN {INVALIDATION_CHANNEL}")
+                if connected:
+                    # 切断中の通知を取りこぼした可能性があるため、プロセス内のキャッシュをすべて破棄する
+                    on_invalidate(None)
+                connected = True
+                while not self._stop.is_set():
+                    if select.select([conn], [], [], 1.0) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        sender, _, query_hash = conn.notifies.pop(0).payload.partition(':')
+                        if sender != self.sender_id:
+                            on_invalidate(None if query_hash == '*' else query_hash)
+            except Exception as e:
+                logger.warning(f"キャッシュ無効化の通知の受信に失敗しました（{self.reconnect_interval}秒後に再接続します）: {str(e)}")
+                self._stop.wait(self.reconnect_interval)
+            finally:
+                if conn is not None:
+                    conn.close()
+
+class ResponseCache:
+    """LRU + TTL cache for Dify answers that coalesces concurrent misses for the same key"""
+
+    def __init__(self, max_entries: int = 1000, ttl: float = 3600.0, scope: str = 'global', backend=None, bus=None):
+        """bus: 無効化を他のプロセスと共有するCacheInvalidationBus（省略時はこのプロセスのみ）"""
+        if scope not in CACHE_SCOPES:
+            raise ValueError(f"キャッシュスコープが不正です: {scope}")
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.scope = scope
+        self.backend = backend
+        self.bus = bus
+
+        self._entries = OrderedDict()  # key -> (query_hash, response, expires_at)
+        self._inflight = {}  # key -> _Flight
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'backend_hits': 0, 'misses': 0, 'coalesced': 0, 'stores': 0, 'evictions': 0}
+
+    def make_key(self, query: str, user: str, channel: str) -> tuple:
+        """スコープに応じたキャッシュキーとクエリハッシュを返す"""
+        query_hash = hashlib.sha256(normalize_query(query).encode('utf-8')).hexdigest()
+        if self.scope == 'channel':
+            prefix = f"channel:{channel}"
+        elif self.scope == 'user':
+            prefix = f"user:{user}"
+        else:
+            prefix = "global"
+        return f"{prefix}:{query_hash}", query_hash
+
+    def get(self, key: str):
+        """キャッシュを参照（ローカルになければ共有バックエンドを参照）"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry:
+                if entry[2] > now:
+                    self._entries.move_to_end(key)
+                    self._stats['hits'] += 1
+                    return entry[1]
+                del self._entries[key]
+
+        if self.backend:
+            try:
+                response = self.backend.get(key)
+            except Exception as e:
+                logger.warning(f"共有キャッシュの参照に失敗しました: {str(e)}")
+                response = None
+            if response is not None:
+                with self._lock:
+                    self._stats['backend_hits'] += 1
+                    self._store_local(key, key.rsplit(':', 1)[-1], response)
+                return response
+
+        with self._lock:
+            self._stats['misses'] += 1
+        return None
+
+    def set(self, key: str, query_hash: str, response: str):
+        """応答をキャッシュへ保存"""
+        with self._lock:
+            self._store_local(key, query_hash, response)
+            self._stats['stores'] += 1
+        if self.backend:
+            try:
+                self.backend.set(key, query_hash, response, self.ttl)
+            except Exception as e:
+                logger.warning(f"共有キャッシュへの保存に失敗しました: {str(e)}")
+
+    def _store_local(self, key: str, query_hash: str, response: str):
+        self._entries[key] = (query_hash, response, time.monotonic() + self.ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self._stats['evictions'] += 1
+
+    def get_or_compute(self, key: str, query_hash: str, compute):
+        """
+        キャッシュにあれば返し、なければcomputeを呼び出して保存する。
+        同じキーへの同時ミスは1回の呼び出しにまとめ、成功した結果のみを共有する
+        """
+        response = self.get(key)
+        if response is not None:
+            return response
+
+        with self._lock:
+            # 直前に別スレッドが保存した可能性があるため再確認
+            entry = self._entries.get(key)
+            if entry and entry[2] > time.monotonic():
+                return entry[1]
+
+            flight = self._inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = _Flight()
+                self._inflight[key] = flight
+            else:
+                self._stats['coalesced'] += 1
+
+        if not leader:
+            response = flight.wait()
+            if response is not None:
+                return response
+            # 先行の呼び出しの例外（そのユーザーの負荷制限など）は共有せず、自分で呼び出す
+            response = compute()
+            self.set(key, query_hash, response)
+            return response
+
+        try:
+            response = compute()
+            self.set(key, query_hash, response)
+            flight.resolve(response)
+            return response
+        except Exception:
+            flight.fail()
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+
+    def start(self):
+        """他のプロセスからの無効化の受信を開始する"""
+        if self.bus:
+            self.bus.start(self._on_remote_invalidate)
+
+    def close(self):
+        if self.bus:
+            self.bus.close()
+
+    def invalidate(self, query: str = None) -> int:
+        """キャッシュを無効化（クエリ指定時はそのクエリのみ、全スコープ対象）。他のプロセスにも通知する"""
+        query_hash = None
+        if query:
+            query_hash = hashlib.sha256(normalize_query(query).encode('utf-8')).hexdigest()
+
+        count = self._invalidate_local(query_hash)
+        if self.backend:
+            try:
+                self.backend.delete(query_hash)
+            except Exception as e:
+                logger.warning(f"共有キャッシュの無効化に失敗しました: {str(e)}")
+        if self.bus:
+            try:
+                self.bus.publish(query_hash)
+            except Exception as e:
+                logger.warning(f"キャッシュ無効化の通知に失敗しました（他のプロセスはTTLまで古い応答を返します）: {str(e)}")
+        logger.info(f"応答キャッシュを無効化しました - {count}件")
+        return count
+
+    def _on_remote_invalidate(self, query_hash: str = None):
+        count = self._invalidate_local(query_hash)
+        logger.info(f"他のプロセスからの通知で応答キャッシュを無効化しました - {count}件")
+
+    def _invalidate_local(self, query_hash: str = None) -> int:
+        with self._lock:
+            if query_hash:
+                keys = [key for key, entry in self._entries.items() if entry[0] == query_hash]
+            else:
+                keys = list(self._entries)
+            for key in keys:
+                del self._entries[key]
+        return len(keys)
+
+    def get_stats(self) -> dict:
+        """ヒット率などのキャッシュ統計を取得"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats['entries'] = len(self._entries)
+        lookups = stats['hits'] + stats['backend_hits'] + stats['misses']
+        stats['hit_rate'] = (stats['hits'] + stats['backend_hits']) / lookups if lookups else 0.0
+        return stats
+
+class _Flight:
+    """単一の上流呼び出しの結果を待ち合わせる"""
+
+    def __init__(self):
+        self._done = threading.Event()
+        self._response = None
+
+    def resolve(self, response: str):
+        self._response = response
+        self._done.set()
+
+    def fail(self):
+        self._done.set()
+
+    def wait(self):
+        """成功した場合は結果、失敗した場合はNoneを返す"""
+        self._done.wait()
+        return self._response
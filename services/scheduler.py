@@ -0,0 +1,150 @@
+import time
+import threading
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from utils.logger import setup_logger
+from .errors import SchedulerBusyError
+
+logger = setup_logger()
+
+class _Waiter:
+    def __init__(self, user: str):
+        self.user = user
+        self.event = threading.Event()
+        self.granted = False
+
+class FairScheduler:
+    """
+    Admission control for Dify calls: caps in-flight calls (overall and per user) and
+    hands free slots round-robin across channels, then across users within a channel.
+    """
+
+    def __init__(self, max_concurrency: int = 8, max_queue_depth: int = 16, max_queue_per_user: int = 2,
+                 max_wait: float = 15.0, max_active_per_user: int = 2):
+        """
+        max_active_per_user: 1人のユーザーが同時に使える実行枠の上限（超える分は空き枠があっても待機させる）
+        """
+        self.max_concurrency = max_concurrency
+        self.max_queue_depth = max_queue_depth
+        self.max_queue_per_user = max_queue_per_user
+        self.max_wait = max_wait
+        self.max_active_per_user = max_active_per_user
+
+        self._lock = threading.Lock()
+        self._active = 0
+        self._active_by_user = {}
+        self._queued = 0
+        self._queued_by_user = {}
+        self._channels = OrderedDict()  # channel -> OrderedDict(user -> deque[_Waiter])
+
+        self._stats = {'admitted': 0, 'shed': 0, 'timeouts': 0, 'total_wait': 0.0, 'max_wait': 0.0}
+
+    @contextmanager
+    def slot(self, user: str, channel: str):
+        """実行枠を確保してから処理を行い、終了後に次の待機者へ枠を渡す"""
+        self.acquire(user, channel)
+        try:
+            yield
+        finally:
+            self.release(user)
+
+    def acquire(self, user: str, channel: str):
+        start = time.monotonic()
+        with self._lock:
+            # 空き枠があれば待機者はすべてユーザーごとの上限で待っているため、追い越しても公平性は崩れない
+            if self._active < self.max_concurrency and self._active_by_user.get(user, 0) < self.max_active_per_user:
+                self._active += 1
+                self._activated(user)
+                self._record_admit(0.0)
+                return
+
+            # キュー長による負荷制限（待たせずに即座に断る）
+            if self._queued >= self.max_queue_depth:
+                self._stats['shed'] += 1
+                logger.warning(f"待ち行列が上限に達したためリクエストを拒否しました - ユーザー: {user}")
+                raise SchedulerBusyError("待ち行列が上限に達しました")
+            if self._queued_by_user.get(user, 0) >= self.max_queue_per_user:
+                self._stats['shed'] += 1
+                logger.warning(f"ユーザーごとの待機上限に達したためリクエストを拒否しました - ユーザー: {user}")
+                raise SchedulerBusyError("同時リクエスト数の上限に達しました")
+
+            waiter = _Waiter(user)
+            users = self._channels.setdefault(channel, OrderedDict())
+            users.setdefault(user, deque()).append(waiter)
+            self._queued += 1
+            self._queued_by_user[user] = self._queued_by_user.get(user, 0) + 1
+
+        waiter.event.wait(self.max_wait)
+
+        with self._lock:
+            if not waiter.granted:
+                self._remove(channel, waiter)
+                self._stats['timeouts'] += 1
+                logger.warning(f"実行枠の待機がタイムアウトしました - ユーザー: {user}")
+                raise SchedulerBusyError("待ち時間が上限に達しました")
+            self._record_admit(time.monotonic() - start)
+
+    def release(self, user: str):
+        with self._lock:
+            self._active_by_user[user] -= 1
+            if not self._active_by_user[user]:
+                del self._active_by_user[user]
+            waiter = self._next_waiter()
+            if waiter:
+                # 枠はそのまま次の待機者へ引き継ぐ
+                self._activated(waiter.user)
+                waiter.granted = True
+                waiter.event.set()
+            else:
+                self._active -= 1
+
+    def _activated(self, user: str):
+        self._active_by_user[user] = self._active_by_user.get(user, 0) + 1
+
+    def _next_waiter(self):
+        """チャンネル→ユーザーの順にラウンドロビンで次の待機者を選ぶ（実行枠の上限に達しているユーザーは飛ばす）"""
+        for channel, users in list(self._channels.items()):
+            for user, waiters in list(users.items()):
+                if self._active_by_user.get(user, 0) >= self.max_active_per_user:
+                    continue
+                self._channels.move_to_end(channel)
+                users.move_to_end(user)
+                waiter = waiters.popleft()
+                if not waiters:
+                    del users[user]
+                if not users:
+                    del self._channels[channel]
+                self._dequeued(waiter.user)
+                return waiter
+        return None
+
+    def _remove(self, channel: str, waiter: _Waiter):
+        users = self._channels.get(channel)
+        if not users or waiter.user not in users:
+            return
+        users[waiter.user].remove(waiter)
+        if not users[waiter.user]:
+            del users[waiter.user]
+        if not users:
+            del self._channels[channel]
+        self._dequeued(waiter.user)
+
+    def _dequeued(self, user: str):
+        self._queued -= 1
+        self._queued_by_user[user] -= 1
+        if not self._queued_by_user[user]:
+            del self._queued_by_user[user]
+
+    def _record_admit(self, wait: float):
+        self._stats['admitted'] += 1
+        self._stats['total_wait'] += wait
+        self._stats['max_wait'] = max(self._stats['max_wait'], wait)
+
+    def get_stats(self) -> dict:
+        """実行中・待機中の件数と待ち時間を取得"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats['active'] = self._active
+            stats['queue_depth'] = self._queued
+        stats['avg_wait'] = stats.pop('total_wait') / stats['admitted'] if stats['admitted'] else 0.0
+        return stats
@@ -0,0 +1,324 @@
+"""Database schema shared by the sync and async conversation services"""
+import hashlib
+
+# 応答時間ヒストグラムのバケット境界（秒）。最後のバケットは上限なし
+LATENCY_BUCKETS = [0.5, 1, 2, 3, 5, 10, 20, 30, 60]
+HISTOGRAM_SIZE = len(LATENCY_BUCKETS) + 1
+
+_BUCKETS_SQL = f"ARRAY[{', '.join(str(b) for b in LATENCY_BUCKETS)}]::FLOAT[]"
+_HISTOGRAM_AGG_SQL = "ARRAY[{}]::BIGINT[]".format(", ".join(
+    f"COUNT(*) FILTER (WHERE width_bucket(response_time, {_BUCKETS_SQL}) = {i})"
+    for i in range(HISTOGRAM_SIZE)
+))
+
+SCHEMA_STATEMENTS = [
+    """
+    CREATE TABLE IF NOT EXISTS conversations (
+        id SERIAL PRIMARY KEY,
+        user_id VARCHAR(50) NOT NULL,
+        message TEXT NOT NULL,
+        response TEXT NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        response_time FLOAT,
+        error_occurred BOOLEAN DEFAULT FALSE
+    )
+    """,
+    """
+    ALTER TABLE conversations
+    ADD COLUMN IF NOT EXISTS first_token_time FLOAT
+    """,
+    """
+    ALTER TABLE conversations
+    ADD COLUMN IF NOT EXISTS trace JSONB
+    """,
+    # /stats 用インデックス
+    """
+    CREATE INDEX IF NOT EXISTS idx_conversations_user_created
+    ON conversations (user_id, created_at DESC)
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS idx_conversations_created_at
+    ON conversations (created_at)
+    """,
+    # 応答キャッシュの共有バックエンド（RESPONSE_CACHE_BACKEND=postgres の場合に使用）
+    """
+    CREATE TABLE IF NOT EXISTS response_cache (
+        cache_key VARCHAR(200) PRIMARY KEY,
+        query_hash CHAR(64) NOT NULL,
+        response TEXT NOT NULL,
+        expires_at TIMESTAMP NOT NULL
+    )
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS idx_response_cache_query_hash
+    ON response_cache (query_hash)
+    """,
+    # 処理済みSlackイベント（EVENT_DEDUP_BACKEND=postgres の場合に複数プロセスで再送を判定）
+    """
+    CREATE TABLE IF NOT EXISTS processed_events (
+        event_key VARCHAR(200) PRIMARY KEY,
+        expires_at TIMESTAMP NOT NULL
+    )
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS idx_processed_events_expires_at
+    ON processed_events (expires_at)
+    """,
+    # Slackスレッドとユーザーの組ごとのDify会話ID（スレッド内の質問で会話を継続する）
+    """
+    CREATE TABLE IF NOT EXISTS thread_conversations (
+        channel VARCHAR(50) NOT NULL,
+        thread_ts VARCHAR(32) NOT NULL,
+        user_id VARCHAR(50) NOT NULL,
+        conversation_id VARCHAR(100) NOT NULL,
+        created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        last_used_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (channel, thread_ts, user_id)
+    )
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS idx_thread_conversations_last_used_at
+    ON thread_conversations (last_used_at)
+    """,
+    # メンションのジョブキュー（MENTION_QUEUE_ENABLED=true の場合に複数レプリカで処理を分担）
+    """
+    CREATE TABLE IF NOT EXISTS mention_jobs (
+        id BIGSERIAL PRIMARY KEY,
+        event_key VARCHAR(200) NOT NULL UNIQUE,
+        payload JSONB NOT NULL,
+        status VARCHAR(10) NOT NULL DEFAULT 'pending',
+        attempts INTEGER NOT NULL DEFAULT 0,
+        locked_by VARCHAR(200),
+        locked_until TIMESTAMP,
+        created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        finished_at TIMESTAMP
+    )
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS idx_mention_jobs_open
+    ON mention_jobs (id) WHERE status IN ('pending', 'running')
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS idx_mention_jobs_finished_at
+    ON mention_jobs (finished_at) WHERE finished_at IS NOT NULL
+    """,
+    # ユーザー別・日別の集計テーブル（INSERT時にトリガーで加算）
+    f"""
+    CREATE TABLE IF NOT EXISTS conversation_user_stats (
+        user_id VARCHAR(50) PRIMARY KEY,
+        total_conversations BIGINT NOT NULL DEFAULT 0,
+        error_count BIGINT NOT NULL DEFAULT 0,
+        response_time_sum DOUBLE PRECISION NOT NULL DEFAULT 0,
+        response_time_count BIGINT NOT NULL DEFAULT 0,
+        latency_histogram BIGINT[] NOT NULL DEFAULT array_fill(0::BIGINT, ARRAY[{HISTOGRAM_SIZE}]),
+        last_seen TIMESTAMP
+    )
+    """,
+    f"""
+    CREATE TABLE IF NOT EXISTS conversation_daily_stats (
+        day DATE PRIMARY KEY,
+        total_conversations BIGINT NOT NULL DEFAULT 0,
+        error_count BIGINT NOT NULL DEFAULT 0,
+        response_time_sum DOUBLE PRECISION NOT NULL DEFAULT 0,
+        response_time_count BIGINT NOT NULL DEFAULT 0,
+        latency_histogram BIGINT[] NOT NULL DEFAULT array_fill(0::BIGINT, ARRAY[{HISTOGRAM_SIZE}])
+    )
+    """,
+    """
+    CREATE OR REPLACE FUNCTION rollup_array_add(a BIGINT[], b BIGINT[]) RETURNS BIGINT[] AS $$
+        SELECT array_agg(COALESCE(x, 0) + COALESCE(y, 0) ORDER BY i)
+        FROM unnest(a, b) WITH ORDINALITY AS t(x, y, i)
+    $$ LANGUAGE sql IMMUTABLE
+    """,
+    # 利用者数（conversation_user_statsの行数）。/stats の全体統計で行数を数えずに済むようトリガーで加算する
+    """
+    CREATE TABLE IF NOT EXISTS conversation_total_stats (
+        id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+        total_users BIGINT NOT NULL DEFAULT 0
+    )
+    """,
+    # 文単位のトリガー: INSERTされた行（new_rows）を集約してから加算する
+    # 行ロックはユーザー→日→利用者数の順、それぞれキーの昇順で取るため、複数行の一括INSERTどうしでもデッドロックしない
+    f"""
+    CREATE OR REPLACE FUNCTION conversations_rollup() RETURNS trigger AS $$
+    DECLARE
+        new_users BIGINT;
+    BEGIN
+        WITH upserted AS (
+            INSERT INTO conversation_user_stats AS s
+                (user_id, total_conversations, error_count, response_time_sum, response_time_count, latency_histogram, last_seen)
+            SELECT user_id, COUNT(*), COUNT(*) FILTER (WHERE error_occurred),
+                   COALESCE(SUM(response_time), 0), COUNT(response_time), {_HISTOGRAM_AGG_SQL}, MAX(created_at)
+            FROM new_rows
+            GROUP BY user_id
+            ORDER BY user_id
+            ON CONFLICT (user_id) DO UPDATE SET
+                total_conversations = s.total_conversations + EXCLUDED.total_conversations,
+                error_count = s.error_count + EXCLUDED.error_count,
+                response_time_sum = s.response_time_sum + EXCLUDED.response_time_sum,
+                response_time_count = s.response_time_count + EXCLUDED.response_time_count,
+                latency_histogram = rollup_array_add(s.latency_histogram, EXCLUDED.latency_histogram),
+                last_seen = GREATEST(s.last_seen, EXCLUDED.last_seen)
+            RETURNING xmax = 0 AS inserted
+        )
+        SELECT COUNT(*) FILTER (WHERE inserted) INTO new_users FROM upserted;
+
+        INSERT INTO conversation_daily_stats AS d
+            (day, total_conversations, error_count, response_time_sum, response_time_count, latency_histogram)
+        SELECT COALESCE(created_at, LOCALTIMESTAMP)::date, COUNT(*), COUNT(*) FILTER (WHERE error_occurred),
+               COALESCE(SUM(response_time), 0), COUNT(response_time), {_HISTOGRAM_AGG_SQL}
+        FROM new_rows
+        GROUP BY 1
+        ORDER BY 1
+        ON CONFLICT (day) DO UPDATE SET
+            total_conversations = d.total_conversations + EXCLUDED.total_conversations,
+            error_count = d.error_count + EXCLUDED.error_count,
+            response_time_sum = d.response_time_sum + EXCLUDED.response_time_sum,
+            response_time_count = d.response_time_count + EXCLUDED.response_time_count,
+            latency_histogram = rollup_array_add(d.latency_histogram, EXCLUDED.latency_histogram);
+
+        -- 新しいユーザーがいる場合のみ更新する（毎回ロックを取らない）
+        IF new_users > 0 THEN
+            UPDATE conversation_total_stats SET total_users = total_users + new_users;
+        END IF;
+
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql
+    """,
+    # 既存データからの集計テーブル初期化（トリガー作成前かつ集計が空で会話が存在する場合のみ）
+    f"""
+    DO $$
+    BEGIN
+        IF NOT EXISTS (SELECT 1 FROM pg_trigger WHERE tgname = 'conversations_rollup_trigger') THEN
+            LOCK TABLE conversations IN SHARE ROW EXCLUSIVE MODE;
+
+            IF NOT EXISTS (SELECT 1 FROM conversation_daily_stats) THEN
+                INSERT INTO conversation_user_stats
+                    (user_id, total_conversations, error_count, response_time_sum, response_time_count, latency_histogram, last_seen)
+                SELECT user_id, COUNT(*), COUNT(*) FILTER (WHERE error_occurred),
+                       COALESCE(SUM(response_time), 0), COUNT(response_time), {_HISTOGRAM_AGG_SQL}, MAX(created_at)
+                FROM conversations
+                GROUP BY user_id;
+
+                INSERT INTO conversation_daily_stats
+                    (day, total_conversations, error_count, response_time_sum, response_time_count, latency_histogram)
+                SELECT created_at::date, COUNT(*), COUNT(*) FILTER (WHERE error_occurred),
+                       COALESCE(SUM(response_time), 0), COUNT(response_time), {_HISTOGRAM_AGG_SQL}
+                FROM conversations
+                GROUP BY created_at::date;
+            END IF;
+        END IF;
+
+        IF NOT EXISTS (SELECT 1 FROM conversation_total_stats) THEN
+            -- 数えている間に新しいユーザーが加算されないよう、トリガーの置き換えが終わるまで書き込みを止める
+            LOCK TABLE conversations IN SHARE ROW EXCLUSIVE MODE;
+            INSERT INTO conversation_total_stats (id, total_users)
+            SELECT TRUE, COUNT(*) FROM conversation_user_stats;
+        END IF;
+    END
+    $$
+    """,
+    # 行単位のトリガー（旧バージョン）を文単位のトリガーに置き換える
+    """
+    DROP TRIGGER IF EXISTS conversations_rollup_trigger ON conversations
+    """,
+    """
+    CREATE TRIGGER conversations_rollup_trigger
+    AFTER INSERT ON conversations
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION conversations_rollup()
+    """,
+]
+
+def schema_version(statements: list) -> str:
+    """DDLの内容から求めるスキーマのバージョン（文が変わればバージョンも変わる）"""
+    return hashlib.sha256('\n'.join(statements).encode('utf-8')).hexdigest()[:16]
+
+SCHEMA_VERSION = schema_version(SCHEMA_STATEMENTS)
+
+# 適用済みスキーマのバージョン。起動時に一致すればDDLを実行しない
+SCHEMA_VERSIONS_EXISTS_SQL = "SELECT to_regclass('schema_versions') IS NOT NULL"
+SCHEMA_VERSIONS_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS schema_versions (
+        component VARCHAR(50) PRIMARY KEY,
+        version VARCHAR(64) NOT NULL,
+        applied_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+    )
+"""
+SCHEMA_VERSION_SQL = "SELECT version FROM schema_versions WHERE component = {component}"
+SCHEMA_RECORD_SQL = """
+    INSERT INTO schema_versions (component, version) VALUES ({component}, {version})
+    ON CONFLICT (component) DO UPDATE SET version = EXCLUDED.version, applied_at = now()
+"""
+# 複数のレプリカが同時に起動してもDDLを適用するのは1プロセスだけにする（トランザクション終了時に解放）
+SCHEMA_LOCK_SQL = "SELECT pg_advisory_xact_lock(hashtext('slackbot_schema'))"
+
+def ensure_schema(pool, component: str, version: str, statements: list) -> bool:
+    """
+    記録済みのバージョンが異なる場合のみ、ロックを取ってDDLを適用しバージョンを記録する（psycopg2の接続プール）
+    DDLを適用した場合はTrueを返す
+    """
+    with pool.connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(SCHEMA_VERSIONS_EXISTS_SQL)
+            if cur.fetchone()[0]:
+                cur.execute(SCHEMA_VERSION_SQL.format(component='%s'), (component,))
+                row = cur.fetchone()
+                if row and row[0] == version:
+                    return False
+    with pool.connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(SCHEMA_LOCK_SQL)
+            cur.execute(SCHEMA_VERSIONS_TABLE_SQL)
+            # ロック待ちの間に他のプロセスが適用済みであれば何もしない
+            cur.execute(SCHEMA_VERSION_SQL.format(component='%s'), (component,))
+            row = cur.fetchone()
+            if row and row[0] == version:
+                return False
+            for statement in statements:
+                cur.execute(statement)
+            cur.execute(SCHEMA_RECORD_SQL.format(component='%s', version='%s'), (component, version))
+    return True
+
+async def ensure_schema_async(pool, component: str, version: str, statements: list) -> bool:
+    """ensure_schemaのasyncpg版"""
+    async with pool.acquire() as conn:
+        if await conn.fetchval(SCHEMA_VERSIONS_EXISTS_SQL):
+            if await conn.fetchval(SCHEMA_VERSION_SQL.format(component='$1'), component) == version:
+                return False
+        async with conn.transaction():
+            await conn.execute(SCHEMA_LOCK_SQL)
+            await conn.execute(SCHEMA_VERSIONS_TABLE_SQL)
+            if await conn.fetchval(SCHEMA_VERSION_SQL.format(component='$1'), component) == version:
+                return False
+            for statement in statements:
+                await conn.execute(statement)
+            await conn.execute(SCHEMA_RECORD_SQL.format(component='$1', version='$2'), component, version)
+    return True
+
+def histogram_percentile(histogram: list, q: float):
+    """バケット内を線形補間してヒストグラムからパーセンタイル値（秒）を推定する"""
+    total = sum(histogram)
+    if not total:
+        return None
+
+    target = q * total
+    cumulative = 0
+    for i, count in enumerate(histogram):
+        if count and cumulative + count >= target:
+            lower = LATENCY_BUCKETS[i - 1] if i > 0 else 0.0
+            upper = LATENCY_BUCKETS[i] if i < len(LATENCY_BUCKETS) else lower
+            return lower + (upper - lower) * (target - cumulative) / count
+        cumulative += count
+    return float(LATENCY_BUCKETS[-1])
+
+def summarize_rollup(total: int, errors: int, time_sum: float, time_count: int, histogram: list) -> dict:
+    """集計テーブルの値から /stats 用の統計情報を組み立てる"""
+    return {
+        'total_conversations': total,
+        'error_rate': (errors / total * 100) if total > 0 else 0,
+        'avg_response_time': (time_sum / time_count) if time_count else 0.0,
+        'p50_response_time': histogram_percentile(histogram, 0.5),
+        'p95_response_time': histogram_percentile(histogram, 0.95),
+    }
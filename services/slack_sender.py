@@ -0,0 +1,278 @@
+import time
+import asyncio
+import threading
+from slack_sdk.errors import SlackApiError
+from utils.logger import setup_logger
+from utils.metrics import SLACK_POSTS, SLACK_RETRIES, SLACK_DELIVERY_LATENCY
+from utils.formatters import split_message, SLACK_MESSAGE_MAX_CHARS
+
+logger = setup_logger()
+
+# Slack APIメソッド名 -> WebClientのメソッド名
+_CLIENT_METHODS = {'chat.postMessage': 'chat_postMessage', 'chat.update': 'chat_update', 'chat.delete': 'chat_delete'}
+
+class _ChannelBucket:
+    def __init__(self, now: float):
+        self.next_slot = now  # 一定レートで送り続けた場合に次の送信が始まる時刻（GCRA）
+        self.generation = 0  # レート制限を受けるたびに増やし、待機中の予約をやり直させる
+
+class _SenderBase:
+    def __init__(self, client, rate: float = 1.0, burst: int = 3, max_retries: int = 3,
+                 max_chars: int = SLACK_MESSAGE_MAX_CHARS, max_channels: int = 1000):
+        """
+        rate / burst: チャンネルごとの送信レート（件/秒）と連続送信できる件数
+        max_retries: レート制限（HTTP 429）時に再送する最大回数
+        """
+        self.client = client
+        self.rate = rate
+        self.burst = burst
+        self.max_retries = max_retries
+        self.max_chars = max_chars
+        self.max_channels = max_channels
+
+        self._interval = 1.0 / rate
+        self._tolerance = (burst - 1) * self._interval
+        self._buckets = {}  # channel -> _ChannelBucket
+        self._lock = threading.Lock()
+        self._stats = {'sent': 0, 'throttled': 0, 'skipped': 0, 'rate_limited': 0, 'retries': 0, 'failed': 0,
+                       'total_delivery': 0.0, 'max_delivery': 0.0}
+
+    def _bucket(self, channel: str, now: float) -> _ChannelBucket:
+        bucket = self._buckets.get(channel)
+        if bucket is None:
+            if len(self._buckets) >= self.max_channels:
+                # 送信待ちのないチャンネルは状態を持つ必要がないため破棄する
+                for key in [k for k, b in self._buckets.items() if b.next_slot <= now]:
+                    del self._buckets[key]
+            bucket = self._buckets[channel] = _ChannelBucket(now)
+        return bucket
+
+    def _reserve(self, channel: str, block: bool = True):
+        """
+        送信枠を予約し、(送信まで待つ秒数, 予約時の世代)を返す（予約した順に送信される）
+        block=Falseで待ちが必要な場合は予約せずにNoneを返す
+        """
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._bucket(channel, now)
+            wait = max(0.0, bucket.next_slot - self._tolerance - now)
+            if wait > 0 and not block:
+                self._stats['skipped'] += 1
+                return None
+            bucket.next_slot = max(bucket.next_slot, now) + self._interval
+            if wait > 0:
+                self._stats['throttled'] += 1
+            return wait, bucket.generation
+
+    def _generation(self, channel: str) -> int:
+        with self._lock:
+            bucket = self._buckets.get(channel)
+            return bucket.generation if bucket else 0
+
+    @staticmethod
+    def _retry_after(error: SlackApiError):
+        """レート制限エラーならRetry-Afterの秒数、それ以外はNoneを返す"""
+        response = getattr(error, 'response', None)
+        if response is None or getattr(response, 'status_code', None) != 429:
+            return None
+        headers = {str(k).lower(): v for k, v in (response.headers or {}).items()}
+        value = headers.get('retry-after')
+        if isinstance(value, list):
+            value = value[0] if value else None
+        try:
+            return max(float(value), 0.0)
+        except (TypeError, ValueError):
+            return 1.0
+
+    def _on_rate_limited(self, method: str, channel: str, retry_after: float, attempt: int, generation: int,
+                         block: bool) -> bool:
+        """送信再開時刻を設定し、再送するならTrueを返す（block=Falseの送信は再送せずに見送る）"""
+        now = time.monotonic()
+        with self._lock:
+            self._stats['rate_limited'] += 1
+            # Retry-Afterまでは送信せず、その後は連続送信せずに一定レートで再開する
+            bucket = self._bucket(channel, now)
+            resume_slot = now + retry_after + self._tolerance
+            if bucket.generation == generation:
+                # 待機中の送信はすべて予約し直すため、それまでの予約は破棄する
+                bucket.next_slot = resume_slot
+                bucket.generation += 1
+            else:
+                bucket.next_slot = max(bucket.next_slot, resume_slot)
+            if not block:
+                self._stats['skipped'] += 1
+                return False
+            if attempt >= self.max_retries:
+                self._stats['failed'] += 1
+                return False
+            self._stats['retries'] += 1
+        SLACK_RETRIES.labels(method).inc()
+        logger.warning(f"Slackのレート制限により{retry_after:.1f}秒後に再送します - {method}, チャンネル: {channel}, "
+                       f"再送: {attempt + 1}/{self.max_retries}")
+        return True
+
+    def _on_delivered(self, method: str, start: float):
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            self._stats['sent'] += 1
+            self._stats['total_delivery'] += elapsed
+            self._stats['max_delivery'] = max(self._stats['max_delivery'], elapsed)
+        SLACK_POSTS.labels(method).inc()
+        SLACK_DELIVERY_LATENCY.labels(method).observe(elapsed)
+
+    def get_stats(self) -> dict:
+        """送信件数、レート制限による待機・再送の回数と配信時間を取得"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats['channels'] = len(self._buckets)
+        stats['avg_delivery'] = stats.pop('total_delivery') / stats['sent'] if stats['sent'] else 0.0
+        return stats
+
+class SlackSender(_SenderBase):
+    """Per-channel rate-limited sender (token bucket as GCRA) for chat.postMessage / update / delete that honors Retry-After"""
+
+    def _call(self, method: str, channel: str, block: bool = True, **kwargs):
+        start = time.perf_counter()
+        attempt = 0
+        while True:
+            reservation = self._reserve(channel, block)
+            if reservation is None:
+                return None
+            wait, generation = reservation
+            if wait > 0:
+                time.sleep(wait)
+            if self._generation(channel) != generation:
+                # 待機中に他の送信がレート制限を受けたため、再開時刻に合わせて予約し直す
+                continue
+            try:
+                response = getattr(self.client, _CLIENT_METHODS[method])(channel=channel, **kwargs)
+            except SlackApiError as e:
+                retry_after = self._retry_after(e)
+                if retry_after is None:
+                    raise
+                if not self._on_rate_limited(method, channel, retry_after, attempt, generation, block):
+                    if block:
+                        raise
+                    return None
+                attempt += 1
+                continue
+            self._on_delivered(method, start)
+            return response
+
+    def post(self, channel: str, text: str, thread_ts: str = None, block: bool = True):
+        """メッセージを投稿する（block=Falseで送信枠が空いていなければ送信せずにNoneを返す）"""
+        return self._call('chat.postMessage', channel, block, text=text, thread_ts=thread_ts)
+
+    def update(self, channel: str, ts: str, text: str, block: bool = True):
+        return self._call('chat.update', channel, block, ts=ts, text=text)
+
+    def delete(self, channel: str, ts: str, block: bool = True):
+        return self._call('chat.delete', channel, block, ts=ts)
+
+class AsyncSlackSender(_SenderBase):
+    """Asyncio counterpart of SlackSender for AsyncWebClient"""
+
+    async def _call(self, method: str, channel: str, block: bool = True, **kwargs):
+        start = time.perf_counter()
+        attempt = 0
+        while True:
+            reservation = self._reserve(channel, block)
+            if reservation is None:
+                return None
+            wait, generation = reservation
+            if wait > 0:
+                await asyncio.sleep(wait)
+            if self._generation(channel) != generation:
+                continue
+            try:
+                response = await getattr(self.client, _CLIENT_METHODS[method])(channel=channel, **kwargs)
+            except SlackApiError as e:
+                retry_after = self._retry_after(e)
+                if retry_after is None:
+                    raise
+                if not self._on_rate_limited(method, channel, retry_after, attempt, generation, block):
+                    if block:
+                        raise
+                    return None
+                attempt += 1
+                continue
+            self._on_delivered(method, start)
+            return response
+
+    async def post(self, channel: str, text: str, thread_ts: str = None, block: bool = True):
+        return await self._call('chat.postMessage', channel, block, text=text, thread_ts=thread_ts)
+
+    async def update(self, channel: str, ts: str, text: str, block: bool = True):
+        return await self._call('chat.update', channel, block, ts=ts, text=text)
+
+    async def delete(self, channel: str, ts: str, block: bool = True):
+        return await self._call('chat.delete', channel, block, ts=ts)
+
+class _ThreadReplyBase:
+    def __init__(self, sender, channel: str, thread_ts: str):
+        self.sender = sender
+        self.channel = channel
+        self.thread_ts = thread_ts
+        self._messages = []  # [ts, 送信済みテキスト]
+
+    @property
+    def ts(self):
+        """最初のメッセージのts（未投稿ならNone）"""
+        return self._messages[0][0] if self._messages else None
+
+    def _changes(self, text: str) -> list:
+        """
+        送信済みの内容から変わったメッセージ（番号, テキスト）の一覧
+        新しい内容の方が短い場合、余ったメッセージは後ろから順にテキストをNoneとして含める（削除する）
+        空の応答は投稿できないため、送信済みのメッセージを残して何も変更しない
+        """
+        chunks = split_message(text, self.sender.max_chars)
+        if not chunks:
+            return []
+        changes = [(i, chunk) for i, chunk in enumerate(chunks)
+                   if i >= len(self._messages) or self._messages[i][1] != chunk]
+        return changes + [(i, None) for i in reversed(range(len(chunks), len(self._messages)))]
+
+class ThreadReply(_ThreadReplyBase):
+    """An answer posted to a thread as one or more ordered messages, updated in place as it grows"""
+
+    def send(self, text: str, block: bool = True) -> bool:
+        """
+        長い応答は分割し、既存のメッセージは更新、足りない分はスレッドに追加投稿、余った分は削除する
+        block=False（ストリーミング途中の更新）では送信枠が空いていなければ見送り、Falseを返す
+        """
+        for i, chunk in self._changes(text):
+            if chunk is None:
+                if self.sender.delete(self.channel, self._messages[i][0], block=block) is None:
+                    return False
+                del self._messages[i]
+            elif i < len(self._messages):
+                if self.sender.update(self.channel, self._messages[i][0], chunk, block=block) is None:
+                    return False
+                self._messages[i][1] = chunk
+            else:
+                response = self.sender.post(self.channel, chunk, thread_ts=self.thread_ts, block=block)
+                if response is None:
+                    return False
+                self._messages.append([response['ts'], chunk])
+        return True
+
+class AsyncThreadReply(_ThreadReplyBase):
+    """Asyncio counterpart of ThreadReply"""
+
+    async def send(self, text: str, block: bool = True) -> bool:
+        for i, chunk in self._changes(text):
+            if chunk is None:
+                if await self.sender.delete(self.channel, self._messages[i][0], block=block) is None:
+                    return False
+                del self._messages[i]
+            elif i < len(self._messages):
+                if await self.sender.update(self.channel, self._messages[i][0], chunk, block=block) is None:
+                    return False
+                self._messages[i][1] = chunk
+            else:
+                response = await self.sender.post(self.channel, chunk, thread_ts=self.thread_ts, block=block)
+                if response is None:
+                    return False
+                self._messages.append([response['ts'], chunk])
+        return True
@@ -0,0 +1,4 @@
+import os
+
+# テスト中はログファイルを作成しない（各モジュールのimport時にロガーが設定されるため、先に指定する）
+os.environ['LOG_FILE'] = ''
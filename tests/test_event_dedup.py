@@ -0,0 +1,51 @@
+import time
+
+from services.event_dedup import EventDeduplicator, event_keys
+
+
+class _FailingBackend:
+    def purge(self):
+        pass
+
+    def claim(self, keys, ttl):
+        raise RuntimeError("unavailable")
+
+
+def test_event_keys():
+    assert event_keys('Ev1', 'C1', '1.0') == ['event:Ev1', 'msg:C1:1.0']
+    assert event_keys(None, 'C1', None) == []
+
+
+def test_redelivery_is_suppressed():
+    dedup = EventDeduplicator(ttl=60.0)
+    assert dedup.claim('Ev1', 'C1', '1.0') is True
+    assert dedup.claim('Ev1', 'C1', '1.0') is False
+    # イベントIDが異なっても同じメッセージの再送は破棄する
+    assert dedup.claim('Ev2', 'C1', '1.0') is False
+    assert dedup.get_stats()['suppressed'] == 2
+
+
+def test_entries_expire_after_ttl():
+    dedup = EventDeduplicator(ttl=0.05)
+    assert dedup.claim('Ev1', 'C1', '1.0') is True
+    time.sleep(0.06)
+    assert dedup.claim('Ev1', 'C1', '1.0') is True
+    assert dedup.get_stats()['entries'] == 2
+
+
+def test_oldest_entries_are_evicted():
+    dedup = EventDeduplicator(ttl=60.0, max_entries=4)
+    for i in range(3):
+        assert dedup.claim(f'Ev{i}', 'C1', f'{i}.0') is True
+    stats = dedup.get_stats()
+    assert stats['entries'] == 4
+    assert stats['evictions'] == 2
+    # 追い出された最も古いイベントは再送として検出できない
+    assert dedup.claim('Ev0', 'C1', '0.0') is True
+    assert dedup.claim('Ev2', 'C1', '2.0') is False
+
+
+def test_backend_error_does_not_drop_event():
+    dedup = EventDeduplicator(backend=_FailingBackend())
+    assert dedup.claim('Ev1', 'C1', '1.0') is True
+    assert dedup.get_stats()['backend_errors'] == 1
@@ -0,0 +1,32 @@
+from utils.formatters import _CODE_FENCE, split_message
+
+
+def test_short_text_is_single_chunk():
+    assert split_message("こんにちは", 100) == ["こんにちは"]
+
+
+def test_empty_text_has_no_chunks():
+    assert split_message("", 100) == []
+    assert split_message(" \n\n ", 100) == []
+
+
+def test_splits_on_paragraph_within_limit():
+    text = "a" * 60 + "\n\n" + "b" * 60
+    assert split_message(text, 100) == ["a" * 60, "b" * 60]
+
+
+def test_code_fence_is_closed_and_reopened():
+    text = "前置き\n```python\n" + "\n".join(f"print({i})" for i in range(100)) + "\n```\n後書き"
+    chunks = split_message(text, 300)
+    assert len(chunks) > 1
+    assert all(len(chunk) <= 300 for chunk in chunks)
+    for chunk in chunks[:-1]:
+        assert chunk.count(_CODE_FENCE) % 2 == 0
+    assert all(chunk.startswith("```python\n") for chunk in chunks[1:-1])
+    assert chunks[-1].endswith("後書き")
+
+
+def test_small_max_chars_terminates():
+    chunks = split_message("```python\n" + "x" * 50 + "\n```", 4)
+    assert chunks
+    assert all(chunk.strip() for chunk in chunks)
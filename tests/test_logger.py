@@ -0,0 +1,25 @@
+import logging
+import queue
+
+from utils.logger import LazyJson, _NonBlockingQueueHandler
+
+
+def _record(msg, args):
+    return logging.LogRecord('test', logging.INFO, __file__, 1, msg, args, None)
+
+
+def test_mutable_args_are_formatted_eagerly():
+    handler = _NonBlockingQueueHandler(queue.Queue())
+    payload = {'count': 1}
+    prepared = handler.prepare(_record('payload=%s', (payload,)))
+    payload['count'] = 2
+    assert prepared.args is None
+    assert prepared.getMessage() == "payload={'count': 1}"
+
+
+def test_lazy_json_is_deferred():
+    handler = _NonBlockingQueueHandler(queue.Queue())
+    lazy = LazyJson({'a': 1})
+    prepared = handler.prepare(_record('%s: %s', ('body', lazy)))
+    assert prepared.args == ('body', lazy)
+    assert prepared.getMessage() == 'body: {"a": 1}'
@@ -0,0 +1,72 @@
+import time
+
+import pytest
+
+from services.resilience import AdaptiveTimeout, CircuitBreaker, CircuitOpenError
+
+
+def _call(breaker, ok: bool):
+    breaker.before_call()
+    if ok:
+        breaker.record_success()
+    else:
+        breaker.record_failure()
+
+
+def test_breaker_opens_half_opens_and_closes():
+    breaker = CircuitBreaker('test', failure_rate_threshold=0.5, window_size=4, min_calls=4, open_duration=0.05)
+    for ok in (True, False, True):
+        _call(breaker, ok)
+    assert breaker.state == CircuitBreaker.CLOSED
+
+    _call(breaker, False)
+    assert breaker.state == CircuitBreaker.OPEN
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+
+    time.sleep(0.06)
+    assert breaker.before_call() is True
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    # 半開状態では試行呼び出し以外を通さない
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED
+    stats = breaker.get_stats()
+    assert (stats['opened'], stats['half_opened'], stats['closed']) == (1, 1, 1)
+    assert stats['failure_rate'] == 0.0
+
+
+def test_failed_probe_reopens_breaker():
+    breaker = CircuitBreaker('test', window_size=2, min_calls=2, open_duration=0.05)
+    _call(breaker, False)
+    _call(breaker, False)
+    assert breaker.state == CircuitBreaker.OPEN
+
+    time.sleep(0.06)
+    breaker.before_call()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+
+
+def test_adaptive_timeout_follows_observed_latency():
+    timeout = AdaptiveTimeout(default=30.0, minimum=1.0, percentile=0.9, multiplier=2.0, min_samples=10)
+    assert timeout.current() == 30.0
+    for _ in range(10):
+        timeout.observe(2.0)
+    assert timeout.current() == 4.0
+
+
+def test_adaptive_timeout_resets_after_adaptive_cutoff():
+    timeout = AdaptiveTimeout(default=30.0, minimum=1.0, multiplier=2.0, min_samples=10)
+    for _ in range(10):
+        timeout.observe(2.0)
+    # 上限で打ち切った場合は観測値を残す
+    timeout.observe_timeout(30.0)
+    assert timeout.current() == 4.0
+    # 適応値で打ち切った場合は既定値に戻す
+    timeout.observe_timeout(timeout.current())
+    assert timeout.current() == 30.0
@@ -0,0 +1,122 @@
+import threading
+import time
+
+import pytest
+
+from services.errors import SchedulerBusyError
+from services.scheduler import FairScheduler
+
+
+def _wait_for(predicate, timeout: float = 2.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, "条件を満たさないままタイムアウトしました"
+        time.sleep(0.005)
+
+
+class _Client:
+    """別スレッドで実行枠を確保し、確保できた順番を記録する"""
+
+    def __init__(self, scheduler, name, user, channel, order):
+        self.acquired = threading.Event()
+        self.error = None
+
+        def run():
+            try:
+                scheduler.acquire(user, channel)
+                order.append(name)
+            except SchedulerBusyError as e:
+                self.error = e
+            self.acquired.set()
+
+        self.thread = threading.Thread(target=run, daemon=True)
+        self.thread.start()
+
+
+def test_free_slot_is_granted_immediately():
+    scheduler = FairScheduler(max_concurrency=2)
+    scheduler.acquire('u1', 'c1')
+    scheduler.acquire('u2', 'c1')
+    assert scheduler.get_stats()['active'] == 2
+    scheduler.release('u1')
+    scheduler.release('u2')
+    assert scheduler.get_stats()['active'] == 0
+
+
+def test_handoff_is_round_robin_across_channels():
+    scheduler = FairScheduler(max_concurrency=1, max_queue_depth=8, max_queue_per_user=4, max_wait=5.0)
+    scheduler.acquire('holder', 'c0')
+    order = []
+    clients = []
+    for name, user, channel in [('a1', 'alice', 'busy'), ('a2', 'alice', 'busy'), ('b1', 'bob', 'quiet')]:
+        clients.append(_Client(scheduler, name, user, channel, order))
+        _wait_for(lambda: scheduler.get_stats()['queue_depth'] == len(clients))
+
+    users = {'a1': 'alice', 'a2': 'alice', 'b1': 'bob'}
+    releasing = 'holder'
+    for expected in ['a1', 'b1', 'a2']:
+        scheduler.release(releasing)
+        _wait_for(lambda: len(order) == ['a1', 'b1', 'a2'].index(expected) + 1)
+        assert order[-1] == expected
+        releasing = users[expected]
+    scheduler.release(releasing)
+    assert scheduler.get_stats()['active'] == 0
+    assert all(client.error is None for client in clients)
+
+
+def test_per_user_active_cap_lets_other_users_pass():
+    scheduler = FairScheduler(max_concurrency=2, max_active_per_user=1, max_wait=5.0)
+    scheduler.acquire('alice', 'c1')
+    order = []
+    waiting = _Client(scheduler, 'a2', 'alice', 'c1', order)
+    _wait_for(lambda: scheduler.get_stats()['queue_depth'] == 1)
+
+    # 空き枠があっても上限に達したユーザーは待機し、他のユーザーは待たずに確保できる
+    scheduler.acquire('bob', 'c1')
+    assert order == []
+    scheduler.release('alice')
+    waiting.acquired.wait(2.0)
+    assert order == ['a2']
+    scheduler.release('alice')
+    scheduler.release('bob')
+
+
+def test_sheds_when_queue_is_full():
+    scheduler = FairScheduler(max_concurrency=1, max_queue_depth=1, max_queue_per_user=1, max_wait=5.0)
+    scheduler.acquire('holder', 'c0')
+    order = []
+    _Client(scheduler, 'a1', 'alice', 'c1', order)
+    _wait_for(lambda: scheduler.get_stats()['queue_depth'] == 1)
+
+    with pytest.raises(SchedulerBusyError):
+        scheduler.acquire('bob', 'c1')
+    assert scheduler.get_stats()['shed'] == 1
+    scheduler.release('holder')
+    _wait_for(lambda: order == ['a1'])
+    scheduler.release('alice')
+
+
+def test_sheds_when_user_queue_is_full():
+    scheduler = FairScheduler(max_concurrency=1, max_queue_depth=8, max_queue_per_user=1, max_wait=5.0)
+    scheduler.acquire('holder', 'c0')
+    order = []
+    _Client(scheduler, 'a1', 'alice', 'c1', order)
+    _wait_for(lambda: scheduler.get_stats()['queue_depth'] == 1)
+
+    with pytest.raises(SchedulerBusyError):
+        scheduler.acquire('alice', 'c2')
+    scheduler.release('holder')
+    _wait_for(lambda: order == ['a1'])
+    scheduler.release('alice')
+
+
+def test_wait_timeout_removes_waiter():
+    scheduler = FairScheduler(max_concurrency=1, max_wait=0.05)
+    scheduler.acquire('holder', 'c0')
+    with pytest.raises(SchedulerBusyError):
+        scheduler.acquire('alice', 'c1')
+    stats = scheduler.get_stats()
+    assert stats['timeouts'] == 1
+    assert stats['queue_depth'] == 0
+    scheduler.release('holder')
+    assert scheduler.get_stats()['active'] == 0
@@ -0,0 +1,53 @@
+import os
+from utils.logger import setup_logger
+from utils.formatters import SLACK_MESSAGE_MAX_CHARS, SLACK_MESSAGE_MIN_CHARS
+
+logger = setup_logger()
+
+def validate_token_format(token: str, token_type: str) -> bool:
+    """トークンの形式を検証する"""
+    if token_type == "bot" and not token.startswith("xoxb-"):
+        logger.error(f"SLACK_BOT_TOKENの形式が正しくありません（'xoxb-'で始まる必要があります）")
+        return False
+    elif token_type == "app" and not token.startswith("xapp-"):
+        logger.error(f"SLACK_APP_TOKENの形式が正しくありません（'xapp-'で始まる必要があります）")
+        return False
+    return True
+
+def get_required_env_var(var_name: str, token_type: str = None) -> str:
+    """環境変数を取得し、必要に応じてトークンの形式を検証する"""
+    value = os.environ.get(var_name)
+    if not value:
+        logger.error(f"環境変数 {var_name} が設定されていません")
+        raise ValueError(f"環境変数 {var_name} が設定されていません")
+
+    if token_type and not validate_token_format(value, token_type):
+        raise ValueError(
+            f"{var_name}の形式が正しくありません。\n"
+            f"{'Bot User OAuth Token' if token_type == 'bot' else 'App-Level Token'}を"
+            f"Slack API設定画面から取得してください。"
+        )
+    return value
+
+def load_slack_credentials() -> tuple:
+    """Slack/Difyの必須環境変数を読み込む"""
+    try:
+        slack_bot_token = get_required_env_var("SLACK_BOT_TOKEN", "bot")
+        slack_app_token = get_required_env_var("SLACK_APP_TOKEN", "app")
+        dify_api_key = get_required_env_var("DIFY_API_KEY")
+    except ValueError as e:
+        logger.error(f"環境変数エラー: {str(e)}")
+        logger.error("Slackアプリの設定を確認してください:")
+        logger.error("1. SLACK_BOT_TOKEN: Bot User OAuth Token（api.slack.com/apps > OAuth & Permissions）")
+        logger.error("2. SLACK_APP_TOKEN: App-Level Token（api.slack.com/apps > Basic Information）")
+        logger.error("3. Socket Mode: 有効化（api.slack.com/apps > Socket Mode）")
+        raise
+    return slack_bot_token, slack_app_token, dify_api_key
+
+def load_message_max_chars() -> int:
+    """SLACK_MESSAGE_MAX_CHARSを読み込む（小さすぎる値では分割できないため下限に切り上げる）"""
+    value = int(os.environ.get("SLACK_MESSAGE_MAX_CHARS", str(SLACK_MESSAGE_MAX_CHARS)))
+    if value < SLACK_MESSAGE_MIN_CHARS:
+        logger.warning(f"SLACK_MESSAGE_MAX_CHARS（{value}）が小さすぎるため{SLACK_MESSAGE_MIN_CHARS}を使用します")
+        return SLACK_MESSAGE_MIN_CHARS
+    return value
@@ -0,0 +1,71 @@
+def format_stats_message(stats: dict) -> str:
+    """統計情報をSlackメッセージ形式に整形"""
+    message = []
+    message.append("*使用統計情報*\n")
+    message.append(f"• 総会話数: {stats['total_conversations']}")
+    message.append(f"• 平均応答時間: {stats['avg_response_time']:.2f}秒")
+    message.append(f"• エラー率: {stats['error_rate']:.1f}%")
+
+    if stats.get('p50_response_time') is not None:
+        message.append(f"• 応答時間 p50 / p95: {stats['p50_response_time']:.2f}秒 / {stats['p95_response_time']:.2f}秒")
+
+    if 'recent_conversations' in stats:
+        message.append("\n*最近の会話*")
+        for conv in stats['recent_conversations'][:3]:  # 最新3件のみ表示
+            message.append(f"• {conv['created_at'].strftime('%Y-%m-%d %H:%M')} - {conv['message'][:50]}...")
+
+    if 'total_users' in stats:
+        message.append(f"\n• 総ユーザー数: {stats['total_users']}")
+
+    return "\n".join(message)
+
+# Slackの1メッセージあたりの文字数上限（表示が切り詰められない目安）
+SLACK_MESSAGE_MAX_CHARS = 3900
+# 設定できる上限の最小値（コードブロックの開き直しと閉じの分を除いても本文が入るようにする）
+SLACK_MESSAGE_MIN_CHARS = 200
+
+# 分割位置の候補（優先度順）
+_SPLIT_SEPARATORS = ("\n\n", "\n", "。", ". ", " ")
+_CODE_FENCE = "```"
+
+def _find_split(text: str, limit: int) -> int:
+    """limit文字以内で最も自然な分割位置を返す（短すぎる分割は避ける）"""
+    window = text[:limit]
+    for separator in _SPLIT_SEPARATORS:
+        index = window.rfind(separator)
+        if index >= limit // 2:
+            return index + len(separator)
+    return limit
+
+def _open_code_fence(text: str):
+    """末尾でコードブロックが閉じていなければ、開始行（```python など）を返す"""
+    fence = None
+    for line in text.split("\n"):
+        if line.lstrip().startswith(_CODE_FENCE):
+            fence = None if fence else line.strip()
+    return fence
+
+def split_message(text: str, max_chars: int = SLACK_MESSAGE_MAX_CHARS) -> list:
+    """
+    長い応答を段落・改行・文末の順に区切りを探してmax_chars以内のメッセージに分割する
+    空白のみのメッセージはSlackに投稿できないため含めない（空の応答は空のリストを返す）
+    """
+    chunks = []
+    reopen = ""  # 前のメッセージで閉じたコードブロックを開き直す行
+    rest = text
+    while len(reopen) + len(rest) > max_chars:
+        # コードブロックを閉じる「\n```」の分を残しておく（max_charsが小さすぎても1文字ずつは進める）
+        cut = max(1, _find_split(rest, max_chars - len(reopen) - len(_CODE_FENCE) - 1))
+        chunk = reopen + rest[:cut].rstrip()
+        rest = rest[cut:].lstrip("\n")
+        fence = _open_code_fence(chunk)
+        if fence:
+            chunk += "\n" + _CODE_FENCE
+            reopen = fence + "\n"
+        else:
+            reopen = ""
+        if chunk.strip():
+            chunks.append(chunk)
+    if rest.strip():
+        chunks.append(reopen + rest)
+    return chunks
@@ -0,0 +1,76 @@
+"""HTTP endpoint for Prometheus scraping and liveness/readiness probes"""
+import os
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from utils.logger import setup_logger
+from utils.metrics import REGISTRY
+
+logger = setup_logger()
+
+_ready = threading.Event()
+_readiness_checks = {}  # 名前 -> 真偽値を返す関数
+
+def set_ready(ready: bool = True):
+    """起動処理の完了（True）または終了処理の開始（False）を通知する"""
+    if ready:
+        _ready.set()
+    else:
+        _ready.clear()
+
+def add_readiness_check(name: str, check):
+    """readyz で評価する確認処理を登録する"""
+    _readiness_checks[name] = check
+
+def readiness() -> tuple:
+    """(準備完了か, 確認結果の詳細)を返す"""
+    results = {'started': _ready.is_set()}
+    for name, check in list(_readiness_checks.items()):
+        try:
+            results[name] = bool(check())
+        except Exception as e:
+            logger.warning(f"readiness確認に失敗しました - {name}: {str(e)}")
+            results[name] = False
+    return all(results.values()), results
+
+class _HealthHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        path = self.path.split('?', 1)[0]
+        if path == '/metrics':
+            self._send(200, REGISTRY.render(), 'text/plain; version=0.0.4; charset=utf-8')
+        elif path == '/healthz':
+            self._send_json(200, {'status': 'ok'})
+        elif path == '/readyz':
+            ready, checks = readiness()
+            self._send_json(200 if ready else 503, {'status': 'ok' if ready else 'unavailable', 'checks': checks})
+        else:
+            self._send_json(404, {'status': 'not_found'})
+
+    def _send_json(self, status: int, payload: dict):
+        self._send(status, json.dumps(payload), 'application/json')
+
+    def _send(self, status: int, body: str, content_type: str):
+        data = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+
+def start_health_server():
+    """METRICS_PORTが設定されていればバックグラウンドでHTTPサーバーを起動する"""
+    port = os.environ.get('METRICS_PORT', '8080')
+    if not port:
+        logger.info("METRICS_PORTが未設定のため、メトリクス・ヘルスチェックのエンドポイントは起動しません")
+        return None
+    host = os.environ.get('METRICS_HOST', '0.0.0.0')
+    server = _Server((host, int(port)), _HealthHandler)
+    threading.Thread(target=server.serve_forever, name='health-server', daemon=True).start()
+    logger.info(f"メトリクス・ヘルスチェックのエンドポイントを起動しました - http://{host}:{port}/metrics, /healthz, /readyz")
+    return server
@@ -0,0 +1,82 @@
+"""Startup phase timing and in-flight request tracking for graceful shutdown"""
+import os
+import time
+import asyncio
+import threading
+from contextlib import contextmanager
+from utils.logger import setup_logger
+from utils.metrics import STARTUP_DURATION, INFLIGHT_MENTIONS
+
+logger = setup_logger()
+
+def process_start_time() -> float:
+    """プロセスの開始時刻（time.time()基準）。/procが読めない環境ではこの関数の呼び出し時刻"""
+    try:
+        with open('/proc/self/stat') as f:
+            # 22番目のフィールド（starttime）は起動からのクロック数。コマンド名に空白を含む場合があるため ')' の後から数える
+            start_ticks = int(f.read().rsplit(')', 1)[1].split()[19])
+        with open('/proc/uptime') as f:
+            uptime = float(f.read().split()[0])
+        return time.time() - uptime + start_ticks / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError):
+        return time.time()
+
+class StartupTimer:
+    """Measures each startup phase and the total time from process start until ready"""
+
+    def __init__(self):
+        self.started_at = process_start_time()
+        self.phases = {}  # フェーズ名 -> 所要秒数
+
+    @contextmanager
+    def phase(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = time.perf_counter() - start
+            logger.info(f"起動処理 {name}: {self.phases[name]:.3f}秒")
+
+    def ready(self) -> float:
+        """準備完了までの時間を記録してログに出力し、秒数を返す"""
+        elapsed = time.time() - self.started_at
+        STARTUP_DURATION.set(elapsed)
+        details = ', '.join(f"{name}: {seconds:.2f}秒" for name, seconds in self.phases.items())
+        logger.info(f"起動が完了しました - プロセス開始から{elapsed:.2f}秒（{details}）")
+        return elapsed
+
+class InFlightTracker:
+    """Counts mentions being processed so shutdown can wait for them to finish"""
+
+    def __init__(self):
+        self._count = 0
+        self._cond = threading.Condition()
+        INFLIGHT_MENTIONS.set_function(lambda: self._count)
+
+    @property
+    def count(self) -> int:
+        return self._count
+
+    @contextmanager
+    def track(self):
+        with self._cond:
+            self._count += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._count -= 1
+                if not self._count:
+                    self._cond.notify_all()
+
+    def wait_idle(self, timeout: float) -> bool:
+        """処理中のメンションがなくなるまで待つ（タイムアウトした場合はFalse）"""
+        with self._cond:
+            return self._cond.wait_for(lambda: not self._count, timeout)
+
+    async def wait_idle_async(self, timeout: float) -> bool:
+        """wait_idleの非同期版（イベントループを止めずに待つ）"""
+        deadline = time.monotonic() + timeout
+        while self._count and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        return not self._count
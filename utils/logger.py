@@ -1,33 +1,166 @@
-import logging
+import os
 import sys
-from logging.handlers import RotatingFileHandler
+import json
+import copy
+import queue
+import atexit
+import logging
+import threading
+from datetime import datetime, timezone
+from logging.handlers import RotatingFileHandler, TimedRotatingFileHandler, QueueHandler, QueueListener
+from dotenv import load_dotenv
 
-def setup_logger():
-    """Configure and return a logger instance"""
-    logger = logging.getLogger('slack_bot')
-    logger.setLevel(logging.DEBUG)  # より詳細なログを取得するためDEBUGレベルに設定
+LOGGER_NAME = 'slack_bot'
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+# LogRecordの標準属性（これ以外はextraとしてJSONに含める）
+_RECORD_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime', 'taskName'}
+
+_lock = threading.Lock()
+_listener = None
+_queue_handler = None
+
+class LazyJson:
+    """ログ出力時（レベルが有効な場合のみ）にJSON文字列へ変換する"""
+
+    __slots__ = ('obj', 'indent')
+
+    def __init__(self, obj, indent: int = None):
+        self.obj = obj
+        self.indent = indent
+
+    def __str__(self):
+        return json.dumps(self.obj, ensure_ascii=False, indent=self.indent, default=str)
+
+class JsonFormatter(logging.Formatter):
+    """1レコードを1行のJSONとして出力する"""
+
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'thread': record.threadName,
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRS and not key.startswith('_'):
+                entry[key] = value
+        if record.exc_info:
+            entry['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+# LazyJsonと一緒に渡されてもメッセージの組み立てを遅らせてよい（変更されない）引数の型
+_IMMUTABLE_ARG_TYPES = (str, int, float, bool, bytes, type(None))
+
+def _is_deferrable(args) -> bool:
+    """LazyJsonを含み、それ以外の引数が変更されない値だけの場合に限りメッセージの組み立てを遅らせる"""
+    if not isinstance(args, tuple) or not any(isinstance(arg, LazyJson) for arg in args):
+        return False
+    return all(isinstance(arg, (LazyJson,) + _IMMUTABLE_ARG_TYPES) for arg in args)
+
+class _NonBlockingQueueHandler(QueueHandler):
+    """LazyJson以外のメッセージを組み立ててレコードをキューへ積み、満杯時は待たずに破棄する"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        if not _is_deferrable(record.args):
+            # 引数が後から変更されてもログの内容が変わらないよう、呼び出し元スレッドでメッセージを組み立てる
+            record.msg = record.getMessage()
+            record.args = None
+        # LazyJsonの変換と例外の整形はリスナースレッドに任せる
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+def _create_formatter(log_format: str) -> logging.Formatter:
+    if log_format == 'json':
+        return JsonFormatter()
+    return logging.Formatter(TEXT_FORMAT)
+
+def _create_file_handler(path: str) -> logging.Handler:
+    """LOG_ROTATE_WHEN指定時は時間、それ以外はサイズでローテーションする"""
+    backup_count = int(os.environ.get('LOG_BACKUP_COUNT', '5'))
+    rotate_when = os.environ.get('LOG_ROTATE_WHEN')
+    if rotate_when:
+        return TimedRotatingFileHandler(path, when=rotate_when, backupCount=backup_count, encoding='utf-8')
+    return RotatingFileHandler(
+        path,
+        maxBytes=int(os.environ.get('LOG_MAX_BYTES', str(1024 * 1024))),  # 1MB
+        backupCount=backup_count,
+        encoding='utf-8'
+    )
+
+def _configure(logger: logging.Logger):
+    global _listener, _queue_handler
+
+    # 各モジュールのimport時に呼ばれるため、.envの設定をここで読み込んでおく
+    load_dotenv()
+    level = os.environ.get('LOG_LEVEL', 'INFO').upper()
+    log_format = os.environ.get('LOG_FORMAT', 'text').lower()
+    log_file = os.environ.get('LOG_FILE', 'app.log')
+
+    logger.setLevel(level)
+    formatter = _create_formatter(log_format)
 
     # コンソールハンドラ
     console_handler = logging.StreamHandler(sys.stdout)
-    console_handler.setLevel(logging.INFO)
-    console_format = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-    console_handler.setFormatter(console_format)
-
-    # ファイルハンドラ（ローテーション付き）
-    file_handler = RotatingFileHandler(
-        'app.log',
-        maxBytes=1024 * 1024,  # 1MB
-        backupCount=5
-    )
-    file_handler.setLevel(logging.DEBUG)
-    file_format = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-    file_handler.setFormatter(file_format)
+    console_handler.setLevel(max(logging.INFO, logger.level))
+    console_handler.setFormatter(formatter)
+    handlers = [console_handler]
+
+    # ファイルハンドラ（ローテーション付き、LOG_FILEが空なら出力しない）
+    if log_file:
+        file_handler = _create_file_handler(log_file)
+        file_handler.setFormatter(formatter)
+        handlers.append(file_handler)
 
-    # 既存のハンドラをクリア
     logger.handlers.clear()
+    if os.environ.get('LOG_ASYNC', 'true').lower() == 'true':
+        # 呼び出し元スレッドはキューに積むだけで、整形とI/Oはリスナースレッドが行う
+        _queue_handler = _NonBlockingQueueHandler(queue.Queue(int(os.environ.get('LOG_QUEUE_SIZE', '10000'))))
+        _listener = QueueListener(_queue_handler.queue, *handlers, respect_handler_level=True)
+        _listener.start()
+        logger.addHandler(_queue_handler)
+        atexit.register(shutdown_logger)
+    else:
+        for handler in handlers:
+            logger.addHandler(handler)
+    logger.propagate = False
+
+def setup_logger():
+    """Configure the shared logger once and return it"""
+    logger = logging.getLogger(LOGGER_NAME)
+    with _lock:
+        if not getattr(logger, '_slack_bot_configured', False):
+            _configure(logger)
+            logger._slack_bot_configured = True
+    return logger
 
-    # ハンドラを追加
-    logger.addHandler(console_handler)
-    logger.addHandler(file_handler)
+def get_logger_stats() -> dict:
+    """非同期ロギングのキュー滞留数と破棄件数を取得"""
+    if _queue_handler is None:
+        return {'async': False}
+    return {'async': True, 'queued': _queue_handler.queue.qsize(), 'dropped': _queue_handler.dropped}
 
-    return logger
\ No newline at end of file
+def shutdown_logger():
+    """キューに残ったログを書き出してリスナースレッドを停止する（以降は同期的に出力する）"""
+    global _listener, _queue_handler
+    with _lock:
+        listener, _listener = _listener, None
+        queue_handler, _queue_handler = _queue_handler, None
+    if listener is None:
+        return
+    listener.stop()
+    logger = logging.getLogger(LOGGER_NAME)
+    logger.removeHandler(queue_handler)
+    for handler in listener.handlers:
+        logger.addHandler(handler)
@@ -0,0 +1,193 @@
+"""In-process metrics registry rendered in the Prometheus text exposition format"""
+import bisect
+import threading
+
+DEFAULT_LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60)
+DB_LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+
+def _escape(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def _format_labels(names: tuple, values: tuple, extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+class _Metric:
+    type_name = ''
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+        if not self.labelnames:
+            self.labels()
+        (registry or REGISTRY).register(self)
+
+    def labels(self, *values):
+        """ラベル値ごとの子メトリクスを返す"""
+        if len(values) != len(self.labelnames):
+            raise ValueError(f"{self.name} のラベル数が一致しません: {values}")
+        key = tuple(str(v) for v in values)
+        with self._lock:
+            child = self._children.get(key)
+            if child is None:
+                child = self._children[key] = self._new_child()
+            return child
+
+    def _default(self):
+        return self.labels()
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}"]
+        with self._lock:
+            children = list(self._children.items())
+        for values, child in children:
+            lines.extend(child.render(self.name, self.labelnames, values))
+        return lines
+
+class _CounterChild:
+    def __init__(self):
+        self._value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0):
+        with self._lock:
+            self._value += amount
+
+    def render(self, name, labelnames, values):
+        return [f"{name}{_format_labels(labelnames, values)} {_format_value(self._value)}"]
+
+class Counter(_Metric):
+    type_name = 'counter'
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount: float = 1.0):
+        self._default().inc(amount)
+
+class _GaugeChild:
+    def __init__(self):
+        self._value = 0.0
+        self._function = None
+
+    def set(self, value: float):
+        self._value = value
+
+    def set_function(self, function):
+        """出力時にfunctionを呼び出して値を取得する"""
+        self._function = function
+
+    def render(self, name, labelnames, values):
+        value = self._value
+        if self._function is not None:
+            try:
+                value = self._function()
+            except Exception:
+                return []
+        return [f"{name}{_format_labels(labelnames, values)} {_format_value(value)}"]
+
+class Gauge(_Metric):
+    type_name = 'gauge'
+
+    def _new_child(self):
+        return _GaugeChild()
+
+    def set(self, value: float):
+        self._default().set(value)
+
+    def set_function(self, function):
+        self._default().set_function(function)
+
+class _HistogramChild:
+    def __init__(self, buckets: tuple):
+        self._buckets = buckets
+        self._counts = [0] * (len(buckets) + 1)
+        self._sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        index = bisect.bisect_left(self._buckets, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+
+    def render(self, name, labelnames, values):
+        with self._lock:
+            counts = list(self._counts)
+            total = self._sum
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self._buckets + (float('inf'),), counts):
+            cumulative += count
+            le = f'le="{_format_value(bound)}"'
+            lines.append(f"{name}_bucket{_format_labels(labelnames, values, le)} {cumulative}")
+        lines.append(f"{name}_sum{_format_labels(labelnames, values)} {_format_value(total)}")
+        lines.append(f"{name}_count{_format_labels(labelnames, values)} {cumulative}")
+        return lines
+
+class Histogram(_Metric):
+    type_name = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = DEFAULT_LATENCY_BUCKETS,
+                 registry=None):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames, registry)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value: float):
+        self._default().observe(value)
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric: _Metric):
+        with self._lock:
+            if any(m.name == metric.name for m in self._metrics):
+                raise ValueError(f"メトリクス名が重複しています: {metric.name}")
+            self._metrics.append(metric)
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+REGISTRY = Registry()
+
+# アプリケーション共通のメトリクス
+MENTIONS = Counter('slackbot_mentions_total', 'Handled app_mention events (after deduplication)')
+EVENTS_DEDUPLICATED = Counter('slackbot_events_deduplicated_total', 'Redelivered Slack events dropped before processing')
+MENTION_JOBS = Counter('slackbot_mention_jobs_total', 'Mention jobs in the shared work queue, by outcome', ('outcome',))
+ERRORS = Counter('slackbot_errors_total', 'Mentions answered with an error message, by error class', ('type',))
+SLACK_POSTS = Counter('slackbot_slack_posts_total', 'Slack Web API message posts', ('method',))
+SLACK_RETRIES = Counter('slackbot_slack_retries_total', 'Slack posts retried after a rate-limit (HTTP 429) response', ('method',))
+SLACK_DELIVERY_LATENCY = Histogram('slackbot_slack_delivery_duration_seconds',
+                                   'Time from queuing a Slack post until Slack accepted it, including rate-limit waits',
+                                   ('method',))
+DIFY_LATENCY = Histogram('slackbot_dify_request_duration_seconds', 'Dify chat-messages request duration', ('mode',))
+DB_WRITE_LATENCY = Histogram('slackbot_db_write_duration_seconds', 'Conversation log write duration', ('operation',),
+                             buckets=DB_LATENCY_BUCKETS)
+REPLY_LATENCY = Histogram('slackbot_reply_latency_seconds', 'Time from receiving a mention to posting the final reply')
+CIRCUIT_STATE = Gauge('slackbot_circuit_breaker_state', 'Circuit breaker state (0=closed, 1=half_open, 2=open)', ('name',))
+SCHEDULER_ACTIVE = Gauge('slackbot_scheduler_active', 'Dify calls currently holding a scheduler slot')
+SCHEDULER_QUEUE_DEPTH = Gauge('slackbot_scheduler_queue_depth', 'Mentions waiting for a scheduler slot')
+DB_POOL_IN_USE = Gauge('slackbot_db_pool_in_use', 'Database connections checked out of the pool')
+WRITER_QUEUE_DEPTH = Gauge('slackbot_conversation_writer_queue_depth', 'Conversation logs waiting for write-behind')
+STARTUP_DURATION = Gauge('slackbot_startup_duration_seconds', 'Time from process start until the bot reported ready')
+INFLIGHT_MENTIONS = Gauge('slackbot_inflight_mentions', 'Mentions currently being processed (drained on shutdown)')
@@ -0,0 +1,56 @@
+import os
+import time
+import uuid
+import random
+import logging
+from contextlib import contextmanager
+from utils.logger import LazyJson
+
+trace_logger = logging.getLogger('slack_bot.trace')
+
+TRACE_SAMPLE_RATE = float(os.environ.get('TRACE_SAMPLE_RATE', '1.0'))
+
+class Trace:
+    """Lightweight span recorder for one handled event"""
+
+    def __init__(self, name: str, trace_id: str = None, sample_rate: float = None):
+        self.name = name
+        self.trace_id = trace_id or uuid.uuid4().hex
+        rate = TRACE_SAMPLE_RATE if sample_rate is None else sample_rate
+        self.sampled = rate >= 1.0 or random.random() < rate
+        self.spans = {}
+        self.attributes = {}
+        self._start = time.perf_counter()
+
+    @contextmanager
+    def span(self, name: str):
+        """処理区間の所要時間（秒）を記録する"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            # 同名の区間が複数回あれば合算する
+            self.spans[name] = self.spans.get(name, 0.0) + (time.perf_counter() - start)
+
+    def set(self, key: str, value):
+        """トレースに付加情報を設定する"""
+        self.attributes[key] = value
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self._start
+
+    def to_dict(self) -> dict:
+        return {
+            'trace_id': self.trace_id,
+            'name': self.name,
+            'total': round(self.elapsed(), 4),
+            'spans': {name: round(duration, 4) for name, duration in self.spans.items()},
+            **self.attributes
+        }
+
+    def finish(self):
+        """サンプリング対象であれば構造化レコードとして出力する"""
+        if self.sampled:
+            record = self.to_dict()
+            # JSON形式のログではextraのtraceフィールドとしても出力される
+            trace_logger.info("%s", LazyJson(record), extra={'trace': record})